@@ -0,0 +1,10 @@
+from __future__ import unicode_literals
+
+from django.apps import AppConfig
+
+
+class Config(AppConfig):
+    name = 'casepro.cases'
+
+    def ready(self):
+        from . import signals  # noqa
@@ -0,0 +1,103 @@
+from __future__ import absolute_import, unicode_literals
+
+import json
+
+from dash.orgs.models import Org
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from casepro.cases.models import Case, CaseFolder, Partner
+from casepro.msgs.models import Message, MessageFolder
+
+PAGE_SIZE = 50
+
+
+class Command(BaseCommand):
+    help = "Explains the canonical message and case folder searches and fails if any use a sequential scan of a " \
+           "large table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('org_id', metavar='ORG', type=int, help="The org to run searches for")
+        parser.add_argument('--min-rows', type=int, default=10000, dest='min_rows',
+                            help="Sequential scans of tables with at least this many rows are failures")
+
+    def handle(self, *args, **options):
+        org = Org.objects.filter(pk=options['org_id'], is_active=True).first()
+        if not org:
+            raise CommandError("No such org with id %d" % options['org_id'])
+
+        min_rows = options['min_rows']
+        failures = 0
+
+        for name, queryset in self.get_searches(org):
+            seq_scans = [s for s in self.get_seq_scans(queryset[:PAGE_SIZE]) if s[1] >= min_rows]
+
+            if seq_scans:
+                failures += 1
+                scans = ", ".join(["%s (~%d rows)" % s for s in seq_scans])
+                self.stdout.write(" > %s: FAIL sequential scan of %s" % (name, scans))
+            else:
+                self.stdout.write(" > %s: OK" % name)
+
+        if failures:
+            raise CommandError("%d searches use sequential scans of tables with %d+ rows" % (failures, min_rows))
+
+    def get_searches(self, org):
+        """
+        Gets the canonical searches for each folder as tuples of names and querysets
+        """
+        admin = org.administrators.filter(is_active=True).first()
+        if not admin:
+            raise CommandError("Org #%d has no active administrators" % org.pk)
+
+        searches = []
+        for folder in MessageFolder:
+            searches.append(('messages/%s' % folder.name, Message.search(org, admin, {'folder': folder})))
+        searches.append(('messages/flagged+archived', Message.search(org, admin, {
+            'folder': MessageFolder.flagged, 'include_archived': True
+        })))
+        for folder in CaseFolder:
+            searches.append(('cases/%s' % folder.name, Case.search(org, admin, {'folder': folder})))
+
+        # restricted partners have their searches limited by label access
+        partner = Partner.objects.filter(org=org, is_active=True, is_restricted=True).order_by('pk').first()
+        partner_user = partner.get_users().filter(is_active=True).first() if partner else None
+
+        if partner_user:
+            for folder in (MessageFolder.inbox, MessageFolder.flagged, MessageFolder.archived):
+                searches.append(('messages/%s (restricted)' % folder.name,
+                                 Message.search(org, partner_user, {'folder': folder})))
+            for folder in CaseFolder:
+                searches.append(('cases/%s (restricted)' % folder.name,
+                                 Case.search(org, partner_user, {'folder': folder})))
+
+        return searches
+
+    @staticmethod
+    def get_seq_scans(queryset):
+        """
+        Gets the sequential scans in the plan for the given queryset as tuples of table names and estimated table sizes
+        """
+        sql, params = queryset.query.sql_with_params()
+
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cursor.fetchone()[0]
+
+            if not isinstance(plan, list):  # pragma: no cover
+                plan = json.loads(plan)
+
+            tables = set()
+            nodes = [plan[0]['Plan']]
+            while nodes:
+                node = nodes.pop()
+                if node['Node Type'] == 'Seq Scan':
+                    tables.add(node['Relation Name'])
+                nodes.extend(node.get('Plans', []))
+
+            seq_scans = []
+            for table in sorted(tables):
+                cursor.execute("SELECT reltuples::BIGINT FROM pg_class WHERE relname = %s", [table])
+                seq_scans.append((table, cursor.fetchone()[0]))
+
+        return seq_scans
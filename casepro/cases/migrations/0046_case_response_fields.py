@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# populate the first reply time of each case from its earliest outgoing message
+FIRST_REPLY_SQL = """
+UPDATE cases_case c SET first_reply_on = r.first_reply_on
+FROM (
+  SELECT case_id, MIN(created_on) AS first_reply_on FROM msgs_outgoing WHERE case_id IS NOT NULL GROUP BY case_id
+) r
+WHERE r.case_id = c.id;
+"""
+
+# populate the assignment time of each case from its latest open/reassign action, unless that was a self-assignment
+ASSIGNED_SQL = """
+UPDATE cases_case c SET assigned_on = a.created_on
+FROM (
+  SELECT DISTINCT ON (case_id) case_id, assignee_id, created_by_id, created_on FROM cases_caseaction
+  WHERE action IN ('O', 'A') ORDER BY case_id, created_on DESC
+) a
+WHERE a.case_id = c.id AND a.assignee_id = c.assignee_id AND NOT EXISTS (
+  SELECT 1 FROM cases_partner_users pu WHERE pu.user_id = a.created_by_id AND pu.partner_id = c.assignee_id
+);
+"""
+
+# populate the time of the assignee's first reply since assignment
+ASSIGNEE_REPLIED_SQL = """
+UPDATE cases_case c SET assignee_replied_on = r.replied_on
+FROM (
+  SELECT o.case_id, MIN(o.created_on) AS replied_on FROM msgs_outgoing o
+  INNER JOIN cases_case c2 ON c2.id = o.case_id
+  WHERE o.partner_id = c2.assignee_id AND o.created_on >= c2.assigned_on
+  GROUP BY o.case_id
+) r
+WHERE r.case_id = c.id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0045_auto_20161014_1341'),
+        ('msgs', '0058_statement_triggers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='case',
+            name='first_reply_on',
+            field=models.DateTimeField(help_text='When this case was first replied to', null=True),
+        ),
+        migrations.AddField(
+            model_name='case',
+            name='assigned_on',
+            field=models.DateTimeField(
+                help_text='When this case was assigned to its current assignee by another partner', null=True),
+        ),
+        migrations.AddField(
+            model_name='case',
+            name='assignee_replied_on',
+            field=models.DateTimeField(help_text='When the current assignee first replied since assignment', null=True),
+        ),
+        migrations.RunSQL(FIRST_REPLY_SQL),
+        migrations.RunSQL(ASSIGNED_SQL),
+        migrations.RunSQL(ASSIGNEE_REPLIED_SQL),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# folder indexes include id so that searches ordered by (opened_on, id) can be paged by cursor without sorting
+INDEX_SQL = """
+DROP INDEX cases_open;
+CREATE INDEX cases_open
+ON cases_case(org_id, assignee_id, opened_on DESC, id DESC)
+WHERE closed_on IS NULL;
+
+DROP INDEX cases_closed;
+CREATE INDEX cases_closed
+ON cases_case(org_id, assignee_id, opened_on DESC, id DESC)
+WHERE closed_on IS NOT NULL;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0046_case_response_fields'),
+    ]
+
+    operations = [
+        migrations.RunSQL(INDEX_SQL)
+    ]
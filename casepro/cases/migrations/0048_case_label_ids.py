@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+from casepro.sql import InstallSQL
+
+BACKFILL_SQL = """
+UPDATE cases_case c SET label_ids = l.label_ids
+FROM (
+  SELECT case_id, ARRAY_AGG(label_id ORDER BY label_id) AS label_ids FROM cases_case_labels GROUP BY case_id
+) l
+WHERE c.id = l.case_id;
+"""
+
+INDEX_SQL = """
+CREATE INDEX cases_case_label_ids
+ON cases_case USING GIN (label_ids);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0047_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='case',
+            name='label_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None),
+        ),
+        migrations.RunSQL(BACKFILL_SQL),
+        migrations.RunSQL(INDEX_SQL),
+        InstallSQL('cases_0001')
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# the existing folder indexes lead with assignee_id so can't provide the order for searches across all assignees
+INDEX_SQL = """
+CREATE INDEX cases_open_org
+ON cases_case(org_id, opened_on DESC, id DESC)
+WHERE closed_on IS NULL;
+
+CREATE INDEX cases_closed_org
+ON cases_case(org_id, opened_on DESC, id DESC)
+WHERE closed_on IS NOT NULL;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0048_case_label_ids'),
+    ]
+
+    operations = [
+        migrations.RunSQL(INDEX_SQL)
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from casepro.sql import InstallSQL
+
+BACKFILL_SQL = """
+INSERT INTO statistics_totalcount("item_type", "scope", "count")
+SELECT cases_count_type(c), s, COUNT(*) FROM cases_case c, unnest(cases_count_scopes(c)) s GROUP BY 1, 2;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0049_case_org_folder_indexes'),
+        ('statistics', '0012_dailysecondtotalcount_bucket'),
+    ]
+
+    operations = [
+        InstallSQL('cases_0002'),
+        migrations.RunSQL(BACKFILL_SQL)
+    ]
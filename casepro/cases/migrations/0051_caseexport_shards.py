@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0050_case_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='caseexport',
+            name='items_done',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='caseexport',
+            name='num_items',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='caseexport',
+            name='shard_bounds',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), null=True, size=None),
+        ),
+        migrations.AddField(
+            model_name='caseexport',
+            name='shards_done',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None),
+        ),
+    ]
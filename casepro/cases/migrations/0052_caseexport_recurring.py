@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0051_caseexport_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='caseexport',
+            name='is_recurring',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='caseexport',
+            name='last_item_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='caseexport',
+            name='previous',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cases.CaseExport'),
+        ),
+    ]
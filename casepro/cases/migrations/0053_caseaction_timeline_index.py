@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# index includes id so that timeline pages ordered by (created_on, id) can be fetched by cursor
+INDEX_SQL = """
+CREATE INDEX cases_caseaction_case_created
+ON cases_caseaction(case_id, created_on DESC, id DESC);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0052_caseexport_recurring'),
+    ]
+
+    operations = [
+        migrations.RunSQL(INDEX_SQL)
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0053_caseaction_timeline_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='caseexport',
+            name='is_failed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,27 +1,36 @@
 from __future__ import absolute_import, unicode_literals
 
-import six
+import heapq
 
 from dash.orgs.models import Org
 from dash.utils import intersection
 from django.contrib.auth.models import User
+from django.contrib.postgres.fields import ArrayField
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
-from django.db import models
-from django.db.models import Q, Count, Prefetch
+from django.db import models, transaction
+from django.db.models import Q, Count, Prefetch, Value
 from django.utils.encoding import python_2_unicode_compatible
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from enum import Enum, IntEnum
-from itertools import chain
 from django_redis import get_redis_connection
+from temba_client.utils import format_iso8601
 
 from casepro.backend import get_backend
 from casepro.contacts.models import Contact
 from casepro.msgs.models import Label, Message, Outgoing
-from casepro.utils import TimelineItem
+from casepro.utils import TimelineItem, filter_before_cursor, datetime_to_microseconds
+from casepro.utils import encode_timeline_cursor, filter_timeline_before_cursor, parse_timeline_cursor
 from casepro.utils.export import BaseSearchExport
+from casepro.utils.push import subscription, wait_for_publish
 
 
 CASE_LOCK_KEY = 'org:%d:case_lock:%s'
+CASE_TIMELINE_KEY = 'org:%d:case_timeline:%d'
+CASE_TIMELINE_CHANNEL = 'org:%d:case_timeline_channel:%d'
+CASE_BACKEND_TIMELINE_KEY = 'org:%d:case_backend_timeline:%d:%d'
+CASE_BACKEND_TIMELINE_TTL = 60 * 60 * 24  # 1 day
 
 
 class CaseFolder(Enum):
@@ -134,15 +143,30 @@ class case_action(object):
         return wrapped
 
 
+class BackendTimelineItem(TimelineItem):
+    """
+    Wraps an outgoing message fetched from the backend, which has no local id, for inclusion in a case timeline
+    """
+    TIMELINE_TYPE = 'B'
+
+    def get_sort_key(self):
+        return self.get_time(), self.TIMELINE_TYPE, self.item.backend_broadcast_id or 0
+
+
 @python_2_unicode_compatible
 class Case(models.Model):
     """
     A case between a partner organization and a contact
     """
+    JSON_FIELDS = ('id', 'contact_id', 'assignee_id', 'assignee__name', 'user_assignee_id', 'label_ids', 'summary',
+                   'opened_on', 'closed_on')
+
     org = models.ForeignKey(Org, verbose_name=_("Organization"), related_name='cases')
 
     labels = models.ManyToManyField(Label, help_text=_("Labels assigned to this case"))
 
+    label_ids = ArrayField(models.IntegerField(), default=list)  # maintained via db triggers
+
     assignee = models.ForeignKey(Partner, related_name='cases')
 
     user_assignee = models.ForeignKey(
@@ -161,6 +185,16 @@ class Case(models.Model):
     closed_on = models.DateTimeField(null=True,
                                      help_text="When this case was closed")
 
+    first_reply_on = models.DateTimeField(null=True,
+                                          help_text="When this case was first replied to")
+
+    assigned_on = models.DateTimeField(null=True,
+                                       help_text="When this case was assigned to its current assignee by another "
+                                                 "partner")
+
+    assignee_replied_on = models.DateTimeField(null=True,
+                                               help_text="When the current assignee first replied since assignment")
+
     watchers = models.ManyToManyField(User, related_name='watched_cases',
                                       help_text="Users to be notified of case activity")
 
@@ -172,12 +206,13 @@ class Case(models.Model):
             # if user is not an org admin, we should only return cases with partner labels or assignment
             user_partner = user.get_partner(org)
             if user_partner and user_partner.is_restricted:
-                queryset = queryset.filter(Q(labels__in=list(user_partner.get_labels())) | Q(assignee=user_partner))
+                label_ids = list(user_partner.get_labels().values_list('pk', flat=True))
+                queryset = queryset.filter(Q(label_ids__overlap=label_ids) | Q(assignee=user_partner))
 
         if label:
-            queryset = queryset.filter(labels=label)
+            queryset = queryset.filter(label_ids__contains=[label.pk])
 
-        return queryset.distinct()
+        return queryset
 
     @classmethod
     def get_open(cls, org, user=None, label=None):
@@ -187,6 +222,22 @@ class Case(models.Model):
     def get_closed(cls, org, user=None, label=None):
         return cls.get_all(org, user, label).exclude(closed_on=None)
 
+    @classmethod
+    def get_counts(cls, org, user=None):
+        """
+        Gets the numbers of open and closed cases visible to the given user. These are read from the counts maintained
+        by db triggers, except for users of restricted partners whose access depends on labels as well as assignment.
+        """
+        from casepro.statistics.models import TotalCount
+
+        if user:
+            user_partner = user.get_partner(org)
+            if user_partner and user_partner.is_restricted:
+                return cls.get_open(org, user).count(), cls.get_closed(org, user).count()
+
+        return (TotalCount.get_by_org([org], TotalCount.TYPE_OPEN_CASES).total(),
+                TotalCount.get_by_org([org], TotalCount.TYPE_CLOSED_CASES).total())
+
     @classmethod
     def get_for_contact(cls, org, contact):
         return cls.get_all(org).filter(contact=contact)
@@ -205,6 +256,7 @@ class Case(models.Model):
         assignee_id = search.get('assignee')
         after = search.get('after')
         before = search.get('before')
+        before_cursor = search.get('before_cursor')
 
         if folder == CaseFolder.open:
             queryset = Case.get_open(org, user)
@@ -220,6 +272,8 @@ class Case(models.Model):
             queryset = queryset.filter(opened_on__gte=after)
         if before:
             queryset = queryset.filter(opened_on__lte=before)
+        if before_cursor:
+            queryset = filter_before_cursor(queryset, before_cursor, 'opened_on')
 
         queryset = queryset.select_related('contact', 'assignee', 'user_assignee')
 
@@ -227,7 +281,7 @@ class Case(models.Model):
             Prefetch('labels', Label.objects.filter(is_active=True))
         )
 
-        return queryset.order_by('-opened_on')
+        return queryset.order_by('-opened_on', '-pk')
 
     @classmethod
     def get_or_open(cls, org, user, message, summary, assignee, user_assignee=None, contact=None):
@@ -268,52 +322,174 @@ class Case(models.Model):
                 message.case = case
                 message.save(update_fields=('case',))
 
+                Message.record_changes(org, [message])
+
             case.is_new = True
             case.watchers.add(user)
             action = CaseAction.create(case, user, CaseAction.OPEN, assignee=assignee, user_assignee=user_assignee)
 
+            # self-assigned cases don't have their response times tracked at the partner level
+            if user.get_partner(org) != assignee:
+                case.assigned_on = action.created_on
+                case.save(update_fields=('assigned_on',))
+
             for assignee_user in assignee.get_users():
                 if assignee_user != user:
                     Notification.new_case_assignment(org, assignee_user, action)
         return case
 
     def get_timeline(self, after, before, merge_from_backend):
-        local_outgoing = self.outgoing_messages.filter(created_on__gte=after, created_on__lte=before)
-        local_outgoing = local_outgoing.select_related('case', 'contact', 'created_by').order_by('-created_on')
+        timeline = self.get_local_timeline(after, before)
+
+        if merge_from_backend:
+            # if this is the initial request, merge in additional messages from the backend
+            local_broadcast_ids = {t.item.backend_broadcast_id for t in timeline
+                                   if t.item.TIMELINE_TYPE == Outgoing.TIMELINE_TYPE and t.item.backend_broadcast_id}
+
+            # add any backend messages that don't exist locally
+            backend_items = [TimelineItem(msg) for msg in self.get_backend_messages(after, before)
+                             if msg.backend_broadcast_id not in local_broadcast_ids]
+
+            # both lists are already in chronological order so can be merged without re-sorting
+            timeline = list(heapq.merge(timeline, backend_items))
+
+        return timeline
+
+    def get_local_timeline(self, after, before):
+        """
+        Gets the local messages and actions in the given window as timeline items in chronological order. Items are
+        ordered by a single UNION query and then loaded by type.
+        """
+        sources = self.get_timeline_sources()
+
+        def item_ids(item_type, queryset):
+            queryset = queryset.filter(created_on__gte=after, created_on__lte=before)
+            queryset = queryset.prefetch_related(None).order_by()
+            queryset = queryset.annotate(item_type=Value(item_type, output_field=models.CharField()))
+            return queryset.values_list('pk', 'created_on', 'item_type')
+
+        first_ids, other_ids = item_ids(*sources[0]), [item_ids(*source) for source in sources[1:]]
+
+        rows = list(first_ids.union(*other_ids, all=True).order_by('created_on'))
 
-        local_incoming = self.incoming_messages.filter(created_on__gte=after, created_on__lte=before)
-        local_incoming = local_incoming.select_related('case', 'contact').prefetch_related('labels')
-        local_incoming = local_incoming.order_by('-created_on')
+        items_by_type = {
+            item_type: queryset.in_bulk([pk for pk, created_on, t in rows if t == item_type])
+            for item_type, queryset in sources
+        }
+
+        return [TimelineItem(items_by_type[item_type][pk]) for pk, created_on, item_type in rows]
+
+    def get_timeline_page(self, after, before, merge_from_backend, cursor, size):
+        """
+        Gets the most recent page of timeline items before the given cursor, returning a tuple of the items in
+        chronological order, whether there are older items, and the cursor for the next page. Each source is queried
+        separately in reverse chronological order so that it can use its (case_id, created_on) index. Messages from the
+        backend are another source, taken from the cached list of them.
+        """
+        items = []
+        for item_type, queryset in self.get_timeline_sources():
+            queryset = queryset.filter(created_on__gte=after, created_on__lte=before)
+            queryset = filter_timeline_before_cursor(queryset, item_type, cursor)
+            queryset = queryset.order_by('-created_on', '-pk')
 
-        # merge local incoming and outgoing
-        timeline = [TimelineItem(msg) for msg in chain(local_outgoing, local_incoming)]
+            items += [TimelineItem(i) for i in queryset[:size + 1]]
 
         if merge_from_backend:
-            # if this is the initial request, fetch additional messages from the backend
-            backend = get_backend()
-            backend_messages = backend.fetch_contact_messages(self.org, self.contact, after, before)
+            parsed_cursor = parse_timeline_cursor(cursor)
+            page_end = parsed_cursor[1] if parsed_cursor else before
 
-            # add any backend messages that don't exist locally
-            if backend_messages:
-                local_broadcast_ids = {o.backend_broadcast_id for o in local_outgoing if o.backend_broadcast_id}
+            local_broadcast_ids = set(self.outgoing_messages.filter(
+                created_on__gte=after, created_on__lte=before, backend_broadcast_id__isnull=False
+            ).values_list('backend_broadcast_id', flat=True))
 
-                for msg in backend_messages:
-                    if msg.backend_broadcast_id not in local_broadcast_ids:
-                        timeline.append(TimelineItem(msg))
+            backend_items = [BackendTimelineItem(msg) for msg in self.get_backend_messages(after, page_end)
+                             if msg.backend_broadcast_id not in local_broadcast_ids]
 
-        # fetch and append actions
-        actions = self.actions.filter(created_on__gte=after, created_on__lte=before)
-        actions = actions.select_related('assignee', 'user_assignee', 'created_by')
-        timeline += [TimelineItem(a) for a in actions]
+            # the same as filter_timeline_before_cursor does for the local sources
+            if parsed_cursor:
+                cursor_type, cursor_time, cursor_pk = parsed_cursor
+                backend_items = [t for t in backend_items if t.get_sort_key() < (cursor_time, cursor_type, cursor_pk)]
 
-        # sort timeline by reverse chronological order
-        return sorted(timeline, key=lambda item: item.get_time())
+            # backend messages are in chronological order so the newest are last
+            items += backend_items[-(size + 1):]
+
+        items = sorted(items, key=lambda t: t.get_sort_key(), reverse=True)
+        has_more = len(items) > size
+        items = items[:size]
+        next_cursor = encode_timeline_cursor(items[-1]) if has_more else None
+
+        return list(reversed(items)), has_more, next_cursor
+
+    def get_timeline_sources(self):
+        """
+        Gets the item type and queryset of each source of this case's timeline
+        """
+        return [
+            (Outgoing.TIMELINE_TYPE, self.outgoing_messages.select_related('case', 'contact', 'created_by')),
+            (Message.TIMELINE_TYPE,
+             self.incoming_messages.select_related('case', 'contact').prefetch_related('labels')),
+            (CaseAction.TIMELINE_TYPE, self.actions.select_related('assignee', 'user_assignee', 'created_by')),
+        ]
+
+    def get_backend_messages(self, after, before):
+        """
+        Gets messages for this case's contact from the backend. These are cached for the window starting at the given
+        time, so subsequent requests only fetch messages newer than the previous fetch.
+        """
+        key = CASE_BACKEND_TIMELINE_KEY % (self.org_id, self.pk, datetime_to_microseconds(after))
+        cached = cache.get(key)
+        if cached:
+            messages, fetched_until = cached['messages'], cached['until']
+        else:
+            messages, fetched_until = [], after
+
+        if fetched_until < before:
+            existing = {(broadcast_id, created_on) for broadcast_id, text, created_on in messages}
+
+            for msg in get_backend().fetch_contact_messages(self.org, self.contact, fetched_until, before):
+                if (msg.backend_broadcast_id, msg.created_on) not in existing:
+                    messages.append((msg.backend_broadcast_id, msg.text, msg.created_on))
+
+            messages = sorted(messages, key=lambda m: m[2])
+
+            cache.set(key, {'messages': messages, 'until': before}, CASE_BACKEND_TIMELINE_TTL)
+
+        return [Outgoing(backend_broadcast_id=broadcast_id, contact=self.contact, text=text, created_on=created_on)
+                for broadcast_id, text, created_on in messages if after <= created_on <= before]
+
+    def record_timeline_change(self):
+        """
+        Records that this case's timeline has changed, waking up any requests waiting for changes. This is deferred
+        until the current transaction commits so that woken requests can read the change.
+        """
+        def record():
+            pipe = get_redis_connection().pipeline()
+            pipe.set(CASE_TIMELINE_KEY % (self.org_id, self.pk), datetime_to_microseconds(now()), ex=60 * 60 * 24)
+            pipe.publish(CASE_TIMELINE_CHANNEL % (self.org_id, self.pk), 1)
+            pipe.execute()
+
+        transaction.on_commit(record)
+
+    def wait_for_timeline_change(self, after, timeout):
+        """
+        Waits up to the given number of seconds for this case's timeline to change after the given time, returning
+        whether it has
+        """
+        with subscription(CASE_TIMELINE_CHANNEL % (self.org_id, self.pk)) as pubsub:
+            last_change = get_redis_connection().get(CASE_TIMELINE_KEY % (self.org_id, self.pk))
+            if last_change and int(last_change) > datetime_to_microseconds(after):
+                return True
+
+            return wait_for_publish(pubsub, timeout)
 
     def add_reply(self, message):
         message.case = self
         message.is_archived = True
         message.save(update_fields=('case', 'is_archived'))
 
+        Message.record_changes(self.org, [message])
+        self.record_timeline_change()
+
         self.notify_watchers(reply=message)
 
     @case_action()
@@ -358,13 +534,15 @@ class Case(models.Model):
     def reassign(self, user, partner, note=None, user_assignee=None):
         from casepro.profiles.models import Notification
 
-        self.assignee = partner
-        self.user_assignee = user_assignee
-        self.save(update_fields=('assignee', 'user_assignee'))
-
         action = CaseAction.create(
             self, user, CaseAction.REASSIGN, assignee=partner, note=note, user_assignee=user_assignee)
 
+        self.assignee = partner
+        self.user_assignee = user_assignee
+        self.assigned_on = action.created_on if user.get_partner(self.org) != partner else None
+        self.assignee_replied_on = None
+        self.save(update_fields=('assignee', 'user_assignee', 'assigned_on', 'assignee_replied_on'))
+
         self.notify_watchers(action=action)
 
         # also notify users in the assigned partner that this case has been assigned to them
@@ -449,6 +627,51 @@ class Case(models.Model):
     def is_closed(self):
         return self.closed_on is not None
 
+    @classmethod
+    def as_json_by_id(cls, case_ids):
+        """
+        Gets the compact JSON of the given cases as a dict by id
+        """
+        from casepro.profiles.models import users_as_json_by_id
+
+        rows = list(cls.objects.filter(pk__in=set(case_ids)).values_list(
+            'pk', 'assignee_id', 'assignee__name', 'user_assignee_id'))
+        users = users_as_json_by_id([r[3] for r in rows if r[3]])
+
+        partners = {}
+        cases = {}
+        for pk, assignee_id, assignee_name, user_assignee_id in rows:
+            assignee = partners.setdefault(assignee_id, {'id': assignee_id, 'name': assignee_name})
+            cases[pk] = {'id': pk, 'assignee': assignee, 'user_assignee': users.get(user_assignee_id)}
+        return cases
+
+    @classmethod
+    def as_json_rows(cls, rows):
+        """
+        Prepares a page of cases fetched as values of JSON_FIELDS for JSON serialization
+        """
+        from casepro.profiles.models import users_as_json_by_id
+
+        contacts = Contact.as_json_by_id([r['contact_id'] for r in rows])
+        users = users_as_json_by_id([r['user_assignee_id'] for r in rows if r['user_assignee_id']])
+        labels = Label.as_json_by_id([l for r in rows for l in r['label_ids']], active_only=True)
+
+        partners = {}
+        results = []
+        for r in rows:
+            assignee = partners.setdefault(r['assignee_id'], {'id': r['assignee_id'], 'name': r['assignee__name']})
+            results.append({
+                'id': r['id'],
+                'assignee': assignee,
+                'user_assignee': users.get(r['user_assignee_id']),
+                'contact': contacts[r['contact_id']],
+                'labels': [labels[l] for l in r['label_ids'] if l in labels],
+                'summary': r['summary'],
+                'opened_on': format_iso8601(r['opened_on']),
+                'is_closed': r['closed_on'] is not None
+            })
+        return results
+
     def as_json(self, full=True):
         if full:
             return {
@@ -515,10 +738,13 @@ class CaseAction(models.Model):
 
     @classmethod
     def create(cls, case, user, action, assignee=None, label=None, note=None, user_assignee=None):
-        return CaseAction.objects.create(
+        case_action = CaseAction.objects.create(
             case=case, action=action, created_by=user, assignee=assignee, label=label, note=note,
             user_assignee=user_assignee)
 
+        case.record_timeline_change()
+        return case_action
+
     def as_json(self):
         return {
             'id': self.pk,
@@ -544,56 +770,53 @@ class CaseExport(BaseSearchExport):
         search['folder'] = CaseFolder[search['folder']]
         return search
 
-    def render_search(self, book, search):
+    def get_items(self, search):
+        return Case.search(self.org, self.created_by, search).select_related('initial_message')  # for "Message On"
+
+    def iter_rows(self, search):
         from casepro.contacts.models import Field
 
         base_fields = [
             "Message On", "Opened On", "Closed On", "Assigned Partner", "Labels", "Summary",
             "Messages Sent", "Messages Received", "Contact"
         ]
-        contact_fields = Field.get_all(self.org, visible=True)
+        contact_fields = list(Field.get_all(self.org, visible=True))
+        field_keys = [f.key for f in contact_fields]
         all_fields = base_fields + [f.label for f in contact_fields]
 
-        # load all messages to be exported
-        items = Case.search(self.org, self.created_by, search)
-
-        items = items.select_related('initial_message')  # need for "Message On"
-
-        items = items.annotate(
-            incoming_count=Count('incoming_messages', distinct=True),
-            outgoing_count=Count('outgoing_messages', distinct=True)
-        )
-
-        def add_sheet(num):
-            sheet = book.add_sheet(six.text_type(_("Cases %d" % num)))
-            self.write_row(sheet, 0, all_fields)
-            return sheet
-
-        sheet = None
-        sheet_number = 0
-        row = 1
-        for item in items:
-            if not sheet or row > self.MAX_SHEET_ROWS:
-                sheet_number += 1
-                sheet = add_sheet(sheet_number)
-                row = 1
-
-            values = [
-                item.initial_message.created_on if item.initial_message else '',
-                item.opened_on,
-                item.closed_on,
-                item.assignee.name,
-                ', '.join([l.name for l in item.labels.all()]),
-                item.summary,
-                item.outgoing_count,
-                # subtract 1 for the initial messages
-                item.incoming_count - 1 if item.initial_message else item.incoming_count,
-                item.contact.uuid
-            ]
-
-            fields = item.contact.get_fields()
-            for field in contact_fields:
-                values.append(fields.get(field.key, ""))
-
-            self.write_row(sheet, row, values)
-            row += 1
+        yield all_fields
+
+        # cases to be exported are fetched in chunks
+        for chunk in self.iter_chunks(self.get_items(search)):
+            # count messages for the cases in this chunk rather than joining both message tables for every case
+            case_ids = [item.pk for item in chunk]
+            incoming_counts = self.get_message_counts(Message.objects.filter(case_id__in=case_ids))
+            outgoing_counts = self.get_message_counts(Outgoing.objects.filter(case_id__in=case_ids))
+
+            for item in chunk:
+                incoming_count = incoming_counts.get(item.pk, 0)
+
+                values = [
+                    item.initial_message.created_on if item.initial_message else '',
+                    item.opened_on,
+                    item.closed_on,
+                    item.assignee.name,
+                    ', '.join([l.name for l in item.labels.all()]),
+                    item.summary,
+                    outgoing_counts.get(item.pk, 0),
+                    # subtract 1 for the initial messages
+                    incoming_count - 1 if item.initial_message else incoming_count,
+                    item.contact.uuid
+                ]
+
+                fields = item.contact.get_fields()
+                values += [fields.get(key, "") for key in field_keys]
+
+                yield values
+
+    @staticmethod
+    def get_message_counts(messages):
+        """
+        Gets the given messages counted by case id
+        """
+        return dict(messages.order_by().values_list('case_id').annotate(count=Count('pk')))
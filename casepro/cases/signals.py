@@ -0,0 +1,33 @@
+from __future__ import unicode_literals
+
+from django.db.models.signals import post_save, m2m_changed
+from django.dispatch import receiver
+
+from casepro.utils import bump_org_version
+
+from .models import Case, Partner
+
+
+@receiver(post_save, sender=Partner)
+def update_partner_labels_version(sender, instance, **kwargs):
+    """
+    Partner changes can change which labels its users can access
+    """
+    bump_org_version(instance.org_id, 'labels')
+
+
+@receiver(m2m_changed, sender=Partner.labels.through)
+def update_partner_labels_version_on_change(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_org_version(instance.org_id, 'labels')
+
+
+@receiver(post_save, sender=Case)
+def update_cases_version(sender, instance, **kwargs):
+    bump_org_version(instance.org_id, 'cases')
+
+
+@receiver(m2m_changed, sender=Case.labels.through)
+def update_cases_version_on_label(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_org_version(instance.org_id, 'cases')
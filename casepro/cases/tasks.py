@@ -6,10 +6,17 @@ from celery.utils.log import get_task_logger
 logger = get_task_logger(__name__)
 
 
-@shared_task
-def case_export(export_id):
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def case_export(task, export_id, shard=None):
     from .models import CaseExport
 
-    logger.info("Starting case export #%d..." % export_id)
+    export = CaseExport.objects.get(pk=export_id)
 
-    CaseExport.objects.get(pk=export_id).do_export()
+    if shard is None:
+        logger.info("Starting case export #%d..." % export_id)
+
+        export.start(task)
+    else:
+        logger.info("Starting shard %d of case export #%d..." % (shard, export_id))
+
+        export.do_shard(task, shard)
@@ -1,23 +1,28 @@
 # coding=utf-8
 from __future__ import absolute_import, unicode_literals
 
+import codecs
 import pytz
 import six
 
 from datetime import datetime, timedelta
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
+from django.core.management import call_command, CommandError
 from django.core.urlresolvers import reverse
 from django.test.utils import override_settings, modify_settings
 from django.utils import timezone
 from mock import patch
+from six import StringIO
 from six.moves import reload_module
 from temba_client.utils import format_iso8601
 
 from casepro.contacts.models import Contact
-from casepro.msgs.models import Message, Outgoing
+from casepro.msgs.models import Label, Message, Outgoing
 from casepro.msgs.tasks import handle_messages
 from casepro.profiles.models import ROLE_ANALYST, ROLE_MANAGER, Notification
+from casepro.statistics.models import TotalCount
 from casepro.test import BaseCasesTest
 from casepro.utils import datetime_to_microseconds, microseconds_to_datetime
 from casepro.pods import registry as pod_registry
@@ -25,6 +30,7 @@ from casepro.pods.tests.utils import DummyPodPlugin
 
 from .context_processors import sentry_dsn
 from .models import AccessLevel, Case, CaseAction, CaseExport, CaseFolder, Partner
+from .views import BaseInboxView
 
 
 class CaseTest(BaseCasesTest):
@@ -287,6 +293,8 @@ class CaseTest(BaseCasesTest):
         case3 = self.create_case(self.unicef, cat, self.who, msg3, [self.pregnancy])
         case4 = self.create_case(self.nyaruka, nic, self.klab, msg4, [self.code])
 
+        self.assertEqual(case2.label_ids, sorted([self.aids.pk, self.pregnancy.pk]))
+
         self.assertEqual(set(Case.get_all(self.unicef)), {case1, case2, case3})  # org admins see all
         self.assertEqual(set(Case.get_all(self.nyaruka)), {case4})
 
@@ -310,6 +318,58 @@ class CaseTest(BaseCasesTest):
         self.assertEqual(set(Case.get_closed(self.unicef)), {case2})
         self.assertEqual(set(Case.get_closed(self.unicef, user=self.user1, label=self.pregnancy)), {case2})
 
+    def test_counts(self):
+        bob = self.create_contact(self.unicef, 'C-002', "Bob")
+        msg1 = self.create_message(self.unicef, 123, self.ann, "Hello 1", [self.aids])
+        msg2 = self.create_message(self.unicef, 234, bob, "Hello 2", [self.aids, self.pregnancy])
+
+        case1 = self.create_case(self.unicef, self.ann, self.moh, msg1, [self.aids])
+        case2 = self.create_case(self.unicef, bob, self.who, msg2, [self.aids, self.pregnancy])
+
+        def assert_counts(scope, open_count, closed_count):
+            if isinstance(scope, Partner):
+                get_count_set = TotalCount.get_by_partner
+            elif isinstance(scope, Label):
+                get_count_set = TotalCount.get_by_label
+            else:
+                get_count_set = TotalCount.get_by_org
+
+            self.assertEqual(get_count_set([scope], TotalCount.TYPE_OPEN_CASES).total(), open_count)
+            self.assertEqual(get_count_set([scope], TotalCount.TYPE_CLOSED_CASES).total(), closed_count)
+
+        assert_counts(self.unicef, 2, 0)
+        assert_counts(self.moh, 1, 0)
+        assert_counts(self.who, 1, 0)
+        assert_counts(self.aids, 2, 0)
+        assert_counts(self.pregnancy, 1, 0)
+
+        case2.close(self.admin)
+
+        assert_counts(self.unicef, 1, 1)
+        assert_counts(self.who, 0, 1)
+        assert_counts(self.aids, 1, 1)
+        assert_counts(self.pregnancy, 0, 1)
+
+        case1.reassign(self.admin, self.who)
+        case1.unlabel(self.admin, self.aids)
+        case1.label(self.admin, self.pregnancy)
+
+        assert_counts(self.unicef, 1, 1)
+        assert_counts(self.moh, 0, 0)
+        assert_counts(self.who, 1, 1)
+        assert_counts(self.aids, 0, 1)
+        assert_counts(self.pregnancy, 1, 1)
+
+        # counts for admins come from the maintained counts, and for restricted partners from queries
+        self.assertEqual(Case.get_counts(self.unicef, self.admin), (1, 1))
+
+        self.assertEqual(Case.get_counts(self.unicef, self.user1), (1, 1))  # MOH can see both by label
+
+        case2.reopen(self.admin)
+
+        self.assertEqual(Case.get_counts(self.unicef), (2, 0))
+        self.assertEqual(TotalCount.get_by_partner([self.who], TotalCount.TYPE_OPEN_CASES).total(), 2)
+
     def test_get_open_for_contact_on(self):
         d0 = datetime(2014, 1, 5, 0, 0, tzinfo=pytz.UTC)
         d1 = datetime(2014, 1, 10, 0, 0, tzinfo=pytz.UTC)
@@ -441,6 +501,21 @@ class CaseTest(BaseCasesTest):
         assert_search(self.admin, {'folder': CaseFolder.open, 'before': d2}, [case2])
         assert_search(self.admin, {'folder': CaseFolder.open, 'after': d3}, [case4, case3])
 
+    def test_record_timeline_change(self):
+        msg = self.create_message(self.unicef, 123, self.ann, "Hello")
+        case = self.create_case(self.unicef, self.ann, self.moh, msg)
+        t0 = timezone.now()
+
+        # changes aren't visible to waiting requests until the current transaction commits
+        with patch('django.db.transaction.on_commit') as mock_on_commit:
+            case.record_timeline_change()
+
+        self.assertFalse(case.wait_for_timeline_change(t0, 0))
+
+        mock_on_commit.call_args[0][0]()
+
+        self.assertTrue(case.wait_for_timeline_change(t0, 0))
+
     def test_access_level(self):
         msg = self.create_message(self.unicef, 234, self.ann, "Hello")
         case = self.create_case(self.unicef, self.ann, self.moh, msg, [self.aids])
@@ -451,6 +526,24 @@ class CaseTest(BaseCasesTest):
         self.assertEqual(case.access_level(self.user3), AccessLevel.read)  # user from other partner can read bc labels
         self.assertEqual(case.access_level(self.user4), AccessLevel.none)  # user from different org
 
+    def test_explain_searches(self):
+        out = StringIO()
+        call_command('explainsearches', self.unicef.pk, stdout=out)
+
+        self.assertIn(" > messages/inbox: OK", out.getvalue())
+        self.assertIn(" > cases/open (restricted): OK", out.getvalue())
+
+        with patch('casepro.cases.management.commands.explainsearches.Command.get_seq_scans') as mock_get_seq_scans:
+            mock_get_seq_scans.return_value = [('msgs_message', 20000)]
+
+            self.assertRaises(CommandError, call_command, 'explainsearches', self.unicef.pk, stdout=out)
+            self.assertIn(" > messages/inbox: FAIL sequential scan of msgs_message (~20000 rows)", out.getvalue())
+
+            # fine if tables are smaller than the minimum
+            call_command('explainsearches', self.unicef.pk, '--min-rows=50000', stdout=out)
+
+        self.assertRaises(CommandError, call_command, 'explainsearches', 12345)
+
 
 @modify_settings(INSTALLED_APPS={'append': 'casepro.pods.tests.utils.DummyPodPlugin'})
 @override_settings(PODS=[{'label': 'dummy_pod', 'title': 'FooPod'}])
@@ -820,6 +913,8 @@ class CaseCRUDLTest(BaseCasesTest):
         case = self.create_case(self.unicef, self.ann, self.moh, msg1, user_assignee=self.user1)
         CaseAction.create(case, self.user1, CaseAction.OPEN, assignee=self.moh, user_assignee=self.user1)
 
+        cache.delete_pattern('org:*:case_backend_timeline:*')
+
         # backend has a message in the case time window that we don't have locally
         remote_message1 = Outgoing(backend_broadcast_id=102, contact=self.ann, text="Non casepro message...",
                                    created_on=d2)
@@ -927,6 +1022,16 @@ class CaseCRUDLTest(BaseCasesTest):
         # nothing to see
         self.assertEqual(len(response.json['results']), 0)
 
+        # long-polls return straight away if the timeline has already changed
+        response = self.url_get('unicef', '%s?after=%s&wait=1' % (timeline_url, datetime_to_microseconds(t5)))
+        self.assertEqual(len(response.json['results']), 1)
+        self.assertEqual(response.json['results'][0]['item']['action'], 'C')
+
+        # otherwise they wait for a change
+        with self.settings(SITE_PUSH_TIMEOUT=0.1):
+            response = self.url_get('unicef', '%s?after=%s&wait=1' % (timeline_url, datetime_to_microseconds(t6)))
+            self.assertEqual(len(response.json['results']), 0)
+
         # user now refreshes page...
 
         # backend has the message sent during the case as well as the unrelated message
@@ -958,10 +1063,17 @@ class CaseCRUDLTest(BaseCasesTest):
         self.assertEqual(items[6]['type'], 'A')
         self.assertEqual(items[6]['item']['action'], 'C')
 
-        # as this was the initial request, messages will have been fetched from the backend
-        mock_fetch_contact_messages.assert_called_once_with(self.unicef, self.ann, d1, case.closed_on)
+        # backend messages were cached by the first request so only newer messages are fetched
+        mock_fetch_contact_messages.assert_called_once_with(self.unicef, self.ann, t0, case.closed_on)
         mock_fetch_contact_messages.reset_mock()
 
+        # refreshing again doesn't need to fetch anything from the backend
+        response = self.url_get('unicef', '%s?after=' % timeline_url)
+        self.assertEqual(len(response.json['results']), 7)
+        self.assertEqual(response.json['results'][1]['item']['text'], "Non casepro message...")
+
+        self.assertNotCalled(mock_fetch_contact_messages)
+
     def test_timeline_no_initial_message(self):
         """
         If a case has no initial message, the timeline should start from the datetime it was opened.
@@ -977,6 +1089,62 @@ class CaseCRUDLTest(BaseCasesTest):
         self.assertEqual(case_open['item']['action'], CaseAction.OPEN)
         self.assertEqual(case_open['item']['id'], caseaction.pk)
 
+    @patch('casepro.test.TestBackend.fetch_contact_messages')
+    @patch('casepro.cases.views.TIMELINE_PAGE_SIZE', 2)
+    def test_timeline_paged(self, mock_fetch_contact_messages):
+        d1 = datetime(2014, 1, 2, 13, 0, tzinfo=pytz.UTC)
+        d2 = datetime(2014, 1, 2, 14, 0, tzinfo=pytz.UTC)
+        d3 = datetime(2014, 1, 2, 15, 0, tzinfo=pytz.UTC)
+
+        msg1 = self.create_message(self.unicef, 111, self.ann, "What is AIDS?", [self.aids], created_on=d1)
+        case = self.create_case(self.unicef, self.ann, self.moh, msg1, user_assignee=self.user1)
+        CaseAction.create(case, self.user1, CaseAction.OPEN, assignee=self.moh, user_assignee=self.user1)
+        case.add_note(self.user1, "Looks interesting")
+        case.add_note(self.user1, "Still interesting")
+
+        cache.delete_pattern('org:*:case_backend_timeline:*')
+
+        mock_fetch_contact_messages.return_value = [
+            Outgoing(backend_broadcast_id=102, contact=self.ann, text="Non casepro message...", created_on=d2),
+            Outgoing(backend_broadcast_id=103, contact=self.ann, text="Another one...", created_on=d3),
+        ]
+
+        timeline_url = reverse('cases.case_timeline', args=[case.pk])
+        self.login(self.user1)
+
+        # first page has the most recent items in chronological order
+        response = self.url_get('unicef', '%s?before_cursor=' % timeline_url)
+        self.assertEqual([i['item'].get('note') for i in response.json['results']],
+                         ["Looks interesting", "Still interesting"])
+        self.assertTrue(response.json['has_more'])
+
+        # next page has older items, including those from the backend which count towards the page size
+        response = self.url_get('unicef', '%s?before_cursor=%s' % (timeline_url, response.json['next_cursor']))
+        items = response.json['results']
+
+        self.assertEqual(len(items), 2)
+        self.assertEqual(items[0]['type'], 'O')
+        self.assertEqual(items[0]['item']['text'], "Another one...")
+        self.assertEqual(items[1]['type'], 'A')
+        self.assertEqual(items[1]['item']['action'], 'O')
+        self.assertTrue(response.json['has_more'])
+        self.assertTrue(response.json['next_cursor'].startswith('B:'))
+
+        # and the last page continues from the backend message which ended the previous page
+        response = self.url_get('unicef', '%s?before_cursor=%s' % (timeline_url, response.json['next_cursor']))
+        items = response.json['results']
+
+        self.assertEqual(len(items), 2)
+        self.assertEqual(items[0]['type'], 'I')
+        self.assertEqual(items[0]['item']['text'], "What is AIDS?")
+        self.assertEqual(items[1]['type'], 'O')
+        self.assertEqual(items[1]['item']['text'], "Non casepro message...")
+        self.assertFalse(response.json['has_more'])
+        self.assertIsNone(response.json['next_cursor'])
+
+        # backend messages were only fetched once
+        self.assertEqual(mock_fetch_contact_messages.call_count, 1)
+
     def test_search(self):
         url = reverse('cases.case_search')
 
@@ -1060,7 +1228,8 @@ class CaseCRUDLTest(BaseCasesTest):
 
 
 class CaseExportCRUDLTest(BaseCasesTest):
-    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory',
+                       EXPORT_STREAM_THRESHOLD=0)
     def test_create_and_read(self):
         ann = self.create_contact(self.unicef, "C-001", "Ann", fields={'nickname': "Annie", 'age': "28", 'state': "WA"})
         bob = self.create_contact(self.unicef, "C-002", "Bob", fields={'age': "32", 'state': "IN"})
@@ -1094,20 +1263,19 @@ class CaseExportCRUDLTest(BaseCasesTest):
         export = CaseExport.objects.get()
         self.assertEqual(export.created_by, self.user1)
 
-        workbook = self.openWorkbook(export.filename)
-        sheet = workbook.sheets()[0]
+        rows = self.openCSV(export.filename)
 
-        self.assertEqual(sheet.nrows, 3)
-        self.assertExcelRow(sheet, 0, [
+        self.assertEqual(len(rows), 3)
+        self.assertCSVRow(rows, 0, [
             "Message On", "Opened On", "Closed On", "Assigned Partner", "Labels", "Summary",
             "Messages Sent", "Messages Received", "Contact", "Nickname", "Age"
         ])
-        self.assertExcelRow(sheet, 1, [
+        self.assertCSVRow(rows, 1, [
             msg2.created_on, case2.opened_on, "", "WHO", "Pregnancy", "I ♡ RapidPro", 0, 0, "C-002", "", "32"
-        ], pytz.UTC)
-        self.assertExcelRow(sheet, 2, [
+        ])
+        self.assertCSVRow(rows, 2, [
             msg1.created_on, case1.opened_on, "", "MOH", "AIDS", "What is HIV?", 2, 3, "C-001", "Annie", "28"
-        ], pytz.UTC)
+        ])
 
         read_url = reverse('cases.caseexport_read', args=[export.pk])
 
@@ -1121,7 +1289,87 @@ class CaseExportCRUDLTest(BaseCasesTest):
         response = self.url_get('unicef', read_url)
         self.assertEqual(response.status_code, 302)
 
-    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory',
+                       EXPORT_STREAM_THRESHOLD=1)
+    def test_create_streamed(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann", fields={'nickname': "Annie", 'age': "28"})
+        bob = self.create_contact(self.unicef, "C-002", "Bob", fields={'age': "32"})
+        msg1 = self.create_message(self.unicef, 101, ann, "What is HIV?")
+        msg2 = self.create_message(self.unicef, 102, bob, "Hello")
+
+        case1 = self.create_case(self.unicef, ann, self.moh, msg1, [self.aids], summary="What is HIV?")
+
+        self.login(self.user1)
+
+        # small searches aren't saved but are given a URL to download directly
+        response = self.url_post('unicef', '%s?folder=open' % reverse('cases.caseexport_create'))
+        self.assertEqual(response.json, {
+            'export_id': None,
+            'download_url': '%s?folder=open' % reverse('cases.caseexport_stream')
+        })
+        self.assertEqual(CaseExport.objects.count(), 0)
+
+        response = self.url_get('unicef', response.json['download_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=case_export.csv')
+
+        content = b''.join(response.streaming_content)
+        self.assertEqual(content[len(codecs.BOM_UTF8):].decode('utf-8').splitlines(), [
+            "Message On,Opened On,Closed On,Assigned Partner,Labels,Summary,Messages Sent,Messages Received,Contact,"
+            "Nickname,Age",
+            "{:%Y-%m-%d %H:%M:%S},{:%Y-%m-%d %H:%M:%S},,MOH,AIDS,What is HIV?,0,0,C-001,Annie,28".format(
+                msg1.created_on, case1.opened_on
+            ),
+        ])
+
+        self.create_case(self.unicef, bob, self.moh, msg2, [], summary="Hello")
+
+        # if the search grows after being found to be streamable, it's generated in the background instead
+        response = self.url_get('unicef', '%s?folder=open' % reverse('cases.caseexport_stream'))
+
+        export = CaseExport.objects.get()
+        self.assertRedirects(response, reverse('cases.caseexport_read', args=[export.pk]),
+                             fetch_redirect_response=False)
+        self.assertEqual(export.created_by, self.user1)
+        self.assertEqual(len(self.openCSV(export.filename)), 3)
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory',
+                       EXPORT_STREAM_THRESHOLD=0)
+    @patch('casepro.utils.export.BaseSearchExport.CHUNK_SIZE', 2)
+    def test_create_in_chunks(self):
+        cases = []
+        for i in range(5):
+            contact = self.create_contact(self.unicef, "C-00%d" % i, "Contact %d" % i, fields={'age': str(20 + i)})
+            msg = self.create_message(self.unicef, 100 + i, contact, "Hello")
+            label = self.aids if i % 2 else self.pregnancy
+            case = self.create_case(self.unicef, contact, self.moh, msg, [label], summary="Case %d" % i)
+
+            # give each case a different number of sent and received messages
+            for j in range(i):
+                self.create_outgoing(self.unicef, self.user1, 200 + 10 * i + j, Outgoing.CASE_REPLY, "Hi", contact,
+                                     case=case)
+            for j in range(4 - i):
+                self.create_message(self.unicef, 300 + 10 * i + j, contact, "Thanks", case=case)
+
+            cases.append((case, msg, label))
+
+        self.login(self.admin)
+        self.url_post('unicef', '%s?folder=open' % reverse('cases.caseexport_create'))
+
+        export = CaseExport.objects.get()
+        rows = self.openCSV(export.filename)
+
+        # rows are newest first across chunk boundaries, with labels and message counts fetched for each chunk
+        self.assertEqual(len(rows), 6)
+
+        for row_num, (i, (case, msg, label)) in enumerate(reversed(list(enumerate(cases))), start=1):
+            self.assertCSVRow(rows, row_num, [
+                msg.created_on, case.opened_on, "", "MOH", label.name, "Case %d" % i, i, 4 - i, case.contact.uuid,
+                "", str(20 + i)
+            ])
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory',
+                       EXPORT_STREAM_THRESHOLD=0)
     def test_create_with_no_initial_message(self):
         """When a case is exported with initial_message=None, the field should be a blank string."""
         ann = self.create_contact(self.unicef, "C-001", "Ann")
@@ -1131,16 +1379,15 @@ class CaseExportCRUDLTest(BaseCasesTest):
         self.url_post('unicef', '%s?folder=open' % reverse('cases.caseexport_create'))
 
         export = CaseExport.objects.get()
-        workbook = self.openWorkbook(export.filename)
-        sheet = workbook.sheets()[0]
+        rows = self.openCSV(export.filename)
 
-        self.assertExcelRow(sheet, 0, [
+        self.assertCSVRow(rows, 0, [
             "Message On", "Opened On", "Closed On", "Assigned Partner", "Labels", "Summary",
             "Messages Sent", "Messages Received", "Contact", "Nickname", "Age"
         ])
-        self.assertExcelRow(sheet, 1, [
+        self.assertCSVRow(rows, 1, [
             "", case.opened_on, "", self.moh.name, self.aids.name, "What is HIV?", 0, 0, ann.uuid, "", ""
-        ], pytz.UTC)
+        ])
 
 
 class InboxViewsTest(BaseCasesTest):
@@ -1168,6 +1415,55 @@ class InboxViewsTest(BaseCasesTest):
         self.assertContains(response, "Message Board")
         self.assertContains(response, "/messageboard/")
 
+    def test_bootstrap(self):
+        ann = self.create_contact(self.unicef, 'C-001', "Ann")
+        msg = self.create_message(self.unicef, 101, ann, "Hello", [self.aids])
+        case = self.create_case(self.unicef, ann, self.moh, msg, [self.aids])
+
+        bootstrap = BaseInboxView.get_bootstrap(self.unicef, self.admin, None)
+        self.assertEqual([l['name'] for l in bootstrap['labels']], ["AIDS", "Pregnancy", "Tea"])
+        self.assertEqual([g['name'] for g in bootstrap['groups']], ["Females", "Males", "Registered (Dynamic)"])
+        self.assertEqual([f['key'] for f in bootstrap['fields']], ["age", "nickname"])
+        self.assertNotIn('case_counts', bootstrap)
+
+        # restricted partners have their own cached context, including their case counts
+        bootstrap = BaseInboxView.get_bootstrap(self.unicef, self.user3, self.who)
+        self.assertEqual([l['name'] for l in bootstrap['labels']], ["AIDS"])
+        self.assertEqual(bootstrap['case_counts'], (1, 0))
+
+        # which is then served from cache
+        with self.assertNumQueries(0):
+            self.assertEqual(BaseInboxView.get_bootstrap(self.unicef, self.user3, self.who), bootstrap)
+
+        # until a case changes
+        case.close(self.user1)
+
+        bootstrap = BaseInboxView.get_bootstrap(self.unicef, self.user3, self.who)
+        self.assertEqual(bootstrap['case_counts'], (0, 1))
+
+        # or a label, group or field changes
+        self.tea.name = "Chai"
+        self.tea.save(update_fields=('name',))
+
+        bootstrap = BaseInboxView.get_bootstrap(self.unicef, self.admin, None)
+        self.assertEqual([l['name'] for l in bootstrap['labels']], ["AIDS", "Chai", "Pregnancy"])
+
+        self.males.is_visible = False
+        self.males.save(update_fields=('is_visible',))
+        self.age.is_visible = False
+        self.age.save(update_fields=('is_visible',))
+
+        bootstrap = BaseInboxView.get_bootstrap(self.unicef, self.admin, None)
+        self.assertEqual([g['name'] for g in bootstrap['groups']], ["Females", "Registered (Dynamic)"])
+        self.assertEqual([f['key'] for f in bootstrap['fields']], ["nickname"])
+
+        # or a partner's label access changes
+        self.who.labels.add(self.pregnancy)
+
+        bootstrap = BaseInboxView.get_bootstrap(self.unicef, self.user3, self.who)
+        self.assertEqual([l['name'] for l in bootstrap['labels']], ["AIDS", "Pregnancy"])
+        self.assertEqual(bootstrap['case_counts'], (0, 1))
+
 
 class PartnerTest(BaseCasesTest):
     def test_create(self):
@@ -1359,11 +1655,15 @@ class PartnerCRUDLTest(BaseCasesTest):
                 'id': self.moh.pk, 'name': "MOH", 'restricted': True,
                 'replies': {
                     'average_referral_response_time_this_month': u'0\xa0minutes',
+                    'referral_response_time_percentiles_this_month': {
+                        'p50': u'0\xa0minutes', 'p90': u'0\xa0minutes', 'p99': u'0\xa0minutes'},
                     'last_month': 0,
                     'this_month': 0,
                     'total': 0},
                 'cases': {
                     'average_closed_this_month': u'0\xa0minutes',
+                    'closed_percentiles_this_month': {
+                        'p50': u'0\xa0minutes', 'p90': u'0\xa0minutes', 'p99': u'0\xa0minutes'},
                     'opened_this_month': 0,
                     'closed_this_month': 0,
                     'total': 0},
@@ -1372,11 +1672,15 @@ class PartnerCRUDLTest(BaseCasesTest):
                 'id': self.who.pk, 'name': "WHO", 'restricted': True,
                 'replies': {
                     'average_referral_response_time_this_month': u'0\xa0minutes',
+                    'referral_response_time_percentiles_this_month': {
+                        'p50': u'0\xa0minutes', 'p90': u'0\xa0minutes', 'p99': u'0\xa0minutes'},
                     'last_month': 0,
                     'this_month': 0,
                     'total': 0},
                 'cases': {
                     'average_closed_this_month': u'0\xa0minutes',
+                    'closed_percentiles_this_month': {
+                        'p50': u'0\xa0minutes', 'p90': u'0\xa0minutes', 'p99': u'0\xa0minutes'},
                     'opened_this_month': 0,
                     'closed_this_month': 0,
                     'total': 0},
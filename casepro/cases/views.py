@@ -1,4 +1,7 @@
 from __future__ import absolute_import, unicode_literals
+
+import six
+
 from dash.orgs.models import Org, TaskState
 from dash.orgs.views import OrgPermsMixin, OrgObjPermsMixin
 from datetime import timedelta
@@ -19,15 +22,22 @@ from temba_client.utils import parse_iso8601
 from casepro.contacts.models import Contact, Field, Group
 from casepro.msgs.models import Label, Message, MessageFolder, OutgoingFolder
 from casepro.pods import registry as pod_registry
-from casepro.statistics.models import DailyCount, DailySecondTotalCount
+from casepro.statistics.models import DailyCount, DailySecondTotalCount, TotalCount
 from casepro.utils import json_encode, datetime_to_microseconds, microseconds_to_datetime, JSONEncoder, str_to_bool
-from casepro.utils import month_range, humanize_seconds
-from casepro.utils.export import BaseDownloadView
+from casepro.utils import month_range, humanize_seconds, cursor_page, get_org_versions
+from casepro.utils.export import BaseDownloadView, BaseStreamView
+from casepro.utils.push import get_push_timeout
+from casepro.utils.views import FastJsonResponse
 
 from .forms import PartnerCreateForm, PartnerUpdateForm
 from .models import AccessLevel, Case, CaseFolder, CaseExport, Partner
 from .tasks import case_export
 
+INBOX_CONTEXT_KEY = 'org:%d:inbox-context:%s:%s'
+INBOX_CONTEXT_TTL = 60  # label and group counts aren't versioned so may be this many seconds stale
+
+TIMELINE_PAGE_SIZE = 50
+
 
 class CaseSearchMixin(object):
     def derive_search(self):
@@ -39,8 +49,11 @@ class CaseSearchMixin(object):
         assignee = params.get('assignee')
         after = parse_iso8601(params.get('after'))
         before = parse_iso8601(params.get('before'))
+        before_cursor = params.get('before_cursor')
 
-        return {'folder': folder, 'assignee': assignee, 'after': after, 'before': before}
+        return {
+            'folder': folder, 'assignee': assignee, 'after': after, 'before': before, 'before_cursor': before_cursor
+        }
 
 
 class CaseCRUDL(SmartCRUDL):
@@ -242,34 +255,43 @@ class CaseCRUDL(SmartCRUDL):
             page = int(self.request.GET.get('page', 1))
 
             search = self.derive_search()
-            cases = Case.search(org, user, search)
-            paginator = LazyPaginator(cases, 50)
+            cases = Case.search(org, user, search).prefetch_related(None).values(*Case.JSON_FIELDS)
 
-            context['object_list'] = paginator.page(page)
-            context['has_more'] = paginator.num_pages > page
+            if search['before_cursor'] is not None:
+                context['object_list'], context['has_more'], context['next_cursor'] = cursor_page(
+                    cases, 50, 'opened_on')
+            else:
+                paginator = LazyPaginator(cases, 50)
+
+                context['object_list'] = paginator.page(page)
+                context['has_more'] = paginator.num_pages > page
             return context
 
         def render_to_response(self, context, **response_kwargs):
-            return JsonResponse({
-                'results': [c.as_json() for c in context['object_list']],
-                'has_more': context['has_more']
-            }, encoder=JSONEncoder)
+            return FastJsonResponse({
+                'results': Case.as_json_rows(list(context['object_list'])),
+                'has_more': context['has_more'],
+                'next_cursor': context.get('next_cursor')
+            })
 
-    class Timeline(OrgObjPermsMixin, SmartReadView):
+    class Timeline(NonAtomicMixin, OrgObjPermsMixin, SmartReadView):
         """
-        JSON endpoint for fetching case actions and messages
+        JSON endpoint for fetching case actions and messages. Non-atomic so that long-polls don't hold a transaction.
         """
         permission = 'cases.case_read'
 
         def get_context_data(self, **kwargs):
             context = super(CaseCRUDL.Timeline, self).get_context_data(**kwargs)
-            dt_now = now()
-            empty = False
 
             after = self.request.GET.get('after', None)
             if after:
                 after = microseconds_to_datetime(int(after))
                 merge_from_backend = False
+
+                # a long-poll request waits for the timeline to change before fetching it
+                if str_to_bool(self.request.GET.get('wait', '')):
+                    if self.object.wait_for_timeline_change(after, get_push_timeout()):
+                        self.object.refresh_from_db()
             else:
                 # this is the initial request for the complete timeline
                 if self.object.initial_message is not None:
@@ -278,6 +300,9 @@ class CaseCRUDL(SmartCRUDL):
                     after = self.object.opened_on
                 merge_from_backend = True
 
+            dt_now = now()
+            empty = False
+
             if self.object.closed_on:
                 if after > self.object.closed_on:
                     empty = True
@@ -287,14 +312,28 @@ class CaseCRUDL(SmartCRUDL):
             else:
                 before = dt_now
 
-            timeline = self.object.get_timeline(after, before, merge_from_backend) if not empty else []
+            # a request with a cursor fetches a page of the most recent items before that cursor
+            before_cursor = self.request.GET.get('before_cursor', None)
+
+            if empty:
+                timeline = []
+            elif before_cursor is not None:
+                timeline, context['has_more'], context['next_cursor'] = self.object.get_timeline_page(
+                    after, before, merge_from_backend, before_cursor, TIMELINE_PAGE_SIZE)
+            else:
+                timeline = self.object.get_timeline(after, before, merge_from_backend)
 
             context['timeline'] = timeline
             context['max_time'] = datetime_to_microseconds(dt_now)
             return context
 
         def render_to_response(self, context, **response_kwargs):
-            return JsonResponse({'results': context['timeline'], 'max_time': context['max_time']}, encoder=JSONEncoder)
+            return JsonResponse({
+                'results': context['timeline'],
+                'max_time': context['max_time'],
+                'has_more': context.get('has_more', False),
+                'next_cursor': context.get('next_cursor')
+            }, encoder=JSONEncoder)
 
     class Watch(OrgObjPermsMixin, SmartReadView):
         """
@@ -319,17 +358,30 @@ class CaseCRUDL(SmartCRUDL):
 
 class CaseExportCRUDL(SmartCRUDL):
     model = CaseExport
-    actions = ('create', 'read')
+    actions = ('create', 'stream', 'read')
 
     class Create(NonAtomicMixin, OrgPermsMixin, CaseSearchMixin, SmartCreateView):
         def post(self, request, *args, **kwargs):
             search = self.derive_search()
-            export = self.model.create(self.request.org, self.request.user, search)
+            export = self.model.for_search(self.request.org, self.request.user, search)
+
+            # small searches can be downloaded directly rather than generated in the background
+            if export.is_streamable():
+                stream_url = '%s?%s' % (reverse('cases.caseexport_stream'), request.GET.urlencode())
+                return JsonResponse({'export_id': None, 'download_url': stream_url})
+
+            export.save()
 
             case_export.delay(export.pk)
 
             return JsonResponse({'export_id': export.pk})
 
+    class Stream(NonAtomicMixin, CaseSearchMixin, BaseStreamView):
+        filename = 'case_export.csv'
+
+        def queue_export(self, export):
+            case_export.delay(export.pk)
+
     class Read(BaseDownloadView):
         title = _("Download Cases")
         filename = 'case_export.xls'
@@ -394,8 +446,8 @@ class PartnerCRUDL(SmartCRUDL):
         def get_summary(self, partner):
             return {
                 'total_replies': DailyCount.get_by_partner([partner], DailyCount.TYPE_REPLIES).total(),
-                'cases_open': Case.objects.filter(org=partner.org, assignee=partner, closed_on=None).count(),
-                'cases_closed': Case.objects.filter(org=partner.org, assignee=partner).exclude(closed_on=None).count()
+                'cases_open': TotalCount.get_by_partner([partner], TotalCount.TYPE_OPEN_CASES).total(),
+                'cases_closed': TotalCount.get_by_partner([partner], TotalCount.TYPE_CLOSED_CASES).total()
             }
 
     class Delete(OrgObjPermsMixin, SmartDeleteView):
@@ -434,6 +486,10 @@ class PartnerCRUDL(SmartCRUDL):
                 average_closed_this_month = DailySecondTotalCount.get_by_partner(
                     partners, DailySecondTotalCount.TYPE_TILL_CLOSED, *month_range(0))
                 average_closed_this_month = average_closed_this_month.scope_averages()
+                referral_response_time_percentiles_this_month = DailySecondTotalCount.get_by_partner(
+                    partners, DailySecondTotalCount.TYPE_TILL_REPLIED, *month_range(0)).scope_percentiles()
+                closed_percentiles_this_month = DailySecondTotalCount.get_by_partner(
+                    partners, DailySecondTotalCount.TYPE_TILL_CLOSED, *month_range(0)).scope_percentiles()
 
                 # get cases statistics
                 cases_total = DailyCount.get_by_partner(
@@ -452,10 +508,14 @@ class PartnerCRUDL(SmartCRUDL):
                             'last_month': replies_last_month.get(partner, 0),
                             'total': replies_total.get(partner, 0),
                             'average_referral_response_time_this_month': humanize_seconds(
-                                average_referral_response_time_this_month.get(partner, 0))
+                                average_referral_response_time_this_month.get(partner, 0)),
+                            'referral_response_time_percentiles_this_month': humanize_percentiles(
+                                referral_response_time_percentiles_this_month.get(partner, {}))
                         },
                         'cases': {
                             'average_closed_this_month': humanize_seconds(average_closed_this_month.get(partner, 0)),
+                            'closed_percentiles_this_month': humanize_percentiles(
+                                closed_percentiles_this_month.get(partner, {})),
                             'opened_this_month': cases_opened_this_month.get(partner, 0),
                             'closed_this_month': cases_closed_this_month.get(partner, 0),
                             'total': cases_total.get(partner, 0)
@@ -463,6 +523,9 @@ class PartnerCRUDL(SmartCRUDL):
                     })
                 return obj
 
+            def humanize_percentiles(percentiles):
+                return {'p%d' % p: humanize_seconds(v) for p, v in percentiles.items()}
+
             return JsonResponse({'results': [as_json(p) for p in partners]})
 
 
@@ -482,30 +545,58 @@ class BaseInboxView(OrgPermsMixin, SmartTemplateView):
         user = self.request.user
         partner = user.get_partner(org)
 
-        labels = list(Label.get_all(org, user).order_by('name'))
-        Label.bulk_cache_initialize(labels)
-
-        groups = Group.get_all(org, visible=True).order_by('name')
-        fields = Field.get_all(org, visible=True).order_by('label')
+        bootstrap = self.get_bootstrap(org, user, partner)
+        case_counts = bootstrap.get('case_counts') or Case.get_counts(org, user)
 
         # angular app requires context data in JSON format
         context['context_data_json'] = json_encode({
             'user': {'id': user.pk, 'partner': partner.as_json() if partner else None},
-            'labels': [l.as_json() for l in labels],
-            'groups': [g.as_json() for g in groups],
-            'fields': [f.as_json() for f in fields],
+            'labels': bootstrap['labels'],
+            'groups': bootstrap['groups'],
+            'fields': bootstrap['fields'],
         })
 
         context['banner_text'] = org.get_banner_text()
         context['folder'] = self.folder.name
         context['folder_icon'] = self.folder_icon
-        context['open_case_count'] = Case.get_open(org, user).count()
-        context['closed_case_count'] = Case.get_closed(org, user).count()
+        context['open_case_count'], context['closed_case_count'] = case_counts
         context['allow_case_without_message'] = getattr(settings, 'SITE_ALLOW_CASE_WITHOUT_MESSAGE', False)
         context['user_must_reply_with_faq'] = org and not user.is_anonymous() and user.must_use_faq()
         context['site_contact_display'] = getattr(settings, 'SITE_CONTACT_DISPLAY', "name")
         return context
 
+    @staticmethod
+    def get_bootstrap(org, user, partner):
+        """
+        Gets the labels, groups and fields visible to the given user. These only vary by whether the user belongs to a
+        restricted partner, so are cached per org and partner visibility until any of them change. Case counts of
+        restricted partners can't be read from maintained counts so are also cached until cases change.
+        """
+        restricted = partner and partner.is_restricted
+        visibility = 'partner:%d' % partner.pk if restricted else 'all'
+        versions = get_org_versions(org, 'labels', 'groups', 'fields', *(['cases'] if restricted else []))
+        key = INBOX_CONTEXT_KEY % (org.pk, visibility, '.'.join([six.text_type(v) for v in versions]))
+
+        bootstrap = cache.get(key)
+        if bootstrap is None:
+            labels = list(Label.get_all(org, user).order_by('name'))
+            Label.bulk_cache_initialize(labels)
+
+            groups = Group.get_all(org, visible=True).order_by('name')
+            fields = Field.get_all(org, visible=True).order_by('label')
+
+            bootstrap = {
+                'labels': [l.as_json() for l in labels],
+                'groups': [g.as_json() for g in groups],
+                'fields': [f.as_json() for f in fields],
+            }
+            if restricted:
+                bootstrap['case_counts'] = Case.get_counts(org, user)
+
+            cache.set(key, bootstrap, INBOX_CONTEXT_TTL)
+
+        return bootstrap
+
 
 class InboxView(BaseInboxView):
     """
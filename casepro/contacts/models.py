@@ -340,18 +340,34 @@ class Contact(models.Model):
         If the display setting is recognised and set then that field is returned, otherwise the name is returned.
         If no name is set an empty string is returned.
         """
-        display_format = getattr(settings, 'SITE_CONTACT_DISPLAY', self.DISPLAY_NAME)
+        return self._format_display(self.get_display_format(), self.uuid, self.name, self.urns)
 
-        if display_format == self.DISPLAY_ANON and self.uuid:
-            return self.uuid[:6].upper()
-        elif display_format == self.DISPLAY_URNS and self.urns:
-            _scheme, path = URN.to_parts(self.urns[0])
+    @classmethod
+    def get_display_format(cls):
+        return getattr(settings, 'SITE_CONTACT_DISPLAY', cls.DISPLAY_NAME)
+
+    @classmethod
+    def _format_display(cls, display_format, uuid, name, urns):
+        if display_format == cls.DISPLAY_ANON and uuid:
+            return uuid[:6].upper()
+        elif display_format == cls.DISPLAY_URNS and urns:
+            _scheme, path = URN.to_parts(urns[0])
             return path
-        elif display_format == self.DISPLAY_NAME and self.name:
-            return self.name
+        elif display_format == cls.DISPLAY_NAME and name:
+            return name
 
         return "---"
 
+    @classmethod
+    def as_json_by_id(cls, contact_ids):
+        """
+        Gets the compact JSON of the given contacts as a dict by id, fetching only the fields needed for their display
+        """
+        display_format = cls.get_display_format()
+        contacts = cls.objects.filter(pk__in=set(contact_ids)).values_list('pk', 'uuid', 'name', 'urns')
+
+        return {c[0]: {'id': c[0], 'display': cls._format_display(display_format, *c[1:])} for c in contacts}
+
     def get_fields(self, visible=None):
         fields = self.fields if self.fields else {}
 
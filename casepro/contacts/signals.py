@@ -5,7 +5,9 @@ import six
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
-from .models import Contact
+from casepro.utils import bump_org_version
+
+from .models import Contact, Field, Group
 
 
 @receiver(post_save, sender=Contact)
@@ -47,3 +49,13 @@ def update_contact_groups(sender, instance, created, **kwargs):
         instance.groups.add(*add_to_groups)
 
     delattr(instance, Contact.SAVE_GROUPS_ATTR)
+
+
+@receiver(post_save, sender=Group)
+def update_groups_version(sender, instance, **kwargs):
+    bump_org_version(instance.org_id, 'groups')
+
+
+@receiver(post_save, sender=Field)
+def update_fields_version(sender, instance, **kwargs):
+    bump_org_version(instance.org_id, 'fields')
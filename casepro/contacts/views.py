@@ -8,7 +8,7 @@ from django.utils.translation import ugettext_lazy as _
 from smartmin.views import SmartCRUDL, SmartReadView, SmartListView, SmartFormView
 
 from casepro.cases.models import Case
-from casepro.utils import json_encode, JSONEncoder
+from casepro.utils import json_encode, JSONEncoder, bump_org_version
 
 from .models import Contact, Group, Field
 
@@ -115,6 +115,8 @@ class GroupCRUDL(SmartCRUDL):
             org_groups.filter(pk__in=selected_ids).update(is_visible=True)
             org_groups.exclude(pk__in=selected_ids).update(is_visible=False)
 
+            bump_org_version(self.request.org.pk, 'groups')
+
             return HttpResponseRedirect(self.get_success_url())
 
 
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from casepro.sql import InstallSQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0057_auto_20170718_1504'),
+        ('statistics', '0011_auto_20170605_0657'),
+    ]
+
+    operations = [
+        InstallSQL('msgs_0003')
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# trigram indexes on the same UPPER(...) expressions that Django uses for icontains lookups, so that substring searches
+# don't require a sequential scan
+INDEX_SQL = """
+CREATE INDEX msgs_message_text_trgm
+ON msgs_message USING gin (UPPER("text"::text) gin_trgm_ops)
+WHERE is_active = TRUE AND is_handled = TRUE;
+
+CREATE INDEX msgs_outgoing_text_trgm
+ON msgs_outgoing USING gin (UPPER("text"::text) gin_trgm_ops);
+
+CREATE INDEX msgs_faq_question_trgm
+ON msgs_faq USING gin (UPPER("question"::text) gin_trgm_ops);
+
+CREATE INDEX msgs_faq_answer_trgm
+ON msgs_faq USING gin (UPPER("answer"::text) gin_trgm_ops);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0058_statement_triggers'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunSQL(INDEX_SQL)
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# folder indexes include id so that searches ordered by (created_on, id) can be paged by cursor without sorting
+INDEX_SQL = """
+DROP INDEX msgs_inbox;
+CREATE INDEX msgs_inbox
+ON msgs_message(org_id, created_on DESC, id DESC)
+WHERE is_active = TRUE AND is_handled = TRUE AND is_archived = FALSE AND has_labels = TRUE;
+
+DROP INDEX msgs_unlabelled_inbox;
+CREATE INDEX msgs_unlabelled_inbox
+ON msgs_message(org_id, created_on DESC, id DESC)
+WHERE is_active = TRUE AND is_handled = TRUE AND is_archived = FALSE AND "type" = 'I' AND has_labels = FALSE;
+
+DROP INDEX msgs_flagged;
+CREATE INDEX msgs_flagged
+ON msgs_message(org_id, created_on DESC, id DESC)
+WHERE is_active = TRUE AND is_handled = TRUE AND is_archived = FALSE AND is_flagged = TRUE;
+
+DROP INDEX msgs_flagged_inc_archived;
+CREATE INDEX msgs_flagged_inc_archived
+ON msgs_message(org_id, created_on DESC, id DESC)
+WHERE is_active = TRUE AND is_handled = TRUE AND is_flagged = TRUE;
+
+DROP INDEX msgs_archived;
+CREATE INDEX msgs_archived
+ON msgs_message(org_id, created_on DESC, id DESC)
+WHERE is_active = TRUE AND is_handled = TRUE AND is_archived = TRUE;
+
+DROP INDEX msgs_outgoing_org_partner_created;
+CREATE INDEX msgs_outgoing_org_partner_created
+ON msgs_outgoing(org_id, partner_id, created_on DESC, id DESC);
+
+CREATE INDEX msgs_outgoing_org_created
+ON msgs_outgoing(org_id, created_on DESC, id DESC);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0059_text_search_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(INDEX_SQL)
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+from casepro.sql import InstallSQL
+
+# backfill with the change trigger disabled as it would only compute empty count deltas for every message
+BACKFILL_SQL = """
+ALTER TABLE msgs_message DISABLE TRIGGER msgs_message_on_change_trg;
+
+UPDATE msgs_message m SET label_ids = l.label_ids
+FROM (
+  SELECT message_id, ARRAY_AGG(label_id ORDER BY label_id) AS label_ids FROM msgs_message_labels GROUP BY message_id
+) l
+WHERE m.id = l.message_id;
+
+ALTER TABLE msgs_message ENABLE TRIGGER msgs_message_on_change_trg;
+"""
+
+INDEX_SQL = """
+CREATE INDEX msgs_message_label_ids
+ON msgs_message USING GIN (label_ids)
+WHERE is_active = TRUE AND is_handled = TRUE;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0060_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='label_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None),
+        ),
+        migrations.RunSQL(BACKFILL_SQL),
+        migrations.RunSQL(INDEX_SQL),
+        InstallSQL('msgs_0004')
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0061_message_label_ids'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messageexport',
+            name='items_done',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='messageexport',
+            name='num_items',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='messageexport',
+            name='shard_bounds',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), null=True, size=None),
+        ),
+        migrations.AddField(
+            model_name='messageexport',
+            name='shards_done',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None),
+        ),
+        migrations.AddField(
+            model_name='replyexport',
+            name='items_done',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='replyexport',
+            name='num_items',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='replyexport',
+            name='shard_bounds',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), null=True, size=None),
+        ),
+        migrations.AddField(
+            model_name='replyexport',
+            name='shards_done',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0062_export_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messageexport',
+            name='is_recurring',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='messageexport',
+            name='last_item_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='messageexport',
+            name='previous',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='msgs.MessageExport'),
+        ),
+        migrations.AddField(
+            model_name='replyexport',
+            name='is_recurring',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='replyexport',
+            name='last_item_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='replyexport',
+            name='previous',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='msgs.ReplyExport'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# case timeline indexes include id so that timeline pages ordered by (created_on, id) can be fetched by cursor
+INDEX_SQL = """
+CREATE INDEX msgs_message_case_created
+ON msgs_message(case_id, created_on DESC, id DESC)
+WHERE case_id IS NOT NULL;
+
+CREATE INDEX msgs_outgoing_case_created
+ON msgs_outgoing(case_id, created_on DESC, id DESC)
+WHERE case_id IS NOT NULL;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0063_export_recurring'),
+    ]
+
+    operations = [
+        migrations.RunSQL(INDEX_SQL)
+    ]
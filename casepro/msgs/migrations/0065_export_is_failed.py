@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0064_case_timeline_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messageexport',
+            name='is_failed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='replyexport',
+            name='is_failed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0065_export_is_failed'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='messageexport',
+            name='previous',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='msgs.MessageExport'),
+        ),
+        migrations.AlterField(
+            model_name='replyexport',
+            name='previous',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='msgs.ReplyExport'),
+        ),
+    ]
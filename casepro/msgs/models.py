@@ -2,27 +2,56 @@ from __future__ import unicode_literals
 
 import six
 
+from collections import Counter
 from dash.orgs.models import Org
 from dash.utils import get_obj_cacheable
 from django.contrib.auth.models import User
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.search import TrigramSimilarity
 from django.core.exceptions import PermissionDenied
-from django.db import models
+from django.db import connection, models, transaction
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
-from django.utils.timesince import timesince
 from django.utils.timezone import now
-from django.db.models import Q
+from django.db.models import ExpressionWrapper, F, Func, Q
+from django.db.models.expressions import RawSQL
 from enum import Enum
 from django_redis import get_redis_connection
+from temba_client.utils import format_iso8601
 from datetime import timedelta
 
 from casepro.backend import get_backend
 from casepro.contacts.models import Contact, Field
-from casepro.utils import json_encode, get_language_name
+from casepro.utils import json_encode, get_language_name, filter_before_cursor
 from casepro.utils.export import BaseSearchExport
+from casepro.utils.push import subscription, wait_for_publish
 
 LABEL_LOCK_KEY = 'lock:label:%d:%s'
 MESSAGE_LOCK_KEY = 'lock:message:%d:%d'
+MESSAGE_CHANGES_KEY = 'org:%d:message_changes'
+MESSAGE_CHANGES_SEQ_KEY = 'org:%d:message_changes_seq'
+MESSAGE_CHANGES_FLOOR_KEY = 'org:%d:message_changes_floor'
+MESSAGE_CHANGES_CHANNEL = 'org:%d:message_changes_channel'
+
+MESSAGE_CHANGES_MAX = 10000
+
+# appends changed message ids to an org's change feed under a single new sequence number, trimming the oldest changes
+# from the feed and recording the highest trimmed sequence number as the feed's floor, then publishes the new sequence
+# number to wake up waiting refresh polls
+RECORD_CHANGES_SCRIPT = """
+local seq = redis.call('INCR', KEYS[2])
+for i = 2, #ARGV do
+  redis.call('ZADD', KEYS[1], seq, ARGV[i])
+end
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[1])
+if excess > 0 then
+  local trimmed = redis.call('ZRANGE', KEYS[1], excess - 1, excess - 1, 'WITHSCORES')
+  redis.call('SET', KEYS[3], trimmed[2])
+  redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+end
+redis.call('PUBLISH', KEYS[4], seq)
+return seq
+"""
 MESSAGE_LOCK_SECONDS = 300
 
 
@@ -161,6 +190,18 @@ class Label(models.Model):
         if rule:
             rule.delete()
 
+    @classmethod
+    def as_json_by_id(cls, label_ids, active_only=False):
+        """
+        Gets the compact JSON of the given labels as a dict by id
+        """
+        labels = cls.objects.filter(pk__in=set(label_ids))
+        if active_only:
+            labels = labels.filter(is_active=True)
+
+        labels = labels.values_list('pk', 'name')
+        return {pk: {'id': pk, 'name': name} for pk, name in labels}
+
     def as_json(self, full=True):
         result = {'id': self.pk, 'name': self.name}
 
@@ -213,6 +254,7 @@ class FAQ(models.Model):
         language = search.get('language')
         label_id = search.get('label')
         text = search.get('text')
+        rank = search.get('rank')
 
         queryset = cls.objects.filter(org=org)
 
@@ -231,12 +273,17 @@ class FAQ(models.Model):
 
         queryset = queryset.filter(Q(labels__in=list(labels)) | Q(parent__labels__in=list(labels)))
 
-        # Text filtering
+        # Text filtering (substring matches are backed by trigram indexes)
         if text:
             queryset = queryset.filter(Q(question__icontains=text) | Q(answer__icontains=text))
 
         queryset = queryset.prefetch_related('labels', 'parent__labels')
 
+        if text and rank:
+            text_rank = TrigramSimilarity('question', text) + TrigramSimilarity('answer', text)
+            queryset = queryset.annotate(text_rank=text_rank)
+            return queryset.order_by('-text_rank', 'question')
+
         return queryset.order_by('question')
 
     @classmethod
@@ -298,6 +345,9 @@ class Message(models.Model):
 
     TIMELINE_TYPE = 'I'
 
+    JSON_FIELDS = ('id', 'backend_id', 'contact_id', 'text', 'created_on', 'label_ids', 'is_flagged', 'is_archived',
+                   'type', 'case_id', 'locked_on', 'locked_by_id')
+
     org = models.ForeignKey(Org, verbose_name=_("Organization"), related_name='incoming_messages')
 
     backend_id = models.IntegerField(unique=True, help_text=_("Backend identifier for this message"))
@@ -312,6 +362,8 @@ class Message(models.Model):
 
     has_labels = models.BooleanField(default=False)  # maintained via db triggers
 
+    label_ids = ArrayField(models.IntegerField(), default=list)  # maintained via db triggers
+
     is_flagged = models.BooleanField(default=False)
 
     is_archived = models.BooleanField(default=False)
@@ -346,6 +398,60 @@ class Message(models.Model):
     def lock(cls, org, backend_id):
         return get_redis_connection().lock(MESSAGE_LOCK_KEY % (org.pk, backend_id), timeout=60)
 
+    @classmethod
+    def record_changes(cls, org, messages):
+        """
+        Appends the given messages to the org's change feed which is read by refresh polls. This is deferred until the
+        current transaction commits so that a poll which sees the change can also read it.
+        """
+        message_ids = [m.pk for m in messages]
+        if message_ids:
+            keys = [MESSAGE_CHANGES_KEY % org.pk, MESSAGE_CHANGES_SEQ_KEY % org.pk, MESSAGE_CHANGES_FLOOR_KEY % org.pk,
+                    MESSAGE_CHANGES_CHANNEL % org.pk]
+
+            def record():
+                script = get_redis_connection().register_script(RECORD_CHANGES_SCRIPT)
+                script(keys=keys, args=[MESSAGE_CHANGES_MAX] + message_ids)
+
+            transaction.on_commit(record)
+
+    @classmethod
+    def get_last_change(cls, org):
+        """
+        Gets the sequence number of the last change in the org's change feed
+        """
+        return int(get_redis_connection().get(MESSAGE_CHANGES_SEQ_KEY % org.pk) or 0)
+
+    @classmethod
+    def get_changes(cls, org, since):
+        """
+        Gets the ids of messages changed since the given sequence number, and the sequence number of the last change.
+        Returns None if changes since that sequence number have been trimmed from the feed.
+        """
+        pipe = get_redis_connection().pipeline(transaction=True)
+        pipe.get(MESSAGE_CHANGES_FLOOR_KEY % org.pk)
+        pipe.get(MESSAGE_CHANGES_SEQ_KEY % org.pk)
+        pipe.zrangebyscore(MESSAGE_CHANGES_KEY % org.pk, '(%d' % since, '+inf')
+        floor, last_change, message_ids = pipe.execute()
+
+        if since < int(floor or 0):
+            return None
+
+        return [int(i) for i in message_ids], int(last_change or 0)
+
+    @classmethod
+    def wait_for_changes(cls, org, since, timeout):
+        """
+        Like get_changes but if there are no changes yet, waits up to the given number of seconds for some
+        """
+        with subscription(MESSAGE_CHANGES_CHANNEL % org.pk) as pubsub:
+            changes = cls.get_changes(org, since)
+
+            if changes is not None and not changes[0] and wait_for_publish(pubsub, timeout):
+                changes = cls.get_changes(org, since)
+
+        return changes
+
     @classmethod
     def search(cls, org, user, search):
         """
@@ -355,11 +461,15 @@ class Message(models.Model):
         label_id = search.get('label')
         include_archived = search.get('include_archived')
         text = search.get('text')
+        rank = search.get('rank')
         contact_id = search.get('contact')
         group_ids = search.get('groups')
         after = search.get('after')
         before = search.get('before')
+        before_cursor = search.get('before_cursor')
         last_refresh = search.get('last_refresh')
+        changed_ids = search.get('changed_ids')
+        is_refresh = last_refresh or changed_ids is not None
 
         # only show non-deleted handled messages
         queryset = org.incoming_messages.filter(is_active=True, is_handled=True)
@@ -370,7 +480,7 @@ class Message(models.Model):
                 queryset = queryset.filter(has_labels=True)
                 if label_id:
                     label = Label.get_all(org, user).filter(pk=label_id).first()
-                    queryset = queryset.filter(labels=label)
+                    queryset = queryset.filter(label_ids__contains=[label.pk]) if label else queryset.none()
 
             elif folder == MessageFolder.unlabelled:
                 # only show inbox messages in unlabelled
@@ -380,11 +490,10 @@ class Message(models.Model):
 
             if label_id:
                 labels = labels.filter(pk=label_id)
-            else:
-                # if not filtering by a single label, need distinct to avoid duplicates
-                queryset = queryset.distinct()
 
-            queryset = queryset.filter(has_labels=True, labels__in=list(labels))
+            # label ids are denormalized onto each message so this doesn't need a join and distinct
+            label_ids = list(labels.values_list('pk', flat=True))
+            queryset = queryset.filter(has_labels=True, label_ids__overlap=label_ids)
 
             if folder == MessageFolder.unlabelled:
                 raise ValueError("Unlabelled folder is only accessible to administrators")
@@ -392,6 +501,8 @@ class Message(models.Model):
         # if this is a refresh we want everything with new actions and locks
         if last_refresh:
             queryset = queryset.filter(modified_on__gt=last_refresh)
+        elif changed_ids is not None:
+            queryset = queryset.filter(pk__in=changed_ids)
         else:
             # only show flagged messages in flagged folder
             if folder == MessageFolder.flagged:
@@ -406,6 +517,7 @@ class Message(models.Model):
             else:
                 queryset = queryset.filter(is_archived=False)
 
+        # substring matches are backed by a trigram index
         if text:
             queryset = queryset.filter(text__icontains=text)
 
@@ -414,14 +526,21 @@ class Message(models.Model):
         if group_ids:
             queryset = queryset.filter(contact__groups__pk__in=group_ids).distinct()
 
-        if after and not last_refresh:
+        if after and not is_refresh:
             queryset = queryset.filter(created_on__gt=after)
         if before:
             queryset = queryset.filter(created_on__lt=before)
 
         queryset = queryset.prefetch_related('contact', 'labels', 'case__assignee', 'case__user_assignee')
 
-        return queryset.order_by('-created_on')
+        # ranked results are ordered by similarity so a time based cursor doesn't apply to them
+        if text and rank:
+            return queryset.annotate(text_rank=TrigramSimilarity('text', text)).order_by('-text_rank', '-created_on')
+
+        if before_cursor and not is_refresh:
+            queryset = filter_before_cursor(queryset, before_cursor, 'created_on')
+
+        return queryset.order_by('-created_on', '-pk')
 
     def get_history(self):
         """
@@ -431,10 +550,14 @@ class Message(models.Model):
         return self.actions.select_related('created_by', 'label').order_by('-pk')
 
     def get_lock(self, user):
-        if self.locked_on and self.locked_by_id:
-            if self.locked_on > (now() - timedelta(seconds=MESSAGE_LOCK_SECONDS)):
-                if self.locked_by_id != user.id:
-                    diff = (self.locked_on + timedelta(seconds=MESSAGE_LOCK_SECONDS)) - now()
+        return self._get_lock(self.locked_on, self.locked_by_id, user)
+
+    @staticmethod
+    def _get_lock(locked_on, locked_by_id, user):
+        if locked_on and locked_by_id:
+            if locked_on > (now() - timedelta(seconds=MESSAGE_LOCK_SECONDS)):
+                if locked_by_id != user.id:
+                    diff = (locked_on + timedelta(seconds=MESSAGE_LOCK_SECONDS)) - now()
                     return diff.seconds
 
         return False
@@ -449,6 +572,8 @@ class Message(models.Model):
         self.modified_on = now()
         self.save(update_fields=('is_active', 'modified_on'))
 
+        Message.record_changes(self.org, [self])
+
     def label(self, *labels):
         """
         Adds the given labels to this message
@@ -467,6 +592,50 @@ class Message(models.Model):
         """
         self.labels.remove(*labels)
 
+    @classmethod
+    def apply_label(cls, org, messages, label):
+        """
+        Adds the given label to the given messages with a single insert. Label statistics are recorded as one count per
+        day rather than one per message.
+        """
+        from casepro.profiles.models import Notification
+        from casepro.statistics.models import DailyCount, datetime_to_date
+
+        through = cls.labels.through
+        labelled = through.objects.filter(label=label, message_id__in=[m.pk for m in messages])
+        labelled_ids = set(labelled.values_list('message_id', flat=True))
+        new_messages = [m for m in messages if m.pk not in labelled_ids]
+
+        if new_messages:
+            through.objects.bulk_create([through(message_id=m.pk, label_id=label.pk) for m in new_messages])
+
+            counts = Counter((datetime_to_date(m.created_on, org), (label,)) for m in new_messages)
+            DailyCount.record_items(DailyCount.TYPE_INCOMING, counts)
+
+            # notify all users who watch this label
+            for watcher in label.watchers.all():
+                for msg in new_messages:
+                    Notification.new_message_labelling(org, watcher, msg)
+
+    @classmethod
+    def remove_label(cls, org, messages, label):
+        """
+        Removes the given label from the given messages with a single delete. Label statistics are recorded as one count
+        per day rather than one per message.
+        """
+        from casepro.statistics.models import DailyCount, datetime_to_date
+
+        through = cls.labels.through
+        labelled = through.objects.filter(label=label, message_id__in=[m.pk for m in messages])
+        labelled_ids = set(labelled.values_list('message_id', flat=True))
+        old_messages = [m for m in messages if m.pk in labelled_ids]
+
+        if old_messages:
+            through.objects.filter(label=label, message_id__in=labelled_ids).delete()
+
+            counts = Counter((datetime_to_date(m.created_on, org), (label,)) for m in old_messages)
+            DailyCount.record_items(DailyCount.TYPE_INCOMING, {k: -v for k, v in six.iteritems(counts)})
+
     def update_labels(self, user, labels):
         """
         Updates this message's labels to match the given set, creating label and unlabel actions as necessary
@@ -482,6 +651,53 @@ class Message(models.Model):
             for label in rem_labels:
                 self.bulk_unlabel(self.org, user, [self], label)
 
+    @staticmethod
+    def bulk_lock(org, user, messages):
+        """
+        Locks the given messages for the given user unless any are locked by another user, in a single statement which
+        is atomic against concurrent lockers. Returns the ids of the messages locked by other users.
+        """
+        messages = list(messages)
+        if not messages:
+            return []
+
+        dt_now = now()
+
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                WITH targets AS (
+                  SELECT id, (locked_by_id IS NOT NULL AND locked_by_id <> %(user_id)s AND locked_on > %(expired_on)s)
+                    AS is_conflict
+                  FROM msgs_message WHERE org_id = %(org_id)s AND id = ANY(%(ids)s) FOR UPDATE
+                ),
+                locked AS (
+                  UPDATE msgs_message m SET locked_on = %(now)s, locked_by_id = %(user_id)s, modified_on = %(now)s
+                  FROM targets t WHERE m.id = t.id AND NOT EXISTS (SELECT 1 FROM targets WHERE is_conflict)
+                )
+                SELECT id FROM targets WHERE is_conflict""", {
+                'org_id': org.pk,
+                'user_id': user.pk,
+                'ids': [m.pk for m in messages],
+                'now': dt_now,
+                'expired_on': dt_now - timedelta(seconds=MESSAGE_LOCK_SECONDS)
+            })
+            conflicting_ids = [r[0] for r in cursor.fetchall()]
+
+        if not conflicting_ids:
+            Message.record_changes(org, messages)
+
+        return conflicting_ids
+
+    @staticmethod
+    def bulk_unlock(org, messages):
+        messages = list(messages)
+        if messages:
+            dt_now = now()
+            org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(locked_on=dt_now,
+                                                                                          locked_by=None,
+                                                                                          modified_on=dt_now)
+            Message.record_changes(org, messages)
+
     @staticmethod
     def bulk_flag(org, user, messages):
         messages = list(messages)
@@ -491,6 +707,8 @@ class Message(models.Model):
 
             get_backend().flag_messages(org, messages)
 
+            Message.record_changes(org, messages)
+
             MessageAction.create(org, user, messages, MessageAction.FLAG)
 
     @staticmethod
@@ -502,34 +720,38 @@ class Message(models.Model):
 
             get_backend().unflag_messages(org, messages)
 
+            Message.record_changes(org, messages)
+
             MessageAction.create(org, user, messages, MessageAction.UNFLAG)
 
     @staticmethod
     def bulk_label(org, user, messages, label):
         messages = list(messages)
         if messages:
-            for msg in messages:
-                msg.label(label)
+            Message.apply_label(org, messages, label)
 
             org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(modified_on=now())
 
             if label.is_synced:
                 get_backend().label_messages(org, messages, label)
 
+            Message.record_changes(org, messages)
+
             MessageAction.create(org, user, messages, MessageAction.LABEL, label)
 
     @staticmethod
     def bulk_unlabel(org, user, messages, label):
         messages = list(messages)
         if messages:
-            for msg in messages:
-                msg.unlabel(label)
+            Message.remove_label(org, messages, label)
 
             org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(modified_on=now())
 
             if label.is_synced:
                 get_backend().unlabel_messages(org, messages, label)
 
+            Message.record_changes(org, messages)
+
             MessageAction.create(org, user, messages, MessageAction.UNLABEL, label)
 
     @staticmethod
@@ -541,6 +763,8 @@ class Message(models.Model):
 
             get_backend().archive_messages(org, messages)
 
+            Message.record_changes(org, messages)
+
             MessageAction.create(org, user, messages, MessageAction.ARCHIVE)
 
     @staticmethod
@@ -552,6 +776,8 @@ class Message(models.Model):
 
             get_backend().restore_messages(org, messages)
 
+            Message.record_changes(org, messages)
+
             MessageAction.create(org, user, messages, MessageAction.RESTORE)
 
     def as_json(self):
@@ -570,6 +796,30 @@ class Message(models.Model):
             'case': self.case.as_json(full=False) if self.case else None
         }
 
+    @classmethod
+    def as_json_rows(cls, rows, user):
+        """
+        Prepares a page of messages fetched as values of JSON_FIELDS for JSON serialization, including their lock
+        state for the given user. This avoids loading model instances, and nested objects are fetched in one query per
+        type and shared between rows.
+        """
+        contacts = Contact.as_json_by_id([r['contact_id'] for r in rows])
+        labels = Label.as_json_by_id([l for r in rows for l in r['label_ids']])
+        cases = cls._meta.get_field('case').related_model.as_json_by_id([r['case_id'] for r in rows if r['case_id']])
+
+        return [{
+            'id': r['backend_id'],
+            'contact': contacts[r['contact_id']],
+            'text': r['text'],
+            'time': format_iso8601(r['created_on']),
+            'labels': [labels[l] for l in r['label_ids'] if l in labels],
+            'flagged': r['is_flagged'],
+            'archived': r['is_archived'],
+            'flow': r['type'] == cls.TYPE_FLOW,
+            'case': cases.get(r['case_id']),
+            'lock': cls._get_lock(r['locked_on'], r['locked_by_id'], user)
+        } for r in rows]
+
     def __str__(self):
         return self.text if self.text else self.pk
 
@@ -637,6 +887,8 @@ class Outgoing(models.Model):
 
     TIMELINE_TYPE = 'O'
 
+    JSON_FIELDS = ('id', 'contact_id', 'urn', 'text', 'created_on', 'case_id', 'created_by_id')
+
     org = models.ForeignKey(Org, verbose_name=_("Organization"), related_name='outgoing_messages')
 
     partner = models.ForeignKey('cases.Partner', null=True, related_name='outgoing_messages')
@@ -708,6 +960,9 @@ class Outgoing(models.Model):
         if push:
             get_backend().push_outgoing(org, [msg])
 
+        if case:
+            case.record_timeline_change()
+
         return msg
 
     @classmethod
@@ -718,6 +973,8 @@ class Outgoing(models.Model):
     def search(cls, org, user, search):
         text = search.get('text')
         contact_id = search.get('contact')
+        rank = search.get('rank')
+        before_cursor = search.get('before_cursor')
 
         queryset = org.outgoing_messages.all()
 
@@ -733,13 +990,21 @@ class Outgoing(models.Model):
 
         queryset = queryset.prefetch_related('partner', 'contact', 'case__assignee', 'created_by__profile')
 
-        return queryset.order_by('-created_on')
+        # ranked results are ordered by similarity so a time based cursor doesn't apply to them
+        if text and rank:
+            return queryset.annotate(text_rank=TrigramSimilarity('text', text)).order_by('-text_rank', '-created_on')
+
+        if before_cursor:
+            queryset = filter_before_cursor(queryset, before_cursor, 'created_on')
+
+        return queryset.order_by('-created_on', '-pk')
 
     @classmethod
     def search_replies(cls, org, user, search):
         partner_id = search.get('partner')
         after = search.get('after')
         before = search.get('before')
+        before_cursor = search.get('before_cursor')
 
         queryset = cls.get_replies(org)
 
@@ -755,10 +1020,13 @@ class Outgoing(models.Model):
         if before:
             queryset = queryset.filter(created_on__lte=before)
 
+        if before_cursor:
+            queryset = filter_before_cursor(queryset, before_cursor, 'created_on')
+
         queryset = queryset.select_related('contact', 'case__assignee', 'created_by__profile')
         queryset = queryset.prefetch_related('reply_to__labels')
 
-        return queryset.order_by('-created_on')
+        return queryset.order_by('-created_on', '-pk')
 
     def is_reply(self):
         return self.activity in self.REPLY_ACTIVITIES
@@ -787,6 +1055,27 @@ class Outgoing(models.Model):
             'sender': self.get_sender().as_json(full=False) if self.get_sender() else None
         }
 
+    @classmethod
+    def as_json_rows(cls, rows):
+        """
+        Prepares a page of outgoing messages fetched as values of JSON_FIELDS for JSON serialization
+        """
+        from casepro.profiles.models import users_as_json_by_id
+
+        contacts = Contact.as_json_by_id([r['contact_id'] for r in rows if r['contact_id']])
+        cases = cls._meta.get_field('case').related_model.as_json_by_id([r['case_id'] for r in rows if r['case_id']])
+        senders = users_as_json_by_id([r['created_by_id'] for r in rows if r['created_by_id']])
+
+        return [{
+            'id': r['id'],
+            'contact': contacts.get(r['contact_id']),
+            'urn': r['urn'],
+            'text': r['text'],
+            'time': format_iso8601(r['created_on']),
+            'case': cases.get(r['case_id']),
+            'sender': senders.get(r['created_by_id'])
+        } for r in rows]
+
     def __str__(self):
         return self.text
 
@@ -803,45 +1092,36 @@ class MessageExport(BaseSearchExport):
         search['folder'] = MessageFolder[search['folder']]
         return search
 
-    def render_search(self, book, search):
+    def get_items(self, search):
+        items = Message.search(self.org, self.created_by, search).prefetch_related(None)
+        return items.select_related('contact').prefetch_related('labels')
+
+    def iter_rows(self, search):
         from casepro.contacts.models import Field
 
         base_fields = ["Time", "Message ID", "Flagged", "Labels", "Text", "Contact"]
-        contact_fields = Field.get_all(self.org, visible=True)
+        contact_fields = list(Field.get_all(self.org, visible=True))
+        field_keys = [f.key for f in contact_fields]
         all_fields = base_fields + [f.label for f in contact_fields]
 
-        # load all messages to be exported
-        items = Message.search(self.org, self.created_by, search)
-
-        def add_sheet(num):
-            sheet = book.add_sheet(six.text_type(_("Messages %d" % num)))
-            self.write_row(sheet, 0, all_fields)
-            return sheet
+        yield all_fields
 
-        sheet = None
-        sheet_number = 0
-        row = 1
-        for item in items:
-            if not sheet or row > self.MAX_SHEET_ROWS:
-                sheet_number += 1
-                sheet = add_sheet(sheet_number)
-                row = 1
+        # messages to be exported are fetched in chunks
+        for chunk in self.iter_chunks(self.get_items(search)):
+            for item in chunk:
+                values = [
+                    item.created_on,
+                    item.backend_id,
+                    item.is_flagged,
+                    ', '.join([l.name for l in item.labels.all()]),
+                    item.text,
+                    item.contact.uuid
+                ]
 
-            values = [
-                item.created_on,
-                item.backend_id,
-                item.is_flagged,
-                ', '.join([l.name for l in item.labels.all()]),
-                item.text,
-                item.contact.uuid
-            ]
+                fields = item.contact.get_fields()
+                values += [fields.get(key, "") for key in field_keys]
 
-            fields = item.contact.get_fields()
-            for field in contact_fields:
-                values.append(fields.get(field.key, ""))
-
-            self.write_row(sheet, row, values)
-            row += 1
+                yield values
 
 
 class ReplyExport(BaseSearchExport):
@@ -851,45 +1131,47 @@ class ReplyExport(BaseSearchExport):
     directory = 'reply_exports'
     download_view = 'msgs.replyexport_read'
 
-    def render_search(self, book, search):
+    def get_items(self, search):
+        return Outgoing.search_replies(self.org, self.created_by, search).select_related('reply_to')
+
+    def iter_rows(self, search):
         base_fields = [
-            "Sent On", "User", "Message", "Delay", "Reply to", "Flagged", "Case Assignee", "Labels", "Contact"
+            "Sent On", "User", "Message", "Delay (Seconds)", "Reply to", "Flagged", "Case Assignee", "Labels", "Contact"
         ]
-        contact_fields = Field.get_all(self.org, visible=True)
+        contact_fields = list(Field.get_all(self.org, visible=True))
+        field_keys = [f.key for f in contact_fields]
         all_fields = base_fields + [f.label for f in contact_fields]
 
-        # load all messages to be exported
-        items = Outgoing.search_replies(self.org, self.created_by, search)
-
-        def add_sheet(num):
-            sheet = book.add_sheet(six.text_type(_("Replies %d" % num)))
-            self.write_row(sheet, 0, all_fields)
-            return sheet
-
-        sheet = None
-        sheet_number = 0
-        row = 1
-        for item in items:
-            if not sheet or row > self.MAX_SHEET_ROWS:
-                sheet_number += 1
-                sheet = add_sheet(sheet_number)
-                row = 1
-
-            values = [
-                item.created_on,
-                item.created_by.email,
-                item.text,
-                timesince(item.reply_to.created_on, now=item.created_on),
-                item.reply_to.text,
-                item.reply_to.is_flagged,
-                item.case.assignee.name if item.case else "",
-                ', '.join([l.name for l in item.reply_to.labels.all()]),
-                item.contact.uuid
-            ]
-
-            fields = item.contact.get_fields()
-            for field in contact_fields:
-                values.append(fields.get(field.key, ""))
-
-            self.write_row(sheet, row, values)
-            row += 1
+        yield all_fields
+
+        # reply delays and labels are calculated by the database rather than for each row here. Labels come from a
+        # correlated subquery rather than an aggregate so that the export query isn't grouped.
+        delay = ExpressionWrapper(F('created_on') - F('reply_to__created_on'), output_field=models.DurationField())
+        reply_to_labels = RawSQL(
+            'SELECT string_agg(l.name, \', \' ORDER BY l.name) FROM msgs_message_labels ml '
+            'INNER JOIN msgs_label l ON l.id = ml.label_id WHERE ml.message_id = msgs_outgoing.reply_to_id', ()
+        )
+        items = self.get_items(search).prefetch_related(None).annotate(
+            delay_secs=Func(delay, template='EXTRACT(EPOCH FROM %(expressions)s)', output_field=models.FloatField()),
+            reply_to_labels=reply_to_labels
+        )
+
+        # replies to be exported are fetched in chunks
+        for chunk in self.iter_chunks(items):
+            for item in chunk:
+                values = [
+                    item.created_on,
+                    item.created_by.email,
+                    item.text,
+                    int(item.delay_secs),
+                    item.reply_to.text,
+                    item.reply_to.is_flagged,
+                    item.case.assignee.name if item.case else "",
+                    item.reply_to_labels,
+                    item.contact.uuid
+                ]
+
+                fields = item.contact.get_fields()
+                values += [fields.get(key, "") for key in field_keys]
+
+                yield values
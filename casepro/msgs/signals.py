@@ -6,6 +6,7 @@ from django.db.models.signals import pre_save, post_save
 from django.dispatch import receiver
 
 from casepro.backend import get_backend
+from casepro.utils import bump_org_version
 
 from .models import Label, Message
 
@@ -16,6 +17,11 @@ def update_label_uuid(sender, instance, **kwargs):
         get_backend().push_label(instance.org, instance)
 
 
+@receiver(post_save, sender=Label)
+def update_labels_version(sender, instance, **kwargs):
+    bump_org_version(instance.org_id, 'labels')
+
+
 @receiver(pre_save, sender=Message)
 def update_message_contact(sender, instance, **kwargs):
     from casepro.contacts.models import Contact
@@ -81,25 +81,54 @@ def handle_messages(org):
         # mark all of these messages as handled
         Message.objects.filter(pk__in=[m.pk for m in unhandled]).update(is_handled=True)
 
+        Message.record_changes(org, unhandled)
+
     return {'handled': len(unhandled), 'rules_matched': num_rules_matched, 'case_replies': len(case_replies)}
 
 
-@shared_task
-def message_export(export_id):
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def message_export(task, export_id, shard=None):
     from .models import MessageExport
 
-    logger.info("Starting message export #%d..." % export_id)
+    export = MessageExport.objects.get(pk=export_id)
 
-    MessageExport.objects.get(pk=export_id).do_export()
+    if shard is None:
+        logger.info("Starting message export #%d..." % export_id)
 
+        export.start(task)
+    else:
+        logger.info("Starting shard %d of message export #%d..." % (shard, export_id))
 
-@shared_task
-def reply_export(export_id):
+        export.do_shard(task, shard)
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def reply_export(task, export_id, shard=None):
     from .models import ReplyExport
 
-    logger.info("Starting replies export #%d..." % export_id)
+    export = ReplyExport.objects.get(pk=export_id)
+
+    if shard is None:
+        logger.info("Starting replies export #%d..." % export_id)
+
+        export.start(task)
+    else:
+        logger.info("Starting shard %d of replies export #%d..." % (shard, export_id))
+
+        export.do_shard(task, shard)
+
+
+@shared_task
+def rerun_message_exports():
+    """
+    Task to start the next runs of recurring message exports
+    """
+    from .models import MessageExport
 
-    ReplyExport.objects.get(pk=export_id).do_export()
+    for export in MessageExport.get_recurring():
+        next_run = export.rerun()
+        if next_run:
+            message_export.delay(next_run.pk)
 
 
 def get_labels(task, org, labelstring):
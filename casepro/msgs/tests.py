@@ -1,21 +1,27 @@
 # coding=utf-8
 from __future__ import unicode_literals
 
+import codecs
+import gzip
+import io
 import pytz
 import six
 
+from celery.exceptions import Retry
 from dash.orgs.models import TaskState
-from datetime import datetime
+from datetime import datetime, timedelta
 from django.core.urlresolvers import reverse
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test.utils import override_settings
 from django.utils.timezone import now
 
-from mock import patch, call
+from mock import patch, call, MagicMock
 from temba_client.utils import format_iso8601
 
 from casepro.contacts.models import Contact
 from casepro.rules.models import ContainsTest, GroupsTest, FieldTest, WordCountTest, Quantifier
+from casepro.statistics.models import TotalCount
 from casepro.statistics.tasks import squash_counts
 from casepro.test import BaseCasesTest
 from casepro.msgs.views import ImportTask
@@ -24,7 +30,7 @@ from casepro.msgs.views import ImportTask
 from .models import (Label, FAQ, Message, MessageAction, MessageExport, MessageFolder, Outgoing,
                      OutgoingFolder, ReplyExport)
 
-from .tasks import handle_messages, pull_messages, faq_csv_import
+from .tasks import handle_messages, pull_messages, faq_csv_import, rerun_message_exports
 
 faq_good_import = b"""Parent ID,Parent Language,Parent Question,Parent Answer,Labels,afr ID,afr Question,afr Answer,bla ID,bla Question,bla Answer
 ,eng,Can I drink tea while pregnant?,"Yes, but avoid too much caffeine","Tea, Pregnancy",,Kan ek tee drink tydens swangerskap?,"Ja, maar beperk jou kaffein inname",,Xtea Xpregnant?,Xyes
@@ -331,6 +337,16 @@ class FaqTest(BaseCasesTest):
         self.tea_faq1_eng.language = None
         self.assertIsNone(self.tea_faq1_eng.get_language())
 
+    def test_search(self):
+        def assert_search(params, results):
+            self.assertEqual(list(FAQ.search(self.unicef, self.admin, params)), results)
+
+        # by text, ordered by question
+        assert_search({'text': "pregnant"}, [self.preg_faq1_bnt, self.preg_faq1_eng, self.preg_faq1_lug])
+
+        # by text with ranking, closest matches first
+        assert_search({'text': "pregnant", 'rank': True}, [self.preg_faq1_eng, self.preg_faq1_bnt, self.preg_faq1_lug])
+
 
 class FaqCRUDLTest(BaseCasesTest):
     def test_create(self):
@@ -759,6 +775,27 @@ class MessageTest(BaseCasesTest):
         self.msg4 = self.create_message(self.unicef, 104, self.ann, "Flagged", is_flagged=True)
         self.msg5 = self.create_message(self.unicef, 105, self.ann, "Inactive", is_active=False)
 
+    def test_triggers_for_bulk_labelling(self):
+        msgs = [self.create_message(self.unicef, 101 + m, self.ann, "Hello", is_handled=True) for m in range(3)]
+
+        Message.apply_label(self.unicef, msgs, self.aids)
+
+        # counts are aggregated per statement rather than per message
+        self.assertEqual(TotalCount.objects.filter(item_type='N', scope='label:%d' % self.aids.pk).count(), 1)
+        self.assertEqual(self.aids.get_inbox_count(recalculate=True), 3)
+        self.assertEqual(Message.objects.filter(has_labels=True).count(), 3)
+
+        Message.objects.filter(pk__in=[msgs[0].pk, msgs[1].pk]).update(is_archived=True)
+
+        self.assertEqual(self.aids.get_inbox_count(recalculate=True), 1)
+        self.assertEqual(self.aids.get_archived_count(recalculate=True), 2)
+
+        Message.remove_label(self.unicef, msgs[1:], self.aids)
+
+        self.assertEqual(self.aids.get_inbox_count(recalculate=True), 0)
+        self.assertEqual(self.aids.get_archived_count(recalculate=True), 1)
+        self.assertEqual(set(Message.objects.filter(has_labels=True)), {msgs[0]})
+
     def test_triggers(self):
         def get_label_counts():
             return {
@@ -785,6 +822,7 @@ class MessageTest(BaseCasesTest):
         msg1.refresh_from_db()
 
         self.assertTrue(msg1.has_labels)
+        self.assertEqual(msg1.label_ids, sorted([self.aids.pk, self.tea.pk]))
         self.assertEqual(get_label_counts(), {'aids.inbox': 2, 'aids.archived': 0, 'tea.inbox': 1, 'tea.archived': 0})
 
         msg1.is_archived = True
@@ -803,6 +841,7 @@ class MessageTest(BaseCasesTest):
         msg1.refresh_from_db()
 
         self.assertFalse(msg1.has_labels)
+        self.assertEqual(msg1.label_ids, [])
         self.assertEqual(get_label_counts(), {'aids.inbox': 1, 'aids.archived': 0, 'tea.inbox': 0, 'tea.archived': 0})
 
         msg1.label(self.aids, self.tea)
@@ -858,7 +897,7 @@ class MessageTest(BaseCasesTest):
             message.save()
 
         # check removing a label and adding new ones
-        with self.assertNumQueries(11):
+        with self.assertNumQueries(10):
             setattr(message, '__data__labels', [("L-002", "Feedback"), ("L-003", "Important")])
             message.save()
 
@@ -893,6 +932,39 @@ class MessageTest(BaseCasesTest):
         self.assertEqual(msg.is_active, False)
         self.assertEqual(msg.labels.count(), 0)
 
+    @patch('casepro.msgs.models.MESSAGE_CHANGES_MAX', 2)
+    def test_changes(self):
+        msg1 = self.create_message(self.unicef, 101, self.ann, "Hi 1")
+        msg2 = self.create_message(self.unicef, 102, self.ann, "Hi 2")
+        msg3 = self.create_message(self.unicef, 103, self.ann, "Hi 3")
+
+        seq = Message.get_last_change(self.unicef)
+
+        Message.record_changes(self.unicef, [msg1, msg2])
+        Message.record_changes(self.unicef, [msg2])
+        Message.record_changes(self.unicef, [])
+
+        self.assertEqual(Message.get_last_change(self.unicef), seq + 2)
+        self.assertEqual(Message.get_changes(self.unicef, seq), ([msg1.pk, msg2.pk], seq + 2))
+        self.assertEqual(Message.get_changes(self.unicef, seq + 1), ([msg2.pk], seq + 2))
+        self.assertEqual(Message.get_changes(self.unicef, seq + 2), ([], seq + 2))
+
+        # feed is trimmed to the most recent changes so older positions are no longer valid
+        Message.record_changes(self.unicef, [msg3])
+
+        self.assertIsNone(Message.get_changes(self.unicef, seq))
+        self.assertEqual(Message.get_changes(self.unicef, seq + 1), ([msg2.pk, msg3.pk], seq + 3))
+
+        # changes aren't visible until the current transaction commits
+        with patch('django.db.transaction.on_commit') as mock_on_commit:
+            Message.record_changes(self.unicef, [msg1])
+
+        self.assertEqual(Message.get_last_change(self.unicef), seq + 3)
+
+        mock_on_commit.call_args[0][0]()
+
+        self.assertEqual(Message.get_last_change(self.unicef), seq + 4)
+
     def test_search(self):
         bob = self.create_contact(self.nyaruka, 'C-002', "Bob", [self.reporters])
         eric = self.create_contact(self.nyaruka, 'C-101', "Eric")
@@ -993,6 +1065,12 @@ class MessageTest(BaseCasesTest):
         # by text
         assert_search(self.admin, {'folder': MessageFolder.inbox, 'text': "LO 5"}, [msg5])
 
+        # by text with ranking, closest matches first
+        msg12 = self.create_message(self.unicef, 112, self.ann, "Hello 5 and goodbye to all of you", [self.aids],
+                                    is_handled=True)
+        assert_search(self.admin, {'folder': MessageFolder.inbox, 'text': "hello 5", 'rank': True}, [msg5, msg12])
+        assert_search(self.admin, {'folder': MessageFolder.inbox, 'text': "hello 5"}, [msg12, msg5])
+
     @patch('casepro.test.TestBackend.label_messages')
     @patch('casepro.test.TestBackend.unlabel_messages')
     def test_update_labels(self, mock_unlabel_messages, mock_label_messages):
@@ -1141,6 +1219,45 @@ class MessageTest(BaseCasesTest):
             'case': None
         })
 
+    def test_as_json_rows(self):
+        msg1 = self.create_message(self.unicef, 101, self.ann, "Hello", [self.aids, self.pregnancy])
+        msg2 = self.create_message(self.unicef, 102, self.ann, "Hi", [self.aids])
+        msg2.locked_on = now()
+        msg2.locked_by = self.user2
+        msg2.save(update_fields=('locked_on', 'locked_by'))
+
+        rows = list(Message.objects.filter(pk__in=[msg1.pk, msg2.pk]).order_by('pk').values(*Message.JSON_FIELDS))
+
+        with self.assertNumQueries(2):
+            results = Message.as_json_rows(rows, self.user1)
+
+        self.assertGreater(results[1].pop('lock'), 0)  # locked by another user
+        self.assertEqual(results, [
+            {
+                'id': 101,
+                'contact': {'id': self.ann.pk, 'display': "Ann"},
+                'text': "Hello",
+                'time': format_iso8601(msg1.created_on),
+                'labels': [{'id': self.aids.pk, 'name': "AIDS"}, {'id': self.pregnancy.pk, 'name': "Pregnancy"}],
+                'flagged': False,
+                'archived': False,
+                'flow': False,
+                'case': None,
+                'lock': False
+            },
+            {
+                'id': 102,
+                'contact': {'id': self.ann.pk, 'display': "Ann"},
+                'text': "Hi",
+                'time': format_iso8601(msg2.created_on),
+                'labels': [{'id': self.aids.pk, 'name': "AIDS"}],
+                'flagged': False,
+                'archived': False,
+                'flow': False,
+                'case': None
+            }
+        ])
+
 
 class MessageCRUDLTest(BaseCasesTest):
     def setUp(self):
@@ -1211,6 +1328,8 @@ class MessageCRUDLTest(BaseCasesTest):
             'user_assignee': {'id': self.user1.pk, 'name': "Evan"}})
         self.assertEqual(response.json['results'][1]['id'], 104)
 
+        last_change = response.json['last_change']
+
         t1 = now()
         self.create_message(self.unicef, 210, self.ann, "Is this thing on?", [self.aids], is_handled=True)
         Message.bulk_flag(self.unicef, self.user1, [msg5])
@@ -1228,6 +1347,39 @@ class MessageCRUDLTest(BaseCasesTest):
         self.assertEqual(response.json['results'][1]['id'], 105)
         self.assertEqual(response.json['results'][1]['flagged'], True)
 
+        # test the refresh from the change feed, which returns messages changed since the given position
+        response = self.url_get('unicef', url, {
+            'folder': 'inbox', 'text': "", 'last_change': last_change, 'last_refresh': format_iso8601(t1),
+            'before': format_iso8601(t1), 'wait': 1
+        })
+
+        self.assertEqual([m['id'] for m in response.json['results']], [105])
+        self.assertEqual(response.json['results'][0]['flagged'], True)
+        self.assertEqual(response.json['last_change'], last_change + 1)
+
+        response = self.url_get('unicef', url, {
+            'folder': 'inbox', 'text': "", 'last_change': response.json['last_change']
+        })
+
+        self.assertEqual(response.json['results'], [])
+        self.assertEqual(response.json['last_change'], last_change + 1)
+
+        # long-polls wait for changes if there aren't any yet
+        with self.settings(SITE_PUSH_TIMEOUT=0.1):
+            response = self.url_get('unicef', url, {
+                'folder': 'inbox', 'text': "", 'last_change': response.json['last_change'], 'wait': 1
+            })
+
+            self.assertEqual(response.json['results'], [])
+            self.assertEqual(response.json['last_change'], last_change + 1)
+
+        # ranked searches can't be paged by cursor so only return the best matches
+        response = self.url_get('unicef', url, {'folder': 'inbox', 'text': "rapid", 'rank': 1, 'before_cursor': ''})
+
+        self.assertEqual([m['id'] for m in response.json['results']], [102])
+        self.assertFalse(response.json['has_more'])
+        self.assertIsNone(response.json['next_cursor'])
+
     def test_get_lock(self):
         msg = self.create_message(self.unicef, 101, self.ann, "Normal", [self.aids, self.pregnancy])
 
@@ -1262,6 +1414,9 @@ class MessageCRUDLTest(BaseCasesTest):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json['messages'], [])
 
+        msg.refresh_from_db()
+        self.assertEqual(msg.locked_by, self.user2)
+
         # Can't lock becuase it is locked by another user
         msg.locked_by = self.user1
         msg.locked_on = now()
@@ -1272,6 +1427,24 @@ class MessageCRUDLTest(BaseCasesTest):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json['messages'], [101])
 
+        # and none of a batch are locked if any are locked by another user
+        msg2 = self.create_message(self.unicef, 102, self.ann, "Normal 2", [self.aids])
+
+        response = self.url_post_json('unicef', get_url('lock'), {'messages': [101, 102]})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['messages'], [101])
+
+        msg2.refresh_from_db()
+        self.assertIsNone(msg2.locked_by)
+
+        # expired locks don't count
+        Message.objects.filter(pk=msg.pk).update(locked_on=now() - timedelta(minutes=10))
+
+        response = self.url_post_json('unicef', get_url('lock'), {'messages': [101, 102]})
+        self.assertEqual(response.json['messages'], [])
+        self.assertEqual(set(Message.objects.filter(locked_by=self.user2)), {msg, msg2})
+
         msg.locked_by = self.admin
         msg.locked_on = now()
         msg.save()
@@ -1280,6 +1453,9 @@ class MessageCRUDLTest(BaseCasesTest):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json['messages'], [])
 
+        msg.refresh_from_db()
+        self.assertIsNone(msg.locked_by)
+
     @patch('casepro.test.TestBackend.flag_messages')
     @patch('casepro.test.TestBackend.unflag_messages')
     @patch('casepro.test.TestBackend.archive_messages')
@@ -1432,7 +1608,8 @@ class MessageCRUDLTest(BaseCasesTest):
 
 
 class MessageExportCRUDLTest(BaseCasesTest):
-    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory',
+                       EXPORT_STREAM_THRESHOLD=0)
     def test_create_and_read(self):
         ann = self.create_contact(self.unicef, "C-001", "Ann", fields={'nickname': "Annie", 'age': "28", 'state': "WA"})
         bob = self.create_contact(self.unicef, "C-002", "Bob", fields={'nickname': "Bobby", 'age': "32", 'state': "IN"})
@@ -1459,13 +1636,14 @@ class MessageExportCRUDLTest(BaseCasesTest):
         self.assertEqual(export.partner, self.moh)
         self.assertEqual(export.created_by, self.user1)
 
-        workbook = self.openWorkbook(export.filename)
-        sheet = workbook.sheets()[0]
+        self.assertTrue(export.filename.endswith('.csv.gz'))
 
-        self.assertEqual(sheet.nrows, 3)
-        self.assertExcelRow(sheet, 0, ["Time", "Message ID", "Flagged", "Labels", "Text", "Contact", "Nickname", "Age"])
-        self.assertExcelRow(sheet, 1, [d2, 102, "Yes", "Pregnancy", "I ♡ RapidPro", "C-002", "Bobby", "32"], pytz.UTC)
-        self.assertExcelRow(sheet, 2, [d1, 101, "No", "AIDS", "What is HIV?", "C-001", "Annie", "28"], pytz.UTC)
+        rows = self.openCSV(export.filename)
+
+        self.assertEqual(len(rows), 3)
+        self.assertCSVRow(rows, 0, ["Time", "Message ID", "Flagged", "Labels", "Text", "Contact", "Nickname", "Age"])
+        self.assertCSVRow(rows, 1, [d2, 102, "Yes", "Pregnancy", "I ♡ RapidPro", "C-002", "Bobby", "32"])
+        self.assertCSVRow(rows, 2, [d1, 101, "No", "AIDS", "What is HIV?", "C-001", "Annie", "28"])
 
         read_url = reverse('msgs.messageexport_read', args=[export.pk])
 
@@ -1473,11 +1651,14 @@ class MessageExportCRUDLTest(BaseCasesTest):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.context['download_url'], "/messageexport/download/%d/?download=1" % export.pk)
 
-        # download as Excel
+        # download as compressed CSV
         response = self.url_get('unicef', read_url + '?download=1')
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response['Content-Type'], 'application/vnd.ms-excel')
-        self.assertEqual(response['Content-Disposition'], 'attachment; filename=message_export.xls')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=message_export.csv')
+        content = gzip.GzipFile(fileobj=io.BytesIO(b''.join(response.streaming_content))).read()
+        self.assertTrue(content.startswith(codecs.BOM_UTF8))
 
         # another partner user from same partner can access this export
         self.login(self.user2)
@@ -1495,6 +1676,383 @@ class MessageExportCRUDLTest(BaseCasesTest):
         self.login(self.norbert)
         self.assertLoginRedirect(self.url_get('unicef', read_url), 'unicef', read_url)
 
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory',
+                       EXPORT_STREAM_THRESHOLD=2)
+    def test_create_streamed(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann", fields={'nickname': "Annie", 'age': "28"})
+        msg1 = self.create_message(self.unicef, 101, ann, "Hello", is_handled=True)
+        msg2 = self.create_message(self.unicef, 102, ann, "Hi, ♡", is_handled=True)
+
+        self.login(self.admin)
+
+        # small searches aren't saved but are given a URL to download directly
+        response = self.url_post('unicef', '%s?folder=unlabelled' % reverse('msgs.messageexport_create'))
+        self.assertEqual(response.json, {
+            'export_id': None,
+            'download_url': '%s?folder=unlabelled' % reverse('msgs.messageexport_stream')
+        })
+        self.assertEqual(MessageExport.objects.count(), 0)
+
+        response = self.url_get('unicef', response.json['download_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=message_export.csv')
+
+        content = b''.join(response.streaming_content)
+        self.assertTrue(content.startswith(codecs.BOM_UTF8))
+        self.assertEqual(content[len(codecs.BOM_UTF8):].decode('utf-8').splitlines(), [
+            "Time,Message ID,Flagged,Labels,Text,Contact,Nickname,Age",
+            "{:%Y-%m-%d %H:%M:%S},102,No,,\"Hi, ♡\",C-001,Annie,28".format(msg2.created_on),
+            "{:%Y-%m-%d %H:%M:%S},101,No,,Hello,C-001,Annie,28".format(msg1.created_on),
+        ])
+
+        self.create_message(self.unicef, 103, ann, "Yo", is_handled=True)
+
+        # larger searches can't be streamed and are generated in the background
+        response = self.url_post('unicef', '%s?folder=unlabelled' % reverse('msgs.messageexport_create'))
+        self.assertEqual(response.json, {'export_id': MessageExport.objects.get().pk})
+
+        # if the search grows after being found to be streamable, the stream view falls back to the same
+        response = self.url_get('unicef', '%s?folder=unlabelled' % reverse('msgs.messageexport_stream'))
+
+        export = MessageExport.objects.order_by('pk').last()
+        self.assertRedirects(response, reverse('msgs.messageexport_read', args=[export.pk]),
+                             fetch_redirect_response=False)
+        self.assertEqual(export.num_items, 3)
+        self.assertEqual(len(self.openCSV(export.filename)), 4)
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory',
+                       EXPORT_SHARD_SIZE=2, EXPORT_STREAM_THRESHOLD=0)
+    def test_create_sharded(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann", fields={'nickname': "Annie", 'age': "28"})
+        msgs = [self.create_message(self.unicef, 101 + m, ann, "Msg %d" % m, is_handled=True) for m in range(5)]
+
+        self.login(self.admin)
+
+        response = self.url_post('unicef', '%s?folder=unlabelled' % reverse('msgs.messageexport_create'))
+        self.assertEqual(response.status_code, 200)
+
+        export = MessageExport.objects.get()
+        self.assertEqual(export.num_items, 5)
+        self.assertEqual(export.num_shards, 3)
+        self.assertEqual(set(export.shards_done), {0, 1, 2})
+        self.assertEqual(export.items_done, 5)
+        self.assertEqual(export.progress, 100)
+
+        # shards are merged into a single file, newest first
+        rows = self.openCSV(export.filename)
+
+        self.assertEqual(len(rows), 6)
+        self.assertCSVRow(rows, 0, ["Time", "Message ID", "Flagged", "Labels", "Text", "Contact", "Nickname", "Age"])
+        for r, msg in enumerate(reversed(msgs)):
+            self.assertCSVRow(rows, r + 1, [msg.created_on, msg.backend_id, "No", "", msg.text, "C-001", "Annie", "28"])
+
+        # and then deleted
+        for shard in range(3):
+            self.assertFalse(default_storage.exists(export.get_shard_filename(shard)))
+
+        # download page shows progress until the export is ready
+        export.filename = ""
+        export.items_done = 3
+        export.save(update_fields=('filename', 'items_done'))
+
+        response = self.url_get('unicef', reverse('msgs.messageexport_read', args=[export.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['in_progress'])
+        self.assertEqual(response.context['progress'], 60)
+
+    @override_settings(EXPORT_SHARD_SIZE=2)
+    def test_shard_failure(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann", fields={'nickname': "Annie", 'age': "28"})
+        for m in range(5):
+            self.create_message(self.unicef, 101 + m, ann, "Msg %d" % m, is_handled=True)
+
+        export = MessageExport.create(self.unicef, self.admin, {'folder': MessageFolder.unlabelled})
+
+        task = MagicMock(max_retries=3)
+        task.retry.side_effect = Retry()
+
+        export.start(task)
+        self.assertEqual(export.num_shards, 3)
+        self.assertEqual(task.delay.mock_calls, [call(export.pk, 0), call(export.pk, 1), call(export.pk, 2)])
+
+        # a shard which fails is retried, and the items it rendered aren't counted
+        task.request.retries = 0
+
+        with patch('casepro.utils.export.default_storage.save', side_effect=IOError("Disk full")):
+            with self.assertRaises(Retry):
+                export.do_shard(task, 0)
+
+        self.assertEqual(len(task.retry.mock_calls), 1)
+
+        export.refresh_from_db()
+        self.assertEqual(export.items_done, 0)
+        self.assertEqual(export.shards_done, [])
+        self.assertFalse(export.is_failed)
+
+        # a shard which fails with no retries left fails the whole export and notifies the user
+        task.request.retries = 3
+
+        with patch('casepro.utils.export.default_storage.save', side_effect=IOError("Disk full")):
+            with patch('casepro.utils.export.send_email') as mock_send_email:
+                with self.assertRaises(IOError):
+                    export.do_shard(task, 1)
+
+                # but only once if other shards also give up
+                with self.assertRaises(IOError):
+                    export.do_shard(task, 2)
+
+        download_url = "http://unicef.localhost:8000/messageexport/download/%d/" % export.pk
+        mock_send_email.assert_called_once_with([self.admin], "Your export failed", 'utils/email/export_failed',
+                                                {'download_url': download_url})
+
+        export.refresh_from_db()
+        self.assertEqual(export.items_done, 0)
+        self.assertTrue(export.is_failed)
+
+        # download page shows the failure rather than progress
+        self.login(self.admin)
+
+        response = self.url_get('unicef', reverse('msgs.messageexport_read', args=[export.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['in_progress'])
+        self.assertTrue(response.context['failed'])
+        self.assertContains(response, "Your export could not be generated.")
+
+    def test_export_failure(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann", fields={'nickname': "Annie", 'age': "28"})
+        self.create_message(self.unicef, 101, ann, "Hello", is_handled=True)
+        self.create_message(self.unicef, 102, ann, "Hi", is_handled=True)
+
+        export = MessageExport.create(self.unicef, self.admin, {'folder': MessageFolder.unlabelled})
+
+        task = MagicMock(max_retries=3)
+        task.retry.side_effect = Retry()
+
+        # an unsharded export which fails is retried
+        task.request.retries = 0
+
+        with patch('casepro.utils.export.default_storage.save', side_effect=IOError("Disk full")):
+            with self.assertRaises(Retry):
+                export.start(task)
+
+        self.assertEqual(len(task.retry.mock_calls), 1)
+
+        export.refresh_from_db()
+        self.assertEqual(export.filename, "")
+        self.assertFalse(export.is_failed)
+
+        # and if it has no retries left, it's marked as failed and the user is notified
+        task.request.retries = 3
+
+        with patch('casepro.utils.export.default_storage.save', side_effect=IOError("Disk full")):
+            with patch('casepro.utils.export.send_email') as mock_send_email:
+                with self.assertRaises(IOError):
+                    export.start(task)
+
+        download_url = "http://unicef.localhost:8000/messageexport/download/%d/" % export.pk
+        mock_send_email.assert_called_once_with([self.admin], "Your export failed", 'utils/email/export_failed',
+                                                {'download_url': download_url})
+
+        export.refresh_from_db()
+        self.assertEqual(export.num_items, 2)
+        self.assertEqual(export.items_done, 2)
+        self.assertTrue(export.is_failed)
+
+    @override_settings(EXPORT_SHARD_SIZE=2)
+    def test_merge_failure(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann", fields={'nickname': "Annie", 'age': "28"})
+        for m in range(5):
+            self.create_message(self.unicef, 101 + m, ann, "Msg %d" % m, is_handled=True)
+
+        export = MessageExport.create(self.unicef, self.admin, {'folder': MessageFolder.unlabelled})
+
+        task = MagicMock(max_retries=3)
+        task.retry.side_effect = Retry()
+        task.request.retries = 0
+
+        export.start(task)
+        export.do_shard(task, 0)
+        export.do_shard(task, 1)
+
+        # if merging fails, the last shard's task is retried
+        with patch('casepro.utils.export.shutil.copyfileobj', side_effect=IOError("Disk full")):
+            with self.assertRaises(Retry):
+                export.do_shard(task, 2)
+
+        export.refresh_from_db()
+        self.assertEqual(export.filename, "")
+        self.assertEqual(set(export.shards_done), {0, 1, 2})
+        self.assertEqual(export.items_done, 5)
+        self.assertFalse(export.is_failed)
+
+        # which merges the shards without writing its own shard again
+        with patch('casepro.utils.export.CSVExportWriter.write_row') as mock_write_row:
+            export.do_shard(task, 2)
+
+        self.assertEqual(mock_write_row.call_count, 0)
+
+        export.refresh_from_db()
+        self.assertEqual(export.items_done, 5)
+        self.assertEqual(len(self.openCSV(export.filename)), 6)
+
+        # and if merging fails with no retries left, the export is marked as failed
+        export = MessageExport.create(self.unicef, self.admin, {'folder': MessageFolder.unlabelled})
+        export.start(task)
+        export.do_shard(task, 0)
+        export.do_shard(task, 1)
+
+        task.request.retries = 3
+
+        with patch('casepro.utils.export.shutil.copyfileobj', side_effect=IOError("Disk full")):
+            with patch('casepro.utils.export.send_email') as mock_send_email:
+                with self.assertRaises(IOError):
+                    export.do_shard(task, 2)
+
+        self.assertEqual(mock_send_email.call_count, 1)
+
+        export.refresh_from_db()
+        self.assertTrue(export.is_failed)
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    def test_create_recurring(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann", fields={'nickname': "Annie", 'age': "28"})
+        self.create_message(self.unicef, 101, ann, "Hello", is_handled=True)
+        msg2 = self.create_message(self.unicef, 102, ann, "Hi", is_handled=True)
+
+        self.login(self.admin)
+
+        response = self.url_post('unicef', '%s?folder=unlabelled&recurring=true' % reverse('msgs.messageexport_create'))
+        self.assertEqual(response.status_code, 200)
+
+        export1 = MessageExport.objects.get()
+        self.assertTrue(export1.is_recurring)
+        self.assertEqual(export1.last_item_id, msg2.pk)
+        self.assertEqual(len(self.openCSV(export1.filename)), 3)
+
+        msg3 = self.create_message(self.unicef, 103, ann, "Yo", is_handled=True)
+
+        rerun_message_exports()
+
+        export1.refresh_from_db()
+        self.assertFalse(export1.is_recurring)
+
+        # next run only includes the message added since the previous run
+        export2 = MessageExport.objects.get(previous=export1)
+        self.assertTrue(export2.is_recurring)
+        self.assertEqual(export2.last_item_id, msg3.pk)
+
+        rows = self.openCSV(export2.filename)
+        self.assertEqual(len(rows), 2)
+        self.assertCSVRow(rows, 1, [msg3.created_on, 103, "No", "", "Yo", "C-001", "Annie", "28"])
+
+        # a run with nothing new is still created, but keeps the previous watermark
+        rerun_message_exports()
+
+        export3 = MessageExport.objects.get(previous=export2)
+        self.assertEqual(export3.last_item_id, msg3.pk)
+        self.assertEqual(len(self.openCSV(export3.filename)), 1)
+
+    def test_rerun_after_failure(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann", fields={'nickname': "Annie", 'age': "28"})
+        msg1 = self.create_message(self.unicef, 101, ann, "Hello", is_handled=True)
+
+        task = MagicMock(max_retries=3)
+        task.request.retries = 3
+
+        export1 = MessageExport.create(self.unicef, self.admin, {'folder': MessageFolder.unlabelled}, True)
+
+        # a run which hasn't finished can't be followed by the next
+        self.assertIsNone(export1.rerun())
+
+        export1.start(task)
+        self.assertEqual(export1.get_watermark(), msg1.pk)
+
+        msg2 = self.create_message(self.unicef, 102, ann, "Hi", is_handled=True)
+
+        # a run which fails still records the newest item it covered...
+        export2 = export1.rerun()
+
+        with patch('casepro.utils.export.default_storage.save', side_effect=IOError("Disk full")):
+            with self.assertRaises(IOError):
+                export2.start(task)
+
+        export2.refresh_from_db()
+        self.assertTrue(export2.is_failed)
+        self.assertEqual(export2.last_item_id, msg2.pk)
+        self.assertEqual(export2.get_watermark(), msg1.pk)
+
+        msg3 = self.create_message(self.unicef, 103, ann, "Yo", is_handled=True)
+
+        # ...but the next run starts after the last successful run so it includes the items the failed run missed
+        export3 = export2.rerun()
+        export3.start(task)
+
+        rows = self.openCSV(export3.filename)
+        self.assertEqual(len(rows), 3)
+        self.assertCSVRow(rows, 1, [msg3.created_on, 103, "No", "", "Yo", "C-001", "Annie", "28"])
+        self.assertCSVRow(rows, 2, [msg2.created_on, 102, "No", "", "Hi", "C-001", "Annie", "28"])
+        self.assertEqual(export3.get_watermark(), msg3.pk)
+
+        # deleting a run doesn't delete the runs after it
+        export1.delete()
+        export2.refresh_from_db()
+        self.assertIsNone(export2.previous)
+        self.assertEqual(MessageExport.objects.count(), 2)
+
+    def test_stop_recurring(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        self.create_message(self.unicef, 101, ann, "Hello", is_handled=True)
+
+        task = MagicMock(max_retries=3)
+
+        export1 = MessageExport.create(self.unicef, self.admin, {'folder': MessageFolder.unlabelled}, True)
+        export1.start(task)
+        export2 = export1.rerun()
+        export2.start(task)
+
+        read_url = reverse('msgs.messageexport_read', args=[export1.pk])
+        stop_url = reverse('msgs.messageexport_stop', args=[export2.pk])
+
+        # recurrence has been handed to the latest run, so that's the run which is stopped from any run's page
+        self.login(self.admin)
+
+        response = self.url_get('unicef', read_url)
+        self.assertEqual(response.context['stop_url'], stop_url)
+        self.assertContains(response, "Stop Recurring")
+
+        # can only be stopped with a POST
+        response = self.url_get('unicef', stop_url)
+        self.assertEqual(response.status_code, 405)
+
+        # and not by a user from another org
+        self.login(self.norbert)
+        self.assertLoginRedirect(self.url_post('unicef', stop_url), 'unicef', stop_url)
+
+        self.login(self.admin)
+
+        response = self.url_post('unicef', stop_url)
+        self.assertRedirects(response, reverse('msgs.messageexport_read', args=[export2.pk]),
+                             fetch_redirect_response=False)
+
+        export2.refresh_from_db()
+        self.assertFalse(export2.is_recurring)
+        self.assertIsNone(export1.get_recurring_run())
+
+        response = self.url_get('unicef', read_url)
+        self.assertNotIn('stop_url', response.context)
+
+        rerun_message_exports()
+
+        self.assertEqual(MessageExport.objects.count(), 2)
+
+        # a run which was stopped after being fetched for re-running isn't re-run
+        export3 = MessageExport.create(self.unicef, self.admin, {'folder': MessageFolder.unlabelled}, True)
+        export3.start(task)
+        export3.stop_recurring()
+
+        self.assertIsNone(export3.rerun())
+
 
 class OutgoingTest(BaseCasesTest):
     def setUp(self):
@@ -1593,6 +2151,12 @@ class OutgoingTest(BaseCasesTest):
         # by text
         assert_search(self.admin, {'folder': OutgoingFolder.sent, 'text': "LO 5"}, [out5])
 
+        # by text with ranking, closest matches first
+        out6 = self.create_outgoing(self.unicef, self.admin, 206, 'B', "Hello 1 and goodbye to all of you", self.ann)
+        assert_search(self.admin, {'folder': OutgoingFolder.sent, 'text': "hello 1", 'rank': True}, [out1, out6])
+        assert_search(self.admin, {'folder': OutgoingFolder.sent, 'text': "hello 1"}, [out6, out1])
+        out6.delete()
+
         # by contact
         assert_search(self.admin, {'folder': OutgoingFolder.sent, 'contact': self.ann.pk}, [out2, out1])
 
@@ -1696,6 +2260,26 @@ class OutgoingCRUDLTest(BaseCasesTest):
             }
         ])
 
+        # test paging by cursor, including items with the same creation time
+        self.login(self.admin)
+        out3 = self.create_outgoing(self.unicef, self.admin, 203, 'B', "Hello 3", self.ann, created_on=out1.created_on)
+        more = [self.create_outgoing(self.unicef, self.admin, 300 + i, 'B', "Hi", self.ann) for i in range(49)]
+
+        response = self.url_get('unicef', url, {'folder': 'sent', 'before_cursor': ''})
+        self.assertEqual(len(response.json['results']), 50)
+        self.assertEqual(response.json['results'][0]['id'], more[-1].pk)
+        self.assertTrue(response.json['has_more'])
+
+        response = self.url_get('unicef', url, {'folder': 'sent', 'before_cursor': response.json['next_cursor']})
+        self.assertEqual([m['id'] for m in response.json['results']], sorted([out1.pk, out3.pk], reverse=True))
+        self.assertFalse(response.json['has_more'])
+
+        # ranked searches can't be paged by cursor so only return the best matches
+        response = self.url_get('unicef', url, {'folder': 'sent', 'text': "hello", 'rank': 1, 'before_cursor': ''})
+        self.assertEqual(len(response.json['results']), 3)
+        self.assertFalse(response.json['has_more'])
+        self.assertIsNone(response.json['next_cursor'])
+
     def test_search_replies(self):
         url = reverse('msgs.outgoing_search_replies')
 
@@ -1754,7 +2338,8 @@ class OutgoingCRUDLTest(BaseCasesTest):
 
 
 class ReplyExportCRUDLTest(BaseCasesTest):
-    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory',
+                       EXPORT_STREAM_THRESHOLD=0)
     def test_create_and_read(self):
         ann = self.create_contact(self.unicef, "C-001", "Ann", fields={'nickname': "Annie", 'age': "28", 'state': "WA"})
         bob = self.create_contact(self.unicef, "C-002", "Bob", fields={'nickname': "Bobby", 'age': "32", 'state': "IN"})
@@ -1767,7 +2352,8 @@ class ReplyExportCRUDLTest(BaseCasesTest):
         d6 = datetime(2016, 5, 24, 14, 0, tzinfo=pytz.UTC)
 
         msg1 = self.create_message(self.unicef, 101, ann, "Hello?", [self.aids], created_on=d1)
-        msg2 = self.create_message(self.unicef, 102, bob, "I ♡ SMS", [self.pregnancy], is_flagged=True, created_on=d2)
+        msg2 = self.create_message(self.unicef, 102, bob, "I ♡ SMS", [self.pregnancy, self.aids], is_flagged=True,
+                                   created_on=d2)
         self.create_message(self.unicef, 103, bob, "Hi", [], created_on=d3)  # no labels
 
         case = self.create_case(self.unicef, ann, self.moh, msg1)
@@ -1785,22 +2371,21 @@ class ReplyExportCRUDLTest(BaseCasesTest):
 
         export = ReplyExport.objects.get(created_by=self.admin)
 
-        workbook = self.openWorkbook(export.filename)
-        sheet = workbook.sheets()[0]
-
-        self.assertEqual(sheet.nrows, 4)
-        self.assertExcelRow(sheet, 0, ["Sent On", "User", "Message", "Delay",
-                                       "Reply to", "Flagged", "Case Assignee", "Labels",
-                                       "Contact", "Nickname", "Age"])
-        self.assertExcelRow(sheet, 1, [d6, "carol@unicef.org", "Welcome", "4\xa0hours",
-                                       "I ♡ SMS", "Yes", "", "Pregnancy",
-                                       "C-002", "Bobby", "32"], pytz.UTC)
-        self.assertExcelRow(sheet, 2, [d5, "rick@unicef.org", "That's nice", "3\xa0hours",
-                                       "I ♡ SMS", "Yes", "", "Pregnancy",
-                                       "C-002", "Bobby", "32"], pytz.UTC)
-        self.assertExcelRow(sheet, 3, [d4, "evan@unicef.org", "Bonjour", "3\xa0hours",
-                                       "Hello?", "No", "MOH", "AIDS",
-                                       "C-001", "Annie", "28"], pytz.UTC)
+        rows = self.openCSV(export.filename)
+
+        self.assertEqual(len(rows), 4)
+        self.assertCSVRow(rows, 0, ["Sent On", "User", "Message", "Delay (Seconds)",
+                                    "Reply to", "Flagged", "Case Assignee", "Labels",
+                                    "Contact", "Nickname", "Age"])
+        self.assertCSVRow(rows, 1, [d6, "carol@unicef.org", "Welcome", 14400,
+                                    "I ♡ SMS", "Yes", "", "AIDS, Pregnancy",
+                                    "C-002", "Bobby", "32"])
+        self.assertCSVRow(rows, 2, [d5, "rick@unicef.org", "That's nice", 10800,
+                                    "I ♡ SMS", "Yes", "", "AIDS, Pregnancy",
+                                    "C-002", "Bobby", "32"])
+        self.assertCSVRow(rows, 3, [d4, "evan@unicef.org", "Bonjour", 10800,
+                                    "Hello?", "No", "MOH", "AIDS",
+                                    "C-001", "Annie", "28"])
 
         # can now view this download
         read_url = reverse('msgs.replyexport_read', args=[export.pk])
@@ -1815,6 +2400,46 @@ class ReplyExportCRUDLTest(BaseCasesTest):
         response = self.url_get('unicef', read_url)
         self.assertEqual(response.status_code, 302)
 
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory',
+                       EXPORT_STREAM_THRESHOLD=1)
+    def test_create_streamed(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann", fields={'nickname': "Annie", 'age': "28"})
+
+        d1 = datetime(2016, 5, 24, 9, 0, tzinfo=pytz.UTC)
+        d2 = datetime(2016, 5, 24, 10, 0, tzinfo=pytz.UTC)
+        d3 = datetime(2016, 5, 24, 11, 0, tzinfo=pytz.UTC)
+
+        msg1 = self.create_message(self.unicef, 101, ann, "Hello?", [self.aids], created_on=d1)
+        self.create_outgoing(self.unicef, self.user1, 201, 'B', "Bonjour", ann, reply_to=msg1, created_on=d2)
+
+        self.login(self.admin)
+
+        # small searches aren't saved but are given a URL to download directly
+        response = self.url_post('unicef', reverse('msgs.replyexport_create'))
+        self.assertEqual(response.json, {'export_id': None, 'download_url': '%s?' % reverse('msgs.replyexport_stream')})
+        self.assertEqual(ReplyExport.objects.count(), 0)
+
+        response = self.url_get('unicef', response.json['download_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=reply_export.csv')
+
+        content = b''.join(response.streaming_content)
+        self.assertEqual(content[len(codecs.BOM_UTF8):].decode('utf-8').splitlines(), [
+            "Sent On,User,Message,Delay (Seconds),Reply to,Flagged,Case Assignee,Labels,Contact,Nickname,Age",
+            "2016-05-24 10:00:00,evan@unicef.org,Bonjour,3600,Hello?,No,,AIDS,C-001,Annie,28",
+        ])
+
+        self.create_outgoing(self.unicef, self.user1, 202, 'B', "Salut", ann, reply_to=msg1, created_on=d3)
+
+        # if the search grows after being found to be streamable, it's generated in the background instead
+        response = self.url_get('unicef', reverse('msgs.replyexport_stream'))
+
+        export = ReplyExport.objects.get()
+        self.assertRedirects(response, reverse('msgs.replyexport_read', args=[export.pk]),
+                             fetch_redirect_response=False)
+        self.assertEqual(export.created_by, self.admin)
+        self.assertEqual(len(self.openCSV(export.filename)), 3)
+
 
 class TasksTest(BaseCasesTest):
     @patch('casepro.test.TestBackend.pull_labels')
@@ -17,12 +17,13 @@ from smartmin.views import (SmartListView, SmartCreateView, SmartUpdateView, Sma
                             SmartCSVImportView)
 from smartmin.csv_imports.models import ImportTask
 from temba_client.utils import parse_iso8601
-from django.utils import timezone
 
 from casepro.rules.mixins import RuleFormMixin
 from casepro.statistics.models import DailyCount
-from casepro.utils import parse_csv, str_to_bool, JSONEncoder, json_encode, month_range
-from casepro.utils.export import BaseDownloadView
+from casepro.utils import parse_csv, str_to_bool, JSONEncoder, json_encode, month_range, cursor_page
+from casepro.utils.export import BaseDownloadView, BaseStopView, BaseStreamView
+from casepro.utils.push import get_push_timeout
+from casepro.utils.views import FastJsonResponse
 
 
 from .forms import LabelForm, FaqForm
@@ -176,20 +177,24 @@ class MessageSearchMixin(object):
         label_id = self.request.GET.get('label', None)
         include_archived = str_to_bool(self.request.GET.get('archived', ''))
         text = self.request.GET.get('text', None)
+        rank = str_to_bool(self.request.GET.get('rank', ''))
         contact_id = self.request.GET.get('contact', None)
         group_ids = parse_csv(self.request.GET.get('groups', ''), as_ints=True)
         after = parse_iso8601(self.request.GET.get('after', None))
         before = parse_iso8601(self.request.GET.get('before', None))
+        before_cursor = self.request.GET.get('before_cursor', None)
 
         return {
             'folder': folder,
             'label': label_id,
             'include_archived': include_archived,  # only applies to flagged folder
             'text': text,
+            'rank': rank,
             'contact': contact_id,
             'groups': group_ids,
             'after': after,
-            'before': before
+            'before': before,
+            'before_cursor': before_cursor
         }
 
 
@@ -197,10 +202,15 @@ class MessageCRUDL(SmartCRUDL):
     actions = ('search', 'lock', 'action', 'label', 'bulk_reply', 'forward', 'history')
     model = Message
 
-    class Search(OrgPermsMixin, MessageSearchMixin, SmartTemplateView):
+    class Search(NonAtomicMixin, OrgPermsMixin, MessageSearchMixin, SmartTemplateView):
         """
-        JSON endpoint for fetching incoming messages
+        JSON endpoint for fetching incoming messages. Non-atomic so that long-polls don't hold a transaction.
         """
+        @staticmethod
+        def search(org, user, search):
+            # results are fetched as values for the compact serializer
+            return Message.search(org, user, search).prefetch_related(None).values(*Message.JSON_FIELDS)
+
         def get_context_data(self, **kwargs):
             context = super(MessageCRUDL.Search, self).get_context_data(**kwargs)
 
@@ -210,39 +220,64 @@ class MessageCRUDL(SmartCRUDL):
 
             search = self.derive_search()
 
-            # this is a refresh of messages
+            # this is a refresh of messages which can be read from the change feed if the client has a position in it
+            last_change = self.request.GET.get('last_change', '')
+            wait = str_to_bool(self.request.GET.get('wait', ''))
+
+            if not last_change.isdigit():
+                changes = None
+            elif wait:
+                changes = Message.wait_for_changes(org, int(last_change), get_push_timeout())
+            else:
+                changes = Message.get_changes(org, int(last_change))
+
+            if changes is not None:
+                search['changed_ids'], context['last_change'] = changes
+                search['before'] = None  # changes are complete up to last_change regardless of the client's clock
+
+                context['object_list'] = list(self.search(org, user, search)) if search['changed_ids'] else []
+                context['has_more'] = False
+                return context
+
+            # read the feed position first so that changes made while searching aren't missed by the next refresh
+            context['last_change'] = Message.get_last_change(org)
+
+            # otherwise fall back to searching for new and modified messages
             if self.request.GET.get('last_refresh', None):
-                new_messages = Message.search(org, user, search)
+                new_messages = list(self.search(org, user, search))
+                new_ids = {m['id'] for m in new_messages}
 
                 search['last_refresh'] = self.request.GET['last_refresh']
 
-                updated_messages = Message.search(org, user, search)
+                updated_messages = [m for m in self.search(org, user, search) if m['id'] not in new_ids]
 
-                context['object_list'] = list(new_messages) + list(set(updated_messages) - set(new_messages))
+                context['object_list'] = new_messages + updated_messages
 
                 context['has_more'] = False
                 return context
 
-            messages = Message.search(org, user, search)
-            paginator = LazyPaginator(messages, per_page=50)
+            messages = self.search(org, user, search)
+
+            if search['before_cursor'] is not None and search['text'] and search['rank']:
+                # ranked results aren't in time order so can't be paged by cursor, only the best matches are returned
+                context['object_list'], context['has_more'] = list(messages[:50]), False
+            elif search['before_cursor'] is not None:
+                context['object_list'], context['has_more'], context['next_cursor'] = cursor_page(
+                    messages, 50, 'created_on')
+            else:
+                paginator = LazyPaginator(messages, per_page=50)
 
-            context['object_list'] = paginator.page(page)
-            context['has_more'] = paginator.num_pages > page
+                context['object_list'] = paginator.page(page)
+                context['has_more'] = paginator.num_pages > page
             return context
 
         def render_to_response(self, context, **response_kwargs):
-            results = []
-            for m in context['object_list']:
-                msg = m.as_json()
-
-                msg['lock'] = m.get_lock(self.request.user)
-
-                results.append(msg)
-
-            return JsonResponse({
-                'results': results,
-                'has_more': context['has_more']
-            }, encoder=JSONEncoder)
+            return FastJsonResponse({
+                'results': Message.as_json_rows(list(context['object_list']), self.request.user),
+                'has_more': context['has_more'],
+                'next_cursor': context.get('next_cursor'),
+                'last_change': context['last_change']
+            })
 
     class Lock(OrgPermsMixin, SmartTemplateView):
         """
@@ -262,26 +297,15 @@ class MessageCRUDL(SmartCRUDL):
             message_ids = request.json['messages']
             messages = org.incoming_messages.filter(org=org, backend_id__in=message_ids)
 
+            messages = list(messages.only('pk', 'backend_id'))
             lock_messages = []
 
             if action == 'lock':
-                for message in messages:
-                    if message.get_lock(request.user):
-                        lock_messages.append(message.backend_id)
-
-                if not lock_messages:
-                    for message in messages:
-                        message.locked_on = timezone.now()
-                        message.locked_by = user
-                        message.modified_on = timezone.now()
-                        message.save(update_fields=['locked_on', 'locked_by', 'modified_on'])
+                conflicting_ids = set(Message.bulk_lock(org, user, messages))
+                lock_messages = [m.backend_id for m in messages if m.pk in conflicting_ids]
 
             elif action == 'unlock':
-                for message in messages:
-                    message.locked_on = timezone.now()
-                    message.locked_by = None
-                    message.modified_on = timezone.now()
-                    message.save(update_fields=['locked_on', 'locked_by', 'modified_on'])
+                Message.bulk_unlock(org, messages)
 
             else:  # pragma: no cover
                 return HttpResponseBadRequest("Invalid action: %s", action)
@@ -410,21 +434,38 @@ class MessageCRUDL(SmartCRUDL):
 
 class MessageExportCRUDL(SmartCRUDL):
     model = MessageExport
-    actions = ('create', 'read')
+    actions = ('create', 'stream', 'read', 'stop')
 
     class Create(NonAtomicMixin, OrgPermsMixin, MessageSearchMixin, SmartCreateView):
         def post(self, request, *args, **kwargs):
             search = self.derive_search()
-            export = MessageExport.create(self.request.org, self.request.user, search)
+            is_recurring = str_to_bool(self.request.GET.get('recurring', ''))
+            export = MessageExport.for_search(self.request.org, self.request.user, search, is_recurring)
+
+            # small searches can be downloaded directly rather than generated in the background
+            if not is_recurring and export.is_streamable():
+                stream_url = '%s?%s' % (reverse('msgs.messageexport_stream'), request.GET.urlencode())
+                return JsonResponse({'export_id': None, 'download_url': stream_url})
+
+            export.save()
 
             message_export.delay(export.pk)
 
             return JsonResponse({'export_id': export.pk})
 
+    class Stream(NonAtomicMixin, MessageSearchMixin, BaseStreamView):
+        filename = 'message_export.csv'
+
+        def queue_export(self, export):
+            message_export.delay(export.pk)
+
     class Read(BaseDownloadView):
         title = _("Download Messages")
         filename = 'message_export.xls'
 
+    class Stop(BaseStopView):
+        permission = 'msgs.messageexport_read'
+
 
 class ReplySearchMixin(object):
     def derive_search(self):
@@ -435,8 +476,9 @@ class ReplySearchMixin(object):
         partner = params.get('partner')
         after = parse_iso8601(params.get('after'))
         before = parse_iso8601(params.get('before'))
+        before_cursor = params.get('before_cursor')
 
-        return {'partner': partner, 'after': after, 'before': before}
+        return {'partner': partner, 'after': after, 'before': before, 'before_cursor': before_cursor}
 
 
 class OutgoingCRUDL(SmartCRUDL):
@@ -450,9 +492,11 @@ class OutgoingCRUDL(SmartCRUDL):
         def derive_search(self):
             folder = OutgoingFolder[self.request.GET['folder']]
             text = self.request.GET.get('text', None)
+            rank = str_to_bool(self.request.GET.get('rank', ''))
             contact = self.request.GET.get('contact', None)
+            before_cursor = self.request.GET.get('before_cursor', None)
 
-            return {'folder': folder, 'text': text, 'contact': contact}
+            return {'folder': folder, 'text': text, 'rank': rank, 'contact': contact, 'before_cursor': before_cursor}
 
         def get_context_data(self, **kwargs):
             context = super(OutgoingCRUDL.Search, self).get_context_data(**kwargs)
@@ -462,18 +506,27 @@ class OutgoingCRUDL(SmartCRUDL):
             page = int(self.request.GET.get('page', 1))
 
             search = self.derive_search()
-            messages = Outgoing.search(org, user, search)
-            paginator = LazyPaginator(messages, per_page=50)
-
-            context['object_list'] = paginator.page(page)
-            context['has_more'] = paginator.num_pages > page
+            messages = Outgoing.search(org, user, search).prefetch_related(None).values(*Outgoing.JSON_FIELDS)
+
+            if search['before_cursor'] is not None and search['text'] and search['rank']:
+                # ranked results aren't in time order so can't be paged by cursor, only the best matches are returned
+                context['object_list'], context['has_more'] = list(messages[:50]), False
+            elif search['before_cursor'] is not None:
+                context['object_list'], context['has_more'], context['next_cursor'] = cursor_page(
+                    messages, 50, 'created_on')
+            else:
+                paginator = LazyPaginator(messages, per_page=50)
+
+                context['object_list'] = paginator.page(page)
+                context['has_more'] = paginator.num_pages > page
             return context
 
         def render_to_response(self, context, **response_kwargs):
-            return JsonResponse({
-                'results': [m.as_json() for m in context['object_list']],
-                'has_more': context['has_more']
-            }, encoder=JSONEncoder)
+            return FastJsonResponse({
+                'results': Outgoing.as_json_rows(list(context['object_list'])),
+                'has_more': context['has_more'],
+                'next_cursor': context.get('next_cursor')
+            })
 
     class SearchReplies(OrgPermsMixin, ReplySearchMixin, SmartTemplateView):
         """
@@ -487,9 +540,13 @@ class OutgoingCRUDL(SmartCRUDL):
             search = self.derive_search()
             items = Outgoing.search_replies(org, user, search)
 
-            paginator = LazyPaginator(items, 50)
-            outgoing = paginator.page(page)
-            has_more = paginator.num_pages > page
+            if search['before_cursor'] is not None:
+                outgoing, has_more, next_cursor = cursor_page(items, 50, 'created_on')
+            else:
+                paginator = LazyPaginator(items, 50)
+                outgoing = paginator.page(page)
+                has_more = paginator.num_pages > page
+                next_cursor = None
 
             def as_json(msg):
                 delay = (msg.created_on - msg.reply_to.created_on).total_seconds()
@@ -507,22 +564,39 @@ class OutgoingCRUDL(SmartCRUDL):
                 })
                 return obj
 
-            return JsonResponse({'results': [as_json(o) for o in outgoing], 'has_more': has_more}, encoder=JSONEncoder)
+            return JsonResponse({
+                'results': [as_json(o) for o in outgoing],
+                'has_more': has_more,
+                'next_cursor': next_cursor
+            }, encoder=JSONEncoder)
 
 
 class ReplyExportCRUDL(SmartCRUDL):
     model = ReplyExport
-    actions = ('create', 'read')
+    actions = ('create', 'stream', 'read')
 
     class Create(NonAtomicMixin, OrgPermsMixin, ReplySearchMixin, SmartCreateView):
         def post(self, request, *args, **kwargs):
             search = self.derive_search()
-            export = self.model.create(self.request.org, self.request.user, search)
+            export = self.model.for_search(self.request.org, self.request.user, search)
+
+            # small searches can be downloaded directly rather than generated in the background
+            if export.is_streamable():
+                stream_url = '%s?%s' % (reverse('msgs.replyexport_stream'), request.GET.urlencode())
+                return JsonResponse({'export_id': None, 'download_url': stream_url})
+
+            export.save()
 
             reply_export.delay(export.pk)
 
             return JsonResponse({'export_id': export.pk})
 
+    class Stream(NonAtomicMixin, ReplySearchMixin, BaseStreamView):
+        filename = 'reply_export.csv'
+
+        def queue_export(self, export):
+            reply_export.delay(export.pk)
+
     class Read(BaseDownloadView):
         title = _("Download Replies")
         filename = 'reply_export.xls'
@@ -535,11 +609,13 @@ class FaqSearchMixin(object):
         """
         label = self.request.GET.get('label', None)
         text = self.request.GET.get('text', None)
+        rank = str_to_bool(self.request.GET.get('rank', ''))
         language = self.request.GET.get('language', None)
 
         return {
             'label': label,
             'text': text,
+            'rank': rank,
             'language': language,
         }
 
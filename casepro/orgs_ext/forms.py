@@ -52,11 +52,18 @@ class OrgEditForm(forms.ModelForm):
         required=False
     )
 
+    stats_retention = forms.IntegerField(
+        label=_("Statistics retention"), min_value=1,
+        help_text=_("Number of months of daily statistics to keep, leave blank to keep all"),
+        required=False
+    )
+
     def __init__(self, *args, **kwargs):
         org = kwargs.pop('org')
         super(OrgEditForm, self).__init__(*args, **kwargs)
 
         self.fields['banner_text'].initial = org.get_banner_text()
+        self.fields['stats_retention'].initial = org.get_stats_retention()
 
         field_choices = []
         for field in Field.objects.filter(org=org, is_active=True).order_by('label'):
@@ -74,4 +81,4 @@ class OrgEditForm(forms.ModelForm):
 
     class Meta:
         model = Org
-        fields = ('name', 'timezone', 'banner_text', 'contact_fields', 'suspend_groups', 'logo')
+        fields = ('name', 'timezone', 'banner_text', 'contact_fields', 'suspend_groups', 'stats_retention', 'logo')
@@ -8,6 +8,7 @@ from django.db.models import Q
 
 ORG_CACHE_TTL = 60 * 60 * 24 * 7  # 1 week
 ORG_CONFIG_BANNER_TEXT = 'banner_text'
+ORG_CONFIG_STATS_RETENTION = 'stats_retention'
 
 
 def _org_get_users(org):
@@ -23,6 +24,14 @@ def _org_set_banner_text(org, text):
     org.set_config(ORG_CONFIG_BANNER_TEXT, text)
 
 
+def _org_get_stats_retention(org):
+    return org.get_config(ORG_CONFIG_STATS_RETENTION)
+
+
+def _org_set_stats_retention(org, months):
+    org.set_config(ORG_CONFIG_STATS_RETENTION, months)
+
+
 def _org_make_absolute_url(org, url):
     return settings.SITE_HOST_PATTERN % org.subdomain + url
 
@@ -30,4 +39,6 @@ def _org_make_absolute_url(org, url):
 Org.get_users = _org_get_users
 Org.get_banner_text = _org_get_banner_text
 Org.set_banner_text = _org_set_banner_text
+Org.get_stats_retention = _org_get_stats_retention
+Org.set_stats_retention = _org_set_stats_retention
 Org.make_absolute_url = _org_make_absolute_url
@@ -75,7 +75,7 @@ class OrgExtCRUDLTest(BaseCasesTest):
         # test updating
         response = self.url_post('unicef', url, {
             'name': "UNIZEFF", 'timezone': "Africa/Kigali", 'banner_text': "Chill",
-            'contact_fields': [self.state.pk], 'suspend_groups': [self.males.pk]
+            'contact_fields': [self.state.pk], 'suspend_groups': [self.males.pk], 'stats_retention': 12
         })
 
         self.assertEqual(response.status_code, 302)
@@ -86,6 +86,7 @@ class OrgExtCRUDLTest(BaseCasesTest):
         self.assertEqual(self.unicef.name, "UNIZEFF")
         self.assertEqual(self.unicef.timezone, pytz.timezone("Africa/Kigali"))
         self.assertEqual(self.unicef.get_banner_text(), "Chill")
+        self.assertEqual(self.unicef.get_stats_retention(), 12)
 
         self.assertEqual(set(Group.get_suspend_from(self.unicef)), {self.males})
         self.assertEqual(set(Field.get_all(self.unicef, visible=True)), {self.state})
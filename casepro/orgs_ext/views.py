@@ -6,9 +6,8 @@ from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext_lazy as _
 from smartmin.views import SmartCRUDL, SmartUpdateView
 
-from casepro.cases.models import Case
 from casepro.contacts.models import Field, Group
-from casepro.statistics.models import DailyCount
+from casepro.statistics.models import DailyCount, TotalCount
 
 from .forms import OrgForm, OrgEditForm
 
@@ -40,8 +39,8 @@ class OrgExtCRUDL(SmartCRUDL):
             return {
                 'total_incoming': DailyCount.get_by_org([org], DailyCount.TYPE_INCOMING).total(),
                 'total_replies': DailyCount.get_by_org([org], DailyCount.TYPE_REPLIES).total(),
-                'cases_open': Case.objects.filter(org=org, closed_on=None).count(),
-                'cases_closed': Case.objects.filter(org=org).exclude(closed_on=None).count()
+                'cases_open': TotalCount.get_by_org([org], TotalCount.TYPE_OPEN_CASES).total(),
+                'cases_closed': TotalCount.get_by_org([org], TotalCount.TYPE_CLOSED_CASES).total()
             }
 
     class Edit(InferOrgMixin, OrgPermsMixin, SmartUpdateView):
@@ -58,6 +57,7 @@ class OrgExtCRUDL(SmartCRUDL):
         def pre_save(self, obj):
             obj = super(OrgExtCRUDL.Edit, self).pre_save(obj)
             obj.set_banner_text(self.form.cleaned_data['banner_text'])
+            obj.set_stats_retention(self.form.cleaned_data['stats_retention'])
 
             field_ids = self.form.cleaned_data['contact_fields']
 
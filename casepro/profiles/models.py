@@ -8,11 +8,13 @@ from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from django.db import models
 from django.utils import timezone
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
+from itertools import groupby
 
 from casepro.cases.models import CaseAction
 from casepro.msgs.models import Message
-from casepro.utils.email import send_email
+from casepro.utils.email import EmailRenderer, send_raw_emails
 
 ROLE_ADMIN = 'A'
 ROLE_MANAGER = 'M'
@@ -114,6 +116,8 @@ class Notification(models.Model):
 
     created_on = models.DateTimeField(default=timezone.now)
 
+    SEND_BATCH_SIZE = 100  # number of users whose emails are sent over each connection
+
     @classmethod
     def new_message_labelling(cls, org, user, message):
         return cls.objects.get_or_create(org=org, user=user, type=cls.TYPE_MESSAGE_LABELLING, message=message)
@@ -132,17 +136,47 @@ class Notification(models.Model):
 
     @classmethod
     def send_all(cls):
+        """
+        Sends all unsent notifications, with multiple notifications for the same user combined into a digest email.
+        Emails are queued in batches for the email delivery task, and each batch's notifications marked as sent by id
+        once queued, so a failure to queue only means that batch will be re-sent. Delivery is at most once: the task
+        retries failed emails but if it gives up, their notifications stay marked as sent and are only counted in the
+        failed email stats.
+        """
         unsent = cls.objects.filter(is_sent=False)
-        unsent = unsent.select_related('org', 'user', 'message', 'case_action').order_by('created_on')
+        unsent = unsent.select_related('org', 'user', 'message', 'case_action').order_by('user_id', 'created_on')
+
+        by_user = [(user, list(notifications)) for user, notifications in groupby(unsent, key=lambda n: n.user)]
+        renderer = EmailRenderer()
+
+        for b in range(0, len(by_user), cls.SEND_BATCH_SIZE):
+            emails = []
+            sent_ids = []
+            for user, notifications in by_user[b:b + cls.SEND_BATCH_SIZE]:
+                emails.append(cls._build_email(user, notifications, renderer))
+                sent_ids += [n.pk for n in notifications]
+
+            send_raw_emails(emails)
+
+            cls.objects.filter(pk__in=sent_ids).update(is_sent=True)
 
-        for notification in unsent:
+    @classmethod
+    def _build_email(cls, user, notifications, renderer):
+        parts = []
+        for notification in notifications:
             type_name = cls.TYPE_NAME[notification.type]
             subject, template, context = getattr(notification, '_build_%s_email' % type_name)()
-            template_path = 'profiles/email/%s' % template
+            text, html = renderer.render('profiles/email/%s' % template, context)
+
+            parts.append({'subject': six.text_type(subject), 'text': text, 'html': mark_safe(html)})
 
-            send_email([notification.user], six.text_type(subject), template_path, context)
+        if len(parts) == 1:
+            return [user], parts[0]['subject'], parts[0]['text'], parts[0]['html']
 
-        unsent.update(is_sent=True)
+        subject = _("%d new notifications") % len(parts)
+        text, html = renderer.render('profiles/email/digest', {'notifications': parts})
+
+        return [user], six.text_type(subject), text, html
 
     def _build_message_labelling_email(self):
         context = {
@@ -372,6 +406,20 @@ def _user_as_json(user, full=True, org=None):
         return {'id': user.pk, 'name': user.get_full_name()}
 
 
+def users_as_json_by_id(user_ids):
+    """
+    Gets the compact JSON of the given users as a dict by id, without loading full user and profile objects
+    """
+    users = User.objects.filter(pk__in=set(user_ids)).values_list(
+        'pk', 'profile__pk', 'profile__full_name', 'first_name', 'last_name')
+
+    users_by_id = {}
+    for pk, profile_pk, full_name, first_name, last_name in users:
+        name = full_name if profile_pk else " ".join([first_name, last_name]).strip()
+        users_by_id[pk] = {'id': pk, 'name': name}
+    return users_by_id
+
+
 User.clean = _user_clean
 User.has_profile = _user_has_profile
 User.get_full_name = _user_get_full_name
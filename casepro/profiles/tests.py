@@ -5,12 +5,14 @@ import six
 
 from datetime import datetime
 from django.contrib.auth.models import User
+from django.core import mail
 from django.core.urlresolvers import reverse
 from django.test.utils import override_settings
 from django.utils import timezone
-from mock import patch, call
+from mock import patch
 
 from casepro.test import BaseCasesTest
+from casepro.utils.email import send_raw_emails
 
 from .models import Notification, Profile, ROLE_ADMIN, ROLE_MANAGER, ROLE_ANALYST
 from .tasks import send_notifications
@@ -40,8 +42,8 @@ class NotificationTest(BaseCasesTest):
         Notification.objects.get(user=self.admin, message=msg, type=Notification.TYPE_MESSAGE_LABELLING, is_sent=False)
         Notification.objects.get(user=self.user1, message=msg, type=Notification.TYPE_MESSAGE_LABELLING, is_sent=False)
 
-    @patch('casepro.profiles.models.send_email')
-    def test_send_all(self, mock_send_email):
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    def test_send_all(self):
         self.aids.watch(self.admin)
         self.pregnancy.watch(self.user1)
         msg1 = self.create_message(self.unicef, 101, self.ann, "Hello", [self.aids])
@@ -52,13 +54,13 @@ class NotificationTest(BaseCasesTest):
         # all notifications now marked as sent
         self.assertEqual(Notification.objects.filter(is_sent=False).count(), 0)
 
-        mock_send_email.assert_has_calls([
-            call([self.admin], "New labelled message", 'profiles/email/message_labelling',
-                 {'labels': {self.aids}, 'inbox_url': "http://unicef.localhost:8000/"}),
-            call([self.user1], "New labelled message", 'profiles/email/message_labelling',
-                 {'labels': {self.pregnancy}, 'inbox_url': "http://unicef.localhost:8000/"})
+        self.assertEmails([
+            ("kidus@unicef.org", "New labelled message"),
+            ("evan@unicef.org", "New labelled message"),
         ])
-        mock_send_email.reset_mock()
+        self.assertIn("A message was given labels that you watch: AIDS.", mail.outbox[0].body)
+        self.assertIn('<a href="http://unicef.localhost:8000/">', mail.outbox[0].alternatives[0][0])
+        mail.outbox = []
 
         case1 = self.create_case(self.unicef, self.ann, self.moh, msg1)
         case1.watch(self.admin)
@@ -66,81 +68,45 @@ class NotificationTest(BaseCasesTest):
 
         send_notifications()
 
-        mock_send_email.assert_has_calls([
-            call([self.admin], "New reply in case #%d" % case1.pk, 'profiles/email/case_reply',
-                 {'case_url': "http://unicef.localhost:8000/case/read/%d/" % case1.pk})
-        ])
-        mock_send_email.reset_mock()
+        self.assertEmails([("kidus@unicef.org", "New reply in case #%d" % case1.pk)])
+        self.assertIn("http://unicef.localhost:8000/case/read/%d/" % case1.pk, mail.outbox[0].body)
+        mail.outbox = []
 
         case1.add_note(self.user1, "General note")
         case1.close(self.user1, "Close note")
         case1.reopen(self.user1)
         case1.reassign(self.admin, self.who)
 
-        send_notifications()
+        # use small batches to check that each is sent and marked as sent separately
+        with patch.object(Notification, 'SEND_BATCH_SIZE', 2):
+            with patch('casepro.profiles.models.send_raw_emails', wraps=send_raw_emails) as mock_send_raw_emails:
+                send_notifications()
 
-        self.assertEqual(len(mock_send_email.mock_calls), 5)
-        mock_send_email.assert_has_calls([
-            call(
-                [self.admin],
-                "New note in case #%d" % case1.pk,
-                'profiles/email/case_new_note',
-                {
-                    'user': self.user1,
-                    'note': "General note",
-                    'assignee': None,
-                    'case_url': "http://unicef.localhost:8000/case/read/%d/" % case1.pk
-                }
-            ),
-            call(
-                [self.admin],
-                "Case #%d was closed" % case1.pk,
-                'profiles/email/case_closed',
-                {
-                    'user': self.user1,
-                    'note': "Close note",
-                    'assignee': None,
-                    'case_url': "http://unicef.localhost:8000/case/read/%d/" % case1.pk
-                }
-            ),
-            call(
-                [self.admin],
-                "Case #%d was reopened" % case1.pk,
-                'profiles/email/case_reopened',
-                {
-                    'user': self.user1,
-                    'note': None,
-                    'assignee': None,
-                    'case_url': "http://unicef.localhost:8000/case/read/%d/" % case1.pk
-                }
-            ),
-            call(
-                [self.user1],
-                "Case #%d was reassigned" % case1.pk,
-                'profiles/email/case_reassigned',
-                {
-                    'user': self.admin,
-                    'note': None,
-                    'assignee': self.who,
-                    'case_url': "http://unicef.localhost:8000/case/read/%d/" % case1.pk
-                }
-            ),
-            call(
-                [self.user3],
-                "New case assignment #%d" % case1.pk,
-                'profiles/email/case_assignment',
-                {
-                    'user': self.admin,
-                    'case_url': "http://unicef.localhost:8000/case/read/%d/" % case1.pk
-                }
-            )
+                self.assertEqual(len(mock_send_raw_emails.mock_calls), 2)
+
+        # multiple notifications for the same user are combined into a digest
+        self.assertEmails([
+            ("kidus@unicef.org", "3 new notifications"),
+            ("evan@unicef.org", "Case #%d was reassigned" % case1.pk),
+            ("carol@unicef.org", "New case assignment #%d" % case1.pk),
         ])
-        mock_send_email.reset_mock()
+
+        digest = mail.outbox[0]
+        self.assertIn("New note in case #%d" % case1.pk, digest.body)
+        self.assertIn("User evan@unicef.org added a new note:", digest.body)
+        self.assertIn("General note", digest.body)
+        self.assertIn("Case #%d was closed" % case1.pk, digest.body)
+        self.assertIn("Case #%d was reopened" % case1.pk, digest.body)
+        self.assertIn("<h3>Case #%d was closed</h3>" % case1.pk, digest.alternatives[0][0])
+        mail.outbox = []
 
         # if nothing has happened, no emails are sent
         send_notifications()
 
-        self.assertNotCalled(mock_send_email)
+        self.assertEqual(mail.outbox, [])
+
+    def assertEmails(self, expected):
+        self.assertEqual([(e.to[0], e.subject) for e in mail.outbox], expected)
 
 
 class ProfileTest(BaseCasesTest):
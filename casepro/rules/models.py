@@ -318,8 +318,7 @@ class LabelAction(Action):
         return "apply label '%s'" % self.label.name
 
     def apply_to(self, org, messages):
-        for msg in messages:
-            msg.label(self.label)
+        Message.apply_label(org, messages, self.label)
 
         if self.label.is_synced:
             get_backend().label_messages(org, messages, self.label)
@@ -37,6 +37,12 @@ DATABASES = {
 EMAIL_BACKEND = 'djcelery_email.backends.CeleryEmailBackend'
 SEND_EMAILS = TESTING  # safe to send emails during tests as these use a fake backend
 
+# our own emails are queued and delivered in batches by a task, limited to a number per minute. The task uses
+# EMAIL_DELIVERY_BACKEND if it's set, and otherwise CELERY_EMAIL_BACKEND like other emails.
+if TESTING:
+    EMAIL_DELIVERY_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+EMAIL_RATE_LIMIT = None
+
 # dash configuration
 SITE_API_HOST = 'http://localhost:8001/'
 SITE_API_USER_AGENT = 'casepro/0.1'
@@ -57,6 +63,7 @@ SITE_HIDE_CONTACT_FIELDS = []  # Listed fields should not be displayed
 SITE_CONTACT_DISPLAY = "name"  # Overrules SITE_HIDE_CONTACT_FIELDS Options: 'name', 'uuid' or 'urns'
 SITE_ALLOW_CASE_WITHOUT_MESSAGE = True
 SITE_MAX_MESSAGE_CHARS = 160  # the max value for this is 800
+SITE_PUSH_TIMEOUT = 25  # the max seconds a long-poll request waits for changes
 
 # junebug configuration
 JUNEBUG_API_ROOT = 'http://localhost:8080/'
@@ -305,15 +312,15 @@ PERMISSIONS = {
 
     'msgs.message': ('action', 'bulk_reply', 'forward', 'label', 'history', 'search', 'unlabelled', 'lock'),
 
-    'msgs.messageexport': ('create', 'read'),
+    'msgs.messageexport': ('create', 'stream', 'read'),
 
     'msgs.outgoing': ('search', 'search_replies'),
 
-    'msgs.replyexport': ('create', 'read'),
+    'msgs.replyexport': ('create', 'stream', 'read'),
 
     'cases.case': ('create', 'read', 'update', 'list'),
 
-    'case.caseexport': ('create', 'read'),
+    'cases.caseexport': ('create', 'stream', 'read'),
 
     'cases.partner': ('create', 'read', 'delete', 'list'),
 
@@ -375,10 +382,12 @@ GROUP_PERMISSIONS = {
         'msgs.message_search',
         'msgs.message_lock',
         'msgs.messageexport_create',
+        'msgs.messageexport_stream',
         'msgs.messageexport_read',
         'msgs.outgoing_search',
         'msgs.outgoing_search_replies',
         'msgs.replyexport_create',
+        'msgs.replyexport_stream',
         'msgs.replyexport_read',
 
         'cases.case_create',
@@ -387,6 +396,7 @@ GROUP_PERMISSIONS = {
         'cases.case_list',
         'cases.case_replies',
         'cases.caseexport_create',
+        'cases.caseexport_stream',
         'cases.caseexport_read',
         'cases.partner_list',
         'cases.partner_read',
@@ -415,10 +425,12 @@ GROUP_PERMISSIONS = {
         'msgs.message_search',
         'msgs.message_lock',
         'msgs.messageexport_create',
+        'msgs.messageexport_stream',
         'msgs.messageexport_read',
         'msgs.outgoing_search',
         'msgs.outgoing_search_replies',
         'msgs.replyexport_create',
+        'msgs.replyexport_stream',
         'msgs.replyexport_read',
 
         'cases.case_create',
@@ -427,6 +439,7 @@ GROUP_PERMISSIONS = {
         'cases.case_list',
         'cases.case_replies',
         'cases.caseexport_create',
+        'cases.caseexport_stream',
         'cases.caseexport_read',
         'cases.partner_list',
         'cases.partner_read',
@@ -486,10 +499,24 @@ CELERYBEAT_SCHEDULE = {
         'task': 'casepro.profiles.tasks.send_notifications',
         'schedule': timedelta(minutes=1),
     },
+    'rerun-message-exports': {
+        'task': 'casepro.msgs.tasks.rerun_message_exports',
+        'schedule': timedelta(days=7),
+    },
+    'rerun-daily-count-exports': {
+        'task': 'casepro.statistics.tasks.rerun_daily_count_exports',
+        'schedule': timedelta(days=7),
+    },
 }
 
 CELERY_TIMEZONE = 'UTC'
 
+# search exports with more items than this are split into shards which are rendered by parallel tasks
+EXPORT_SHARD_SIZE = 100000
+
+# search exports with up to this many items are streamed directly to the user rather than generated in the background
+EXPORT_STREAM_THRESHOLD = 1000
+
 # -----------------------------------------------------------------------------------
 # Django Compressor configuration
 # -----------------------------------------------------------------------------------
@@ -0,0 +1,50 @@
+----------------------------------------------------------------------
+-- Trigger function to maintain case.label_ids when labels are applied
+-- or removed. Runs once per statement.
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_case_labels_on_change() RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    UPDATE cases_case c
+    SET label_ids = ARRAY(SELECT cl.label_id FROM cases_case_labels cl WHERE cl.case_id = c.id ORDER BY cl.label_id)
+    WHERE c.id IN (SELECT case_id FROM cases_case_labels_new);
+  ELSE
+    UPDATE cases_case c
+    SET label_ids = ARRAY(SELECT cl.label_id FROM cases_case_labels cl WHERE cl.case_id = c.id ORDER BY cl.label_id)
+    WHERE c.id IN (SELECT case_id FROM cases_case_labels_old);
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Trigger function to maintain case.label_ids on truncate
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_case_labels_on_truncate() RETURNS TRIGGER AS $$
+BEGIN
+  UPDATE cases_case SET label_ids = '{}' WHERE label_ids != '{}';
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- install for INSERT on cases_case_labels
+DROP TRIGGER IF EXISTS cases_case_labels_on_insert_trg ON cases_case_labels;
+CREATE TRIGGER cases_case_labels_on_insert_trg
+   AFTER INSERT ON cases_case_labels
+   REFERENCING NEW TABLE AS cases_case_labels_new
+   FOR EACH STATEMENT EXECUTE PROCEDURE cases_case_labels_on_change();
+
+-- install for DELETE on cases_case_labels
+DROP TRIGGER IF EXISTS cases_case_labels_on_delete_trg ON cases_case_labels;
+CREATE TRIGGER cases_case_labels_on_delete_trg
+   AFTER DELETE ON cases_case_labels
+   REFERENCING OLD TABLE AS cases_case_labels_old
+   FOR EACH STATEMENT EXECUTE PROCEDURE cases_case_labels_on_change();
+
+-- install for TRUNCATE on cases_case_labels
+DROP TRIGGER IF EXISTS cases_case_labels_on_truncate_trg ON cases_case_labels;
+CREATE TRIGGER cases_case_labels_on_truncate_trg
+   AFTER TRUNCATE ON cases_case_labels
+   FOR EACH STATEMENT EXECUTE PROCEDURE cases_case_labels_on_truncate();
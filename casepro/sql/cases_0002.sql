@@ -0,0 +1,74 @@
+----------------------------------------------------------------------
+-- Utility function to get the count type of a case, i.e. open or closed
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_count_type(_case cases_case) RETURNS CHAR(1) AS $$
+BEGIN
+  RETURN CASE WHEN _case.closed_on IS NULL THEN 'O' ELSE 'X' END;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Utility function to get the count scopes of a case, i.e. its org,
+-- assigned partner and labels
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_count_scopes(_case cases_case) RETURNS TEXT[] AS $$
+BEGIN
+  RETURN ARRAY['org:' || _case.org_id, 'partner:' || _case.assignee_id]
+      || ARRAY(SELECT 'label:' || l FROM unnest(_case.label_ids) l);
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Trigger function to maintain open and closed case counts
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_case_on_change() RETURNS TRIGGER AS $$
+BEGIN
+  -- remove the old state of the case from its old scopes
+  IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+    INSERT INTO statistics_totalcount("item_type", "scope", "count")
+    SELECT cases_count_type(OLD), s, -1 FROM unnest(cases_count_scopes(OLD)) s;
+  END IF;
+
+  -- and add the new state to its new scopes
+  IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+    INSERT INTO statistics_totalcount("item_type", "scope", "count")
+    SELECT cases_count_type(NEW), s, 1 FROM unnest(cases_count_scopes(NEW)) s;
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Trigger function to clear case counts on truncate
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION cases_case_on_truncate() RETURNS TRIGGER AS $$
+BEGIN
+  DELETE FROM statistics_totalcount WHERE "item_type" IN ('O', 'X');
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- install for INSERT and DELETE on cases_case
+DROP TRIGGER IF EXISTS cases_case_on_insert_or_delete_trg ON cases_case;
+CREATE TRIGGER cases_case_on_insert_or_delete_trg
+   AFTER INSERT OR DELETE ON cases_case
+   FOR EACH ROW EXECUTE PROCEDURE cases_case_on_change();
+
+-- install for UPDATE on cases_case, only when the case moves between counts
+DROP TRIGGER IF EXISTS cases_case_on_update_trg ON cases_case;
+CREATE TRIGGER cases_case_on_update_trg
+   AFTER UPDATE OF closed_on, assignee_id, label_ids ON cases_case
+   FOR EACH ROW WHEN (
+     (OLD.closed_on IS NULL) != (NEW.closed_on IS NULL)
+     OR OLD.assignee_id != NEW.assignee_id
+     OR OLD.label_ids != NEW.label_ids
+   )
+   EXECUTE PROCEDURE cases_case_on_change();
+
+-- install for TRUNCATE on cases_case
+DROP TRIGGER IF EXISTS cases_case_on_truncate_trg ON cases_case;
+CREATE TRIGGER cases_case_on_truncate_trg
+   AFTER TRUNCATE ON cases_case
+   FOR EACH STATEMENT EXECUTE PROCEDURE cases_case_on_truncate();
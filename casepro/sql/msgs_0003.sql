@@ -0,0 +1,117 @@
+----------------------------------------------------------------------
+-- Trigger function to maintain label counts. Runs once per statement
+-- and writes one aggregated count row per label and folder.
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION msgs_message_on_change() RETURNS TRIGGER AS $$
+BEGIN
+  WITH deltas AS (
+    SELECT n.id AS message_id,
+      (NOT n.is_archived AND n.is_handled AND n.is_active)::INT - (NOT o.is_archived AND o.is_handled AND o.is_active)::INT AS inbox,
+      (n.is_archived AND n.is_handled AND n.is_active)::INT - (o.is_archived AND o.is_handled AND o.is_active)::INT AS archived
+    FROM msgs_message_old o INNER JOIN msgs_message_new n ON n.id = o.id
+  ),
+  label_deltas AS (
+    SELECT ml.label_id, SUM(d.inbox) AS inbox, SUM(d.archived) AS archived
+    FROM deltas d INNER JOIN msgs_message_labels ml ON ml.message_id = d.message_id
+    WHERE d.inbox != 0 OR d.archived != 0
+    GROUP BY ml.label_id
+  )
+  INSERT INTO statistics_totalcount("item_type", "scope", "count")
+  SELECT 'N', 'label:' || label_id, inbox FROM label_deltas WHERE inbox != 0
+  UNION ALL
+  SELECT 'A', 'label:' || label_id, archived FROM label_deltas WHERE archived != 0;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- install for UPDATE on msgs_message
+DROP TRIGGER IF EXISTS msgs_message_on_change_trg ON msgs_message;
+CREATE TRIGGER msgs_message_on_change_trg
+   AFTER UPDATE ON msgs_message
+   REFERENCING OLD TABLE AS msgs_message_old NEW TABLE AS msgs_message_new
+   FOR EACH STATEMENT EXECUTE PROCEDURE msgs_message_on_change();
+
+----------------------------------------------------------------------
+-- Trigger function to maintain label counts and message.has_labels
+-- when labels are applied. Runs once per statement.
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION msgs_message_labels_on_insert() RETURNS TRIGGER AS $$
+BEGIN
+  UPDATE msgs_message SET has_labels = TRUE
+  WHERE id IN (SELECT message_id FROM msgs_message_labels_new) AND has_labels = FALSE;
+
+  WITH label_counts AS (
+    SELECT ml.label_id,
+      COUNT(*) FILTER (WHERE NOT m.is_archived AND m.is_handled AND m.is_active) AS inbox,
+      COUNT(*) FILTER (WHERE m.is_archived AND m.is_handled AND m.is_active) AS archived
+    FROM msgs_message_labels_new ml INNER JOIN msgs_message m ON m.id = ml.message_id
+    GROUP BY ml.label_id
+  )
+  INSERT INTO statistics_totalcount("item_type", "scope", "count")
+  SELECT 'N', 'label:' || label_id, inbox FROM label_counts WHERE inbox > 0
+  UNION ALL
+  SELECT 'A', 'label:' || label_id, archived FROM label_counts WHERE archived > 0;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Trigger function to maintain label counts and message.has_labels
+-- when labels are removed. Runs once per statement.
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION msgs_message_labels_on_delete() RETURNS TRIGGER AS $$
+BEGIN
+  UPDATE msgs_message m SET has_labels = FALSE
+  WHERE m.id IN (SELECT message_id FROM msgs_message_labels_old) AND m.has_labels = TRUE
+    AND NOT EXISTS (SELECT 1 FROM msgs_message_labels ml WHERE ml.message_id = m.id);
+
+  WITH label_counts AS (
+    SELECT ml.label_id,
+      COUNT(*) FILTER (WHERE NOT m.is_archived AND m.is_handled AND m.is_active) AS inbox,
+      COUNT(*) FILTER (WHERE m.is_archived AND m.is_handled AND m.is_active) AS archived
+    FROM msgs_message_labels_old ml INNER JOIN msgs_message m ON m.id = ml.message_id
+    GROUP BY ml.label_id
+  )
+  INSERT INTO statistics_totalcount("item_type", "scope", "count")
+  SELECT 'N', 'label:' || label_id, -inbox FROM label_counts WHERE inbox > 0
+  UNION ALL
+  SELECT 'A', 'label:' || label_id, -archived FROM label_counts WHERE archived > 0;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Trigger function to maintain message.has_labels on truncate
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION msgs_message_labels_on_truncate() RETURNS TRIGGER AS $$
+BEGIN
+  UPDATE msgs_message SET has_labels = FALSE WHERE has_labels = TRUE;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- replace the old row-level triggers on msgs_message_labels
+DROP TRIGGER IF EXISTS msgs_message_labels_on_change_trg ON msgs_message_labels;
+DROP TRIGGER IF EXISTS msgs_message_labels_on_truncate_trg ON msgs_message_labels;
+DROP FUNCTION IF EXISTS msgs_message_labels_on_change();
+
+-- install for INSERT on msgs_message_labels (transition tables require a trigger per event)
+CREATE TRIGGER msgs_message_labels_on_insert_trg
+   AFTER INSERT ON msgs_message_labels
+   REFERENCING NEW TABLE AS msgs_message_labels_new
+   FOR EACH STATEMENT EXECUTE PROCEDURE msgs_message_labels_on_insert();
+
+-- install for DELETE on msgs_message_labels
+CREATE TRIGGER msgs_message_labels_on_delete_trg
+   AFTER DELETE ON msgs_message_labels
+   REFERENCING OLD TABLE AS msgs_message_labels_old
+   FOR EACH STATEMENT EXECUTE PROCEDURE msgs_message_labels_on_delete();
+
+-- install for TRUNCATE on msgs_message_labels
+CREATE TRIGGER msgs_message_labels_on_truncate_trg
+   AFTER TRUNCATE ON msgs_message_labels
+   FOR EACH STATEMENT EXECUTE PROCEDURE msgs_message_labels_on_truncate();
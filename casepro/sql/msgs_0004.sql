@@ -0,0 +1,64 @@
+----------------------------------------------------------------------
+-- Trigger function to maintain label counts, message.has_labels and
+-- message.label_ids when labels are applied. Runs once per statement.
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION msgs_message_labels_on_insert() RETURNS TRIGGER AS $$
+BEGIN
+  UPDATE msgs_message m SET has_labels = TRUE,
+    label_ids = ARRAY(SELECT ml.label_id FROM msgs_message_labels ml WHERE ml.message_id = m.id ORDER BY ml.label_id)
+  WHERE m.id IN (SELECT message_id FROM msgs_message_labels_new);
+
+  WITH label_counts AS (
+    SELECT ml.label_id,
+      COUNT(*) FILTER (WHERE NOT m.is_archived AND m.is_handled AND m.is_active) AS inbox,
+      COUNT(*) FILTER (WHERE m.is_archived AND m.is_handled AND m.is_active) AS archived
+    FROM msgs_message_labels_new ml INNER JOIN msgs_message m ON m.id = ml.message_id
+    GROUP BY ml.label_id
+  )
+  INSERT INTO statistics_totalcount("item_type", "scope", "count")
+  SELECT 'N', 'label:' || label_id, inbox FROM label_counts WHERE inbox > 0
+  UNION ALL
+  SELECT 'A', 'label:' || label_id, archived FROM label_counts WHERE archived > 0;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Trigger function to maintain label counts, message.has_labels and
+-- message.label_ids when labels are removed. Runs once per statement.
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION msgs_message_labels_on_delete() RETURNS TRIGGER AS $$
+BEGIN
+  UPDATE msgs_message m
+  SET label_ids = ARRAY(SELECT ml.label_id FROM msgs_message_labels ml WHERE ml.message_id = m.id ORDER BY ml.label_id),
+    has_labels = EXISTS(SELECT 1 FROM msgs_message_labels ml WHERE ml.message_id = m.id)
+  WHERE m.id IN (SELECT message_id FROM msgs_message_labels_old);
+
+  WITH label_counts AS (
+    SELECT ml.label_id,
+      COUNT(*) FILTER (WHERE NOT m.is_archived AND m.is_handled AND m.is_active) AS inbox,
+      COUNT(*) FILTER (WHERE m.is_archived AND m.is_handled AND m.is_active) AS archived
+    FROM msgs_message_labels_old ml INNER JOIN msgs_message m ON m.id = ml.message_id
+    GROUP BY ml.label_id
+  )
+  INSERT INTO statistics_totalcount("item_type", "scope", "count")
+  SELECT 'N', 'label:' || label_id, -inbox FROM label_counts WHERE inbox > 0
+  UNION ALL
+  SELECT 'A', 'label:' || label_id, -archived FROM label_counts WHERE archived > 0;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Trigger function to maintain message.has_labels and
+-- message.label_ids on truncate
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION msgs_message_labels_on_truncate() RETURNS TRIGGER AS $$
+BEGIN
+  UPDATE msgs_message SET has_labels = FALSE, label_ids = '{}' WHERE has_labels = TRUE;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
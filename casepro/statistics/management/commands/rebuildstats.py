@@ -0,0 +1,95 @@
+from __future__ import unicode_literals
+
+import time
+
+from dash.orgs.models import Org
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils.timezone import now
+from multiprocessing import Pool
+
+from casepro.statistics import rebuild
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the statistics of an org for a date range from its messages, replies and case actions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('org_id', metavar='ORG', type=int, help="The org to rebuild statistics for")
+        parser.add_argument('--since', type=parse_date, dest='since',
+                            help="The first day to rebuild (YYYY-MM-DD), defaults to when the org was created")
+        parser.add_argument('--until', type=parse_date, dest='until',
+                            help="The day after the last day to rebuild (YYYY-MM-DD), defaults to tomorrow")
+        parser.add_argument('--shard-days', type=int, default=30, dest='shard_days',
+                            help="Number of days calculated by each query")
+        parser.add_argument('--processes', type=int, default=4, dest='processes',
+                            help="Number of processes to calculate shards with")
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False,
+                            help="Report discrepancies with existing statistics without changing them")
+
+    def handle(self, *args, **options):
+        org = Org.objects.filter(pk=options['org_id']).first()
+        if not org:
+            raise CommandError("No such org with id %d" % options['org_id'])
+
+        today = now().astimezone(org.timezone).date()
+        since = options['since'] or org.created_on.astimezone(org.timezone).date()
+        until = options['until'] or today + timedelta(days=1)
+        if since >= until:
+            raise CommandError("Since date must be before until date")
+
+        shards = rebuild.get_shards(since, until, options['shard_days'])
+
+        self.stdout.write("Rebuilding statistics for org '%s' from %s to %s in %d shards..." % (
+            org.name, since.isoformat(), until.isoformat(), len(shards)))
+
+        start = time.time()
+        shard_args = [(org.pk, org.timezone.zone, s[0], s[1]) for s in shards]
+
+        if options['processes'] > 1:
+            # forked processes can't share the parent's database connection
+            connections.close_all()
+
+            pool = Pool(processes=options['processes'])
+            try:
+                results = pool.map(rebuild.calculate_shard_from_args, shard_args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [rebuild.calculate_shard_from_args(a) for a in shard_args]
+
+        daily_counts, second_totals = [], []
+        for shard_daily_counts, shard_second_totals in results:
+            daily_counts += shard_daily_counts
+            second_totals += shard_second_totals
+
+        total_counts = rebuild.calculate_total_counts(org)
+
+        self.stdout.write(" > Calculated %d daily counts, %d second totals and %d total counts in %.1f seconds" % (
+            len(daily_counts), len(second_totals), len(total_counts), time.time() - start))
+
+        if options['dry_run']:
+            self.report_discrepancies(org, since, until, daily_counts, second_totals, total_counts)
+        else:
+            rebuild.swap_in(org, since, until, daily_counts, second_totals, total_counts)
+            self.stdout.write(" > Replaced existing statistics with rebuilt statistics")
+
+    def report_discrepancies(self, org, since, until, daily_counts, second_totals, total_counts):
+        existing_daily, existing_second, existing_total = rebuild.get_existing(org, since, until)
+
+        discrepancies = rebuild.diff_counts(existing_daily, {c[:3]: c[3] for c in daily_counts})
+        discrepancies += rebuild.diff_counts(existing_second, rebuild.aggregate_second_totals(second_totals),
+                                             missing=(0, 0))
+        discrepancies += rebuild.diff_counts(existing_total, {c[:2]: c[2] for c in total_counts})
+
+        for key, existing, rebuilt in discrepancies:
+            self.stdout.write(" > %s: existing=%s rebuilt=%s" % (
+                " ".join([k.isoformat() if hasattr(k, 'isoformat') else k for k in key]), existing, rebuilt))
+
+        self.stdout.write("Found %d discrepancies" % len(discrepancies))
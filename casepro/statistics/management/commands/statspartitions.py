@@ -0,0 +1,84 @@
+from __future__ import unicode_literals
+
+from dash.orgs.models import Org
+from dateutil.relativedelta import relativedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+
+from casepro.statistics import partitions
+from casepro.statistics.models import DailyCount, DailySecondTotalCount
+
+MODELS = (DailyCount, DailySecondTotalCount)
+
+
+class Command(BaseCommand):
+    help = "Converts daily count tables to monthly partitions and maintains them"
+
+    CONVERT = 'convert'
+    MAINTAIN = 'maintain'
+    ACTION_CHOICES = (CONVERT, MAINTAIN)
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=self.ACTION_CHOICES, help="The action to perform")
+        parser.add_argument('--months-ahead', type=int, default=3, dest='months_ahead',
+                            help="Number of months ahead to create partitions for")
+        parser.add_argument('--compact-after', type=int, default=2, dest='compact_after',
+                            help="Number of months after which partitions are compacted")
+
+    def handle(self, *args, **options):
+        action = options['action']
+        months_ahead = options['months_ahead']
+        compact_after = options['compact_after']
+
+        if action == self.CONVERT:
+            for model in MODELS:
+                if partitions.is_partitioned(model):
+                    raise CommandError("Table %s is already partitioned" % model._meta.db_table)
+
+            for model in MODELS:
+                partitions.convert_table(model, months_ahead)
+                self.stdout.write(" > Converted %s to monthly partitions" % model._meta.db_table)
+
+        elif action == self.MAINTAIN:
+            self.do_maintain(months_ahead, compact_after)
+
+    def do_maintain(self, months_ahead, compact_after):
+        this_month = partitions.month_start(now().date())
+
+        # retention applies whether or not tables are partitioned
+        for org in Org.objects.filter(is_active=True).order_by('pk'):
+            retention = org.get_stats_retention()
+            if not retention:
+                continue
+
+            before = this_month - relativedelta(months=retention)
+
+            for model in MODELS:
+                num_deleted = partitions.delete_before(model, org, before)
+                if num_deleted:
+                    self.stdout.write(" > Deleted %d %s rows before %s for org #%d" % (
+                        num_deleted, model._meta.db_table, before.isoformat(), org.pk))
+
+        for model in MODELS:
+            if not partitions.is_partitioned(model):
+                continue
+
+            existing = partitions.get_partitions(model)
+
+            for n in range(months_ahead + 1):
+                month = this_month + relativedelta(months=n)
+                if month not in existing:
+                    name = partitions.create_partition(model, month)
+                    self.stdout.write(" > Created partition %s" % name)
+
+            compact_before = this_month - relativedelta(months=compact_after)
+
+            for month, name in sorted(existing.items()):
+                if month >= compact_before:
+                    continue
+
+                if partitions.drop_partition_if_empty(name):
+                    self.stdout.write(" > Dropped empty partition %s" % name)
+                elif not partitions.is_compacted(name):
+                    partitions.compact_partition(model, name)
+                    self.stdout.write(" > Compacted partition %s" % name)
@@ -47,6 +47,8 @@ class Migration(migrations.Migration):
 
     dependencies = [
         ('statistics', '0001_initial'),
+        ('orgs', '0016_taskstate_is_disabled'),
+        ('msgs', '0046_exports_partner'),
     ]
 
     operations = [
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# existing unsquashed counts can be bucketed from their seconds, squashed counts are left as unknown
+BUCKET_SQL = """
+UPDATE statistics_dailysecondtotalcount
+SET bucket = CASE WHEN seconds <= 1 THEN 0 ELSE LEAST(CEIL(LN(seconds) / LN(1.25)), 100) END
+WHERE "count" = 1;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('statistics', '0011_auto_20170605_0657'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailysecondtotalcount',
+            name='bucket',
+            field=models.SmallIntegerField(
+                default=-1, help_text='The log-scale histogram bucket of the counted durations'),
+        ),
+        migrations.RunSQL(BUCKET_SQL),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('statistics', '0012_dailysecondtotalcount_bucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailycountexport',
+            name='is_recurring',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='dailycountexport',
+            name='previous',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='statistics.DailyCountExport'),
+        ),
+    ]
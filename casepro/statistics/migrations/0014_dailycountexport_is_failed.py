@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('statistics', '0013_dailycountexport_recurring'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailycountexport',
+            name='is_failed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('statistics', '0014_dailycountexport_is_failed'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dailycountexport',
+            name='previous',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='statistics.DailyCountExport'),
+        ),
+    ]
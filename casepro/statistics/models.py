@@ -7,9 +7,10 @@ from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.db import models, connection
 from django.db.models import Sum
+from django.utils import timezone
 from django.utils.functional import SimpleLazyObject
 from django.utils.translation import ugettext_lazy as _
-from math import ceil
+from math import ceil, log
 
 from casepro.cases.models import Partner, CaseAction
 from casepro.msgs.models import Label
@@ -24,6 +25,18 @@ def datetime_to_date(dt, org):
     return dt.astimezone(org.timezone).date()
 
 
+def get_org_scopes(org):
+    """
+    Gets the encoded scopes of the given org and its partners and labels, and a LIKE pattern matching the scopes of its
+    users
+    """
+    scopes = [BaseCount.encode_scope(org)]
+    scopes += [BaseCount.encode_scope(p) for p in Partner.objects.filter(org=org)]
+    scopes += [BaseCount.encode_scope(l) for l in Label.objects.filter(org=org)]
+
+    return scopes, '%s:user:%%' % BaseCount.encode_scope(org)
+
+
 class BaseCount(models.Model):
     """
     Tracks total counts of different items (e.g. replies, messages) in different scopes (e.g. org, user)
@@ -34,6 +47,8 @@ class BaseCount(models.Model):
     TYPE_REPLIES = 'R'
     TYPE_CASE_OPENED = 'C'
     TYPE_CASE_CLOSED = 'D'
+    TYPE_OPEN_CASES = 'O'
+    TYPE_CLOSED_CASES = 'X'
 
     squash_sql = """
         WITH removed as (
@@ -42,6 +57,8 @@ class BaseCount(models.Model):
         INSERT INTO %(table_name)s(%(insert_cols)s, "count")
         VALUES (%(insert_vals)s, GREATEST(0, (SELECT SUM("count") FROM removed)));"""
 
+    sum_fields = ('count',)
+
     item_type = models.CharField(max_length=1, help_text=_("The thing being counted"))
 
     scope = models.CharField(max_length=32, help_text=_("The scope in which it is being counted"))
@@ -144,12 +161,40 @@ class BaseSecondTotal(BaseCount):
             COALESCE((SELECT SUM("seconds") FROM removed), 0)
         );"""
 
+    sum_fields = ('count', 'seconds')
+
+    BUCKET_UNKNOWN = -1  # counts recorded before bucketing was added
+    BUCKET_GROWTH = 1.25  # each bucket covers durations up to 25% longer than the previous one
+    BUCKET_MAX = 100
+
     seconds = models.BigIntegerField()
 
+    bucket = models.SmallIntegerField(default=BUCKET_UNKNOWN,
+                                      help_text=_("The log-scale histogram bucket of the counted durations"))
+
+    @classmethod
+    def get_bucket(cls, seconds):
+        """
+        Gets the histogram bucket for the given duration. Bucket 0 is durations of up to a second, and bucket n is
+        durations between BUCKET_GROWTH^(n-1) and BUCKET_GROWTH^n seconds.
+        """
+        if seconds <= 1:
+            return 0
+        return min(int(ceil(log(seconds) / log(cls.BUCKET_GROWTH))), cls.BUCKET_MAX)
+
+    @classmethod
+    def get_bucket_value(cls, bucket):
+        """
+        Gets the representative duration of the given bucket, i.e. the geometric mean of its bounds
+        """
+        return cls.BUCKET_GROWTH ** (bucket - 0.5) if bucket > 0 else 1
+
     class CountSet(BaseCount.CountSet):
         """
         A queryset of counts which can be aggregated in different ways
         """
+        PERCENTILES = (50, 90, 99)
+
         def average(self):
             """
             Calculates the overall total over a set of counts
@@ -182,6 +227,53 @@ class BaseSecondTotal(BaseCount):
 
             return average_by_scope
 
+        def percentiles(self, percentiles=PERCENTILES):
+            """
+            Calculates the given percentiles of seconds over a set of counts
+            """
+            buckets = self.counts.exclude(bucket=BaseSecondTotal.BUCKET_UNKNOWN)
+            buckets = buckets.values_list('bucket').annotate(total=Sum('count'))
+
+            return self._calculate_percentiles(buckets, percentiles)
+
+        def scope_percentiles(self, percentiles=PERCENTILES):
+            """
+            Calculates the given percentiles of seconds per-scope over a set of counts
+            """
+            buckets = self.counts.exclude(bucket=BaseSecondTotal.BUCKET_UNKNOWN)
+            buckets = list(buckets.values_list('scope', 'bucket').annotate(total=Sum('count')))
+
+            percentiles_by_scope = {}
+            for encoded_scope, scope in six.iteritems(self.scopes):
+                scope_buckets = [(b[1], b[2]) for b in buckets if b[0] == encoded_scope]
+                percentiles_by_scope[scope] = self._calculate_percentiles(scope_buckets, percentiles)
+
+            return percentiles_by_scope
+
+        @staticmethod
+        def _calculate_percentiles(buckets, percentiles):
+            """
+            Calculates percentiles from a histogram of (bucket, count) tuples
+            """
+            buckets = sorted([b for b in buckets if b[1] > 0])
+            total = sum([b[1] for b in buckets])
+
+            values = {}
+            for percentile in percentiles:
+                if not total:
+                    values[percentile] = 0
+                    continue
+
+                rank = ceil(total * percentile / 100.0)
+                cumulative = 0
+                for bucket, count in buckets:
+                    cumulative += count
+                    if cumulative >= rank:
+                        values[percentile] = BaseSecondTotal.get_bucket_value(bucket)
+                        break
+
+            return values
+
         def day_totals(self):
             """
             Calculates per-day totals over a set of counts
@@ -208,6 +300,14 @@ class TotalCount(BaseCount):
     squash_over = ('item_type', 'scope')
     last_squash_key = 'total_count:last_squash'
 
+    @classmethod
+    def get_by_org(cls, orgs, item_type):
+        return cls._get_count_set(item_type, {cls.encode_scope(o): o for o in orgs})
+
+    @classmethod
+    def get_by_partner(cls, partners, item_type):
+        return cls._get_count_set(item_type, {cls.encode_scope(p): p for p in partners})
+
     @classmethod
     def get_by_label(cls, labels, item_type):
         return cls._get_count_set(item_type, {cls.encode_scope(l): l for l in labels})
@@ -240,6 +340,17 @@ class DailyCount(BaseCount):
     def record_removal(cls, day, item_type, *scope_args):
         cls.objects.create(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=-1)
 
+    @classmethod
+    def record_items(cls, item_type, counts):
+        """
+        Records multiple counts with a single insert, where counts is a dict of (day, scope args) tuples to counts. This
+        allows bulk operations to record one row per day and scope rather than one row per item.
+        """
+        cls.objects.bulk_create([
+            cls(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=count)
+            for (day, scope_args), count in six.iteritems(counts) if count
+        ])
+
     @classmethod
     def get_by_org(cls, orgs, item_type, since=None, until=None):
         return cls._get_count_set(item_type, {cls.encode_scope(o): o for o in orgs}, since, until)
@@ -306,8 +417,19 @@ class DailyCountExport(BaseExport):
     download_view = 'statistics.dailycountexport_read'
 
     @classmethod
-    def create(cls, org, user, of_type, since, until):
-        return cls.objects.create(org=org, created_by=user, type=of_type, since=since, until=until)
+    def create(cls, org, user, of_type, since, until, is_recurring=False):
+        return cls.objects.create(org=org, created_by=user, type=of_type, since=since, until=until,
+                                  is_recurring=is_recurring)
+
+    def create_next(self):
+        # next run covers the days from the end of this one until yesterday, as today's counts aren't final
+        since = self.until
+        until = datetime_to_date(timezone.now(), self.org)
+        if since >= until:
+            return None
+
+        return DailyCountExport.objects.create(org=self.org, created_by=self.created_by, type=self.type,
+                                               since=since, until=until, is_recurring=True, previous=self)
 
     def render_book(self, book):
         if self.type == self.TYPE_LABEL:
@@ -426,12 +548,13 @@ class DailySecondTotalCount(BaseSecondTotal):
 
     day = models.DateField(help_text=_("The day this count is for"))
 
-    squash_over = ('day', 'item_type', 'scope')
+    squash_over = ('day', 'item_type', 'scope', 'bucket')
     last_squash_key = 'daily_second_total_count:last_squash'
 
     @classmethod
     def record_item(cls, day, seconds, item_type, *scope_args):
-        cls.objects.create(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=1, seconds=seconds)
+        cls.objects.create(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=1, seconds=seconds,
+                           bucket=cls.get_bucket(seconds))
 
     @classmethod
     def get_by_org(cls, orgs, item_type, since=None, until=None):
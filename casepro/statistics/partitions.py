@@ -0,0 +1,184 @@
+"""
+Optional monthly range partitioning of the daily count tables, and retention of old counts. Converting a table is
+opt-in (see the statspartitions command) and requires PostgreSQL 11+ for default partitions and indexes on partitioned
+tables. Queries filtering on day, as all daily count queries do, are then pruned to the partitions covering that range.
+"""
+from __future__ import unicode_literals
+
+import re
+
+from datetime import date
+from dateutil.relativedelta import relativedelta
+from django.db import connection, transaction
+
+from .models import get_org_scopes
+
+DEFAULT_SUFFIX = 'default'
+
+PARTITION_NAME_REGEX = re.compile(r'_y(\d{4})m(\d{2})$')
+
+INDEX_COLS = ('item_type', 'scope', 'day')
+
+
+def is_partitioned(model):
+    """
+    Gets whether the table of the given model has been converted to a partitioned table
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", [model._meta.db_table])
+        row = cursor.fetchone()
+
+    return row is not None and row[0] == 'p'
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def partition_name(model, month):
+    return '%s_y%04dm%02d' % (model._meta.db_table, month.year, month.month)
+
+
+def get_partitions(model):
+    """
+    Gets the month partitions of the given model's table as a dict of month start dates to partition names
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.relname FROM pg_inherits i
+            INNER JOIN pg_class c ON c.oid = i.inhrelid
+            INNER JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = %s""", [model._meta.db_table])
+        names = [r[0] for r in cursor.fetchall()]
+
+    partitions = {}
+    for name in names:
+        match = PARTITION_NAME_REGEX.search(name)
+        if match:
+            partitions[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return partitions
+
+
+def create_partition(model, month):
+    """
+    Creates the partition for the given month, moving any rows for that month out of the default partition
+    """
+    table = model._meta.db_table
+    name = partition_name(model, month)
+    default = '%s_%s' % (table, DEFAULT_SUFFIX)
+    bounds = [month, month + relativedelta(months=1)]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SELECT EXISTS(SELECT 1 FROM "%s" WHERE "day" >= %%s AND "day" < %%s)' % default, bounds)
+        has_rows = cursor.fetchone()[0]
+
+        if has_rows:
+            cursor.execute('ALTER TABLE "%s" DETACH PARTITION "%s"' % (table, default))
+
+        cursor.execute('CREATE TABLE "%s" PARTITION OF "%s" FOR VALUES FROM (%%s) TO (%%s)' % (name, table), bounds)
+
+        if has_rows:
+            cursor.execute("""
+                WITH moved AS (DELETE FROM "%s" WHERE "day" >= %%s AND "day" < %%s RETURNING *)
+                INSERT INTO "%s" SELECT * FROM moved""" % (default, name), bounds)
+            cursor.execute('ALTER TABLE "%s" ATTACH PARTITION "%s" DEFAULT' % (table, default))
+
+    return name
+
+
+def convert_table(model, months_ahead):
+    """
+    Converts the given model's table to a table partitioned by month on day, with partitions for every month from
+    the earliest existing count to months_ahead months from now, and a default partition for anything else.
+    """
+    table = model._meta.db_table
+    old_table = '%s_unpartitioned' % table
+    index_cols = ', '.join(['"%s"' % f for f in INDEX_COLS])
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SELECT MIN("day") FROM "%s"' % table)
+        earliest = cursor.fetchone()[0] or date.today()
+
+        cursor.execute('ALTER TABLE "%s" RENAME TO "%s"' % (table, old_table))
+        cursor.execute('CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS) PARTITION BY RANGE ("day")' % (
+            table, old_table))
+        cursor.execute('ALTER TABLE "%s" ADD PRIMARY KEY ("id", "day")' % table)
+        cursor.execute('CREATE INDEX "%s_partitioned_idx" ON "%s" (%s)' % (table, table, index_cols))
+        cursor.execute('CREATE TABLE "%s_%s" PARTITION OF "%s" DEFAULT' % (table, DEFAULT_SUFFIX, table))
+
+        month = month_start(earliest)
+        last = month_start(date.today()) + relativedelta(months=months_ahead)
+        while month <= last:
+            create_partition(model, month)
+            month += relativedelta(months=1)
+
+        cursor.execute('INSERT INTO "%s" SELECT * FROM "%s"' % (table, old_table))
+        cursor.execute('ALTER SEQUENCE "%s_id_seq" OWNED BY "%s"."id"' % (table, table))
+        cursor.execute('DROP TABLE "%s"' % old_table)
+
+
+def is_compacted(name):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT obj_description(%s::regclass, 'pg_class')", [name])
+        return cursor.fetchone()[0] == 'compacted'
+
+
+def compact_partition(model, name):
+    """
+    Squashes all counts in the given partition to one row per squash key, then rewrites the partition to reclaim the
+    space left by squashing. Squashing keeps the lowest id of each key so that it isn't picked up again by the regular
+    squash task. Partitions are marked once compacted so they aren't rewritten again.
+    """
+    key_cols = ['"%s"' % f for f in model.squash_over]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("""
+            WITH totals AS (
+                SELECT MIN("id") AS "id", %(keys)s, %(sums)s FROM "%(name)s" GROUP BY %(keys)s HAVING COUNT(*) > 1
+            ),
+            updated AS (
+                UPDATE "%(name)s" t SET %(sets)s FROM totals s WHERE t."id" = s."id"
+            )
+            DELETE FROM "%(name)s" t USING totals s WHERE %(key_cond)s AND t."id" <> s."id";""" % {
+            'name': name,
+            'keys': ", ".join(key_cols),
+            'sums': ", ".join(['SUM("%s") AS "%s"' % (f, f) for f in model.sum_fields]),
+            'sets': ", ".join(['"%s" = s."%s"' % (f, f) for f in model.sum_fields]),
+            'key_cond': " AND ".join(['t.%s = s.%s' % (c, c) for c in key_cols]),
+        })
+        cursor.execute("COMMENT ON TABLE \"%s\" IS 'compacted'" % name)
+
+    vacuum_partition(name)
+
+
+def vacuum_partition(name):
+    """
+    Rewrites the given partition to reclaim space. VACUUM can't be run inside a transaction.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('VACUUM FULL ANALYZE "%s"' % name)
+
+
+def drop_partition_if_empty(name):
+    """
+    Drops the given partition if retention has left it without any rows
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SELECT EXISTS(SELECT 1 FROM "%s")' % name)
+        if cursor.fetchone()[0]:
+            return False
+
+        cursor.execute('DROP TABLE "%s"' % name)
+        return True
+
+
+def delete_before(model, org, before):
+    """
+    Deletes the counts in all scopes of the given org for days before the given date
+    """
+    scopes, user_scopes = get_org_scopes(org)
+
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM "%s" WHERE "day" < %%s AND ("scope" = ANY(%%s) OR "scope" LIKE %%s)' % (
+            model._meta.db_table), [before, scopes, user_scopes])
+        return cursor.rowcount
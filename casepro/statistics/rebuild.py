@@ -0,0 +1,297 @@
+"""
+Rebuilding of statistics from the source tables, for when counts have been missed or recorded incorrectly. Daily counts
+are calculated by set-based queries over shards of days, which can be run in parallel as each shard is independent.
+"""
+from __future__ import unicode_literals
+
+import pytz
+
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from django.db import connection, transaction
+from django.db.models import Q, Sum
+
+from .models import get_org_scopes, BaseSecondTotal, DailyCount, DailySecondTotalCount, TotalCount
+
+DAILY_COUNT_TYPES = (DailyCount.TYPE_INCOMING, DailyCount.TYPE_REPLIES, DailyCount.TYPE_CASE_OPENED,
+                     DailyCount.TYPE_CASE_CLOSED)
+SECOND_TOTAL_TYPES = (DailySecondTotalCount.TYPE_TILL_REPLIED, DailySecondTotalCount.TYPE_TILL_CLOSED)
+TOTAL_COUNT_TYPES = (TotalCount.TYPE_INBOX, TotalCount.TYPE_ARCHIVED, TotalCount.TYPE_OPEN_CASES,
+                     TotalCount.TYPE_CLOSED_CASES)
+
+BUCKET_SQL = '(CASE WHEN t.seconds <= 1 THEN 0 ELSE LEAST(CEIL(LN(t.seconds) / LN(%s)), %d) END)::INT' % (
+    BaseSecondTotal.BUCKET_GROWTH, BaseSecondTotal.BUCKET_MAX)
+
+DAY_SQL = '(%s AT TIME ZONE %%(tz)s)::date'
+
+# the first close of each case, as later closes follow a reopen and aren't counted
+FIRST_CLOSES_SQL = """
+first_closes AS (
+  SELECT a.case_id, a.created_by_id, a.created_on, c.opened_on, %(action_day)s AS day, COALESCE((
+    SELECT x.assignee_id FROM cases_caseaction x
+    WHERE x.case_id = a.case_id AND x.action IN ('O', 'A') AND x.created_on <= a.created_on
+    ORDER BY x.created_on DESC LIMIT 1
+  ), c.assignee_id) AS partner_id
+  FROM cases_caseaction a INNER JOIN cases_case c ON c.id = a.case_id
+  WHERE c.org_id = %%(org)s AND a.action = 'C' AND a.created_on >= %%(start)s AND a.created_on < %%(end)s
+    AND NOT EXISTS (
+      SELECT 1 FROM cases_caseaction e WHERE e.case_id = a.case_id AND e.action = 'C' AND e.created_on < a.created_on
+    )
+)"""
+
+# daily counts of incoming messages, replies and opened and closed cases as (day, item_type, scope, count)
+DAILY_COUNTS_SQL = """
+WITH %(first_closes)s,
+incoming AS (
+  SELECT m.id, %(msg_day)s AS day FROM msgs_message m
+  WHERE m.org_id = %%(org)s AND m.created_on >= %%(start)s AND m.created_on < %%(end)s
+),
+replies AS (
+  SELECT %(reply_day)s AS day, o.created_by_id, o.partner_id FROM msgs_outgoing o
+  WHERE o.org_id = %%(org)s AND o.activity IN ('B', 'C') AND o.created_on >= %%(start)s AND o.created_on < %%(end)s
+),
+opens AS (
+  SELECT %(action_day)s AS day, a.created_by_id, a.assignee_id AS partner_id FROM cases_caseaction a
+  INNER JOIN cases_case c ON c.id = a.case_id
+  WHERE c.org_id = %%(org)s AND a.action = 'O' AND a.created_on >= %%(start)s AND a.created_on < %%(end)s
+)
+SELECT day, 'I', 'org:' || %%(org)s, COUNT(*) FROM incoming GROUP BY day
+UNION ALL
+SELECT i.day, 'I', 'label:' || ml.label_id, COUNT(*) FROM incoming i
+INNER JOIN msgs_message_labels ml ON ml.message_id = i.id GROUP BY i.day, ml.label_id
+UNION ALL
+SELECT day, 'R', 'org:' || %%(org)s, COUNT(*) FROM replies GROUP BY day
+UNION ALL
+SELECT day, 'R', 'org:' || %%(org)s || ':user:' || created_by_id, COUNT(*) FROM replies GROUP BY day, created_by_id
+UNION ALL
+SELECT day, 'R', 'partner:' || partner_id, COUNT(*) FROM replies WHERE partner_id IS NOT NULL GROUP BY day, partner_id
+UNION ALL
+SELECT day, 'C', 'org:' || %%(org)s, COUNT(*) FROM opens GROUP BY day
+UNION ALL
+SELECT day, 'C', 'org:' || %%(org)s || ':user:' || created_by_id, COUNT(*) FROM opens GROUP BY day, created_by_id
+UNION ALL
+SELECT day, 'C', 'partner:' || partner_id, COUNT(*) FROM opens GROUP BY day, partner_id
+UNION ALL
+SELECT day, 'D', 'org:' || %%(org)s, COUNT(*) FROM first_closes GROUP BY day
+UNION ALL
+SELECT day, 'D', 'org:' || %%(org)s || ':user:' || created_by_id, COUNT(*) FROM first_closes GROUP BY day, created_by_id
+UNION ALL
+SELECT day, 'D', 'partner:' || partner_id, COUNT(*) FROM first_closes GROUP BY day, partner_id
+"""
+
+# time till closed and time till first replied as (day, item_type, scope, bucket, count, seconds)
+SECOND_TOTALS_SQL = """
+WITH %(first_closes)s,
+closed_times AS (
+  SELECT day, 'org:' || %%(org)s AS scope, CEIL(EXTRACT(EPOCH FROM created_on - opened_on))::BIGINT AS seconds
+  FROM first_closes
+  UNION ALL
+  SELECT day, 'partner:' || partner_id, CEIL(EXTRACT(EPOCH FROM created_on - COALESCE((
+    SELECT MAX(r.created_on) FROM cases_caseaction r
+    WHERE r.case_id = f.case_id AND r.action = 'A' AND r.assignee_id = f.partner_id AND r.created_on < f.created_on
+  ), opened_on)))::BIGINT
+  FROM first_closes f
+  WHERE EXISTS (
+    SELECT 1 FROM cases_partner_users pu WHERE pu.partner_id = f.partner_id AND pu.user_id = f.created_by_id
+  )
+),
+first_replies AS (
+  SELECT %(reply_day)s AS day, CEIL(EXTRACT(EPOCH FROM o.created_on - c.opened_on))::BIGINT AS seconds
+  FROM msgs_outgoing o INNER JOIN cases_case c ON c.id = o.case_id
+  WHERE o.org_id = %%(org)s AND o.activity IN ('B', 'C') AND o.created_on >= %%(start)s AND o.created_on < %%(end)s
+    AND NOT EXISTS (
+      SELECT 1 FROM msgs_outgoing e
+      WHERE e.case_id = o.case_id AND e.activity IN ('B', 'C') AND e.created_on < o.created_on
+    )
+),
+assignments AS (
+  SELECT a.case_id, a.assignee_id, a.created_by_id, a.created_on,
+    LEAD(a.created_on) OVER (PARTITION BY a.case_id ORDER BY a.created_on) AS ended_on
+  FROM cases_caseaction a INNER JOIN cases_case c ON c.id = a.case_id
+  WHERE c.org_id = %%(org)s AND a.action IN ('O', 'A') AND a.created_on < %%(end)s
+),
+assignee_replies AS (
+  SELECT s.assignee_id, s.created_on AS assigned_on, (
+    SELECT MIN(o.created_on) FROM msgs_outgoing o
+    WHERE o.case_id = s.case_id AND o.partner_id = s.assignee_id AND o.activity IN ('B', 'C')
+      AND o.created_on >= s.created_on AND (s.ended_on IS NULL OR o.created_on < s.ended_on)
+  ) AS created_on
+  FROM assignments s
+  WHERE NOT EXISTS (
+    SELECT 1 FROM cases_partner_users pu WHERE pu.partner_id = s.assignee_id AND pu.user_id = s.created_by_id
+  )
+),
+replied_times AS (
+  SELECT day, 'org:' || %%(org)s AS scope, seconds FROM first_replies
+  UNION ALL
+  SELECT %(assignee_reply_day)s, 'partner:' || r.assignee_id,
+    CEIL(EXTRACT(EPOCH FROM r.created_on - r.assigned_on))::BIGINT
+  FROM assignee_replies r WHERE r.created_on >= %%(start)s AND r.created_on < %%(end)s
+)
+SELECT day, 'C', scope, %(bucket)s AS bucket, COUNT(*), SUM(seconds) FROM closed_times t
+GROUP BY day, scope, bucket
+UNION ALL
+SELECT day, 'A', scope, %(bucket)s AS bucket, COUNT(*), SUM(seconds) FROM replied_times t
+GROUP BY day, scope, bucket
+"""
+
+# label totals of messages in the inbox and archived, and org, partner and label totals of open and closed cases as
+# (item_type, scope, count)
+TOTAL_COUNTS_SQL = """
+WITH label_counts AS (
+  SELECT ml.label_id,
+    COUNT(*) FILTER (WHERE NOT m.is_archived AND m.is_handled AND m.is_active) AS inbox,
+    COUNT(*) FILTER (WHERE m.is_archived AND m.is_handled AND m.is_active) AS archived
+  FROM msgs_message_labels ml INNER JOIN msgs_message m ON m.id = ml.message_id
+  WHERE m.org_id = %(org)s
+  GROUP BY ml.label_id
+)
+SELECT 'N', 'label:' || label_id, inbox FROM label_counts WHERE inbox > 0
+UNION ALL
+SELECT 'A', 'label:' || label_id, archived FROM label_counts WHERE archived > 0
+UNION ALL
+SELECT cases_count_type(c), s, COUNT(*) FROM cases_case c, unnest(cases_count_scopes(c)) s
+WHERE c.org_id = %(org)s
+GROUP BY 1, 2
+"""
+
+DAY_COLUMNS = {
+    'msg_day': DAY_SQL % 'm.created_on',
+    'reply_day': DAY_SQL % 'o.created_on',
+    'action_day': DAY_SQL % 'a.created_on',
+    'assignee_reply_day': DAY_SQL % 'r.created_on',
+}
+
+SHARD_SQL_ARGS = dict(first_closes=FIRST_CLOSES_SQL % DAY_COLUMNS, bucket=BUCKET_SQL, **DAY_COLUMNS)
+
+
+def get_scope_filter(scopes, user_scopes):
+    """
+    Gets a query filter for counts in the given scopes or matching the given user scope pattern
+    """
+    return Q(scope__in=scopes) | Q(scope__startswith=user_scopes.rstrip('%'))
+
+
+def get_shards(since, until, shard_days):
+    """
+    Splits the given date range into shards of the given number of days
+    """
+    shards = []
+    start = since
+    while start < until:
+        end = min(start + timedelta(days=shard_days), until)
+        shards.append((start, end))
+        start = end
+    return shards
+
+
+def calculate_shard(org_id, tz_name, since, until):
+    """
+    Calculates the daily counts and second totals for the days of the given org in [since, until)
+    """
+    tz = pytz.timezone(tz_name)
+    params = {
+        'org': org_id,
+        'tz': tz_name,
+        'start': tz.localize(datetime.combine(since, time.min)),
+        'end': tz.localize(datetime.combine(until, time.min)),
+    }
+
+    with connection.cursor() as cursor:
+        cursor.execute(DAILY_COUNTS_SQL % SHARD_SQL_ARGS, params)
+        daily_counts = cursor.fetchall()
+
+        cursor.execute(SECOND_TOTALS_SQL % SHARD_SQL_ARGS, params)
+        second_totals = cursor.fetchall()
+
+    return daily_counts, second_totals
+
+
+def calculate_shard_from_args(args):
+    """
+    Wrapper of calculate_shard for use with a process pool
+    """
+    return calculate_shard(*args)
+
+
+def calculate_total_counts(org):
+    with connection.cursor() as cursor:
+        cursor.execute(TOTAL_COUNTS_SQL, {'org': org.pk})
+        return cursor.fetchall()
+
+
+def get_existing(org, since, until):
+    """
+    Gets the existing daily counts, second totals and total counts of the given org, aggregated by the same keys as
+    the rebuilt values so they can be compared
+    """
+    scopes, user_scopes = get_org_scopes(org)
+
+    daily_counts = DailyCount.objects.filter(day__gte=since, day__lt=until, item_type__in=DAILY_COUNT_TYPES)
+    daily_counts = daily_counts.filter(get_scope_filter(scopes, user_scopes))
+    daily_counts = daily_counts.values_list('day', 'item_type', 'scope').annotate(total=Sum('count'))
+
+    second_totals = DailySecondTotalCount.objects.filter(day__gte=since, day__lt=until,
+                                                         item_type__in=SECOND_TOTAL_TYPES)
+    second_totals = second_totals.filter(get_scope_filter(scopes, user_scopes))
+    second_totals = second_totals.values_list('day', 'item_type', 'scope').annotate(
+        total=Sum('count'), seconds=Sum('seconds'))
+
+    total_counts = TotalCount.objects.filter(item_type__in=TOTAL_COUNT_TYPES, scope__in=scopes)
+    total_counts = total_counts.values_list('item_type', 'scope').annotate(total=Sum('count'))
+
+    return (
+        {c[:3]: c[3] for c in daily_counts},
+        {c[:3]: tuple(c[3:]) for c in second_totals},
+        {c[:2]: c[2] for c in total_counts}
+    )
+
+
+def diff_counts(existing, rebuilt, missing=0):
+    """
+    Compares existing and rebuilt values by key, returning a sorted list of (key, existing, rebuilt) discrepancies
+    """
+    discrepancies = []
+    for key in set(existing.keys()) | set(rebuilt.keys()):
+        existing_val, rebuilt_val = existing.get(key, missing), rebuilt.get(key, missing)
+        if existing_val != rebuilt_val:
+            discrepancies.append((key, existing_val, rebuilt_val))
+    return sorted(discrepancies, key=lambda d: d[0])
+
+
+def aggregate_second_totals(second_totals):
+    """
+    Aggregates rebuilt second totals over buckets for comparison with existing values
+    """
+    totals = defaultdict(lambda: (0, 0))
+    for day, item_type, scope, bucket, count, seconds in second_totals:
+        current = totals[(day, item_type, scope)]
+        totals[(day, item_type, scope)] = (current[0] + count, current[1] + seconds)
+    return dict(totals)
+
+
+def swap_in(org, since, until, daily_counts, second_totals, total_counts):
+    """
+    Replaces the existing counts of the given org and date range with rebuilt ones in a single transaction
+    """
+    scopes, user_scopes = get_org_scopes(org)
+
+    with transaction.atomic():
+        DailyCount.objects.filter(day__gte=since, day__lt=until, item_type__in=DAILY_COUNT_TYPES).filter(
+            get_scope_filter(scopes, user_scopes)).delete()
+        DailySecondTotalCount.objects.filter(day__gte=since, day__lt=until, item_type__in=SECOND_TOTAL_TYPES).filter(
+            get_scope_filter(scopes, user_scopes)).delete()
+        TotalCount.objects.filter(item_type__in=TOTAL_COUNT_TYPES, scope__in=scopes).delete()
+
+        DailyCount.objects.bulk_create([
+            DailyCount(day=day, item_type=item_type, scope=scope, count=count)
+            for day, item_type, scope, count in daily_counts
+        ])
+        DailySecondTotalCount.objects.bulk_create([
+            DailySecondTotalCount(day=day, item_type=item_type, scope=scope, bucket=bucket, count=count,
+                                  seconds=seconds)
+            for day, item_type, scope, bucket, count, seconds in second_totals
+        ])
+        TotalCount.objects.bulk_create([
+            TotalCount(item_type=item_type, scope=scope, count=count) for item_type, scope, count in total_counts
+        ])
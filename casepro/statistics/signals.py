@@ -4,7 +4,7 @@ from django.db.models.signals import post_save, m2m_changed
 from django.dispatch import receiver
 from math import ceil
 
-from casepro.cases.models import CaseAction
+from casepro.cases.models import Case, CaseAction
 from casepro.msgs.models import Message, Label, Outgoing
 
 from .models import datetime_to_date, DailyCount, DailySecondTotalCount, record_case_closed_time
@@ -42,48 +42,42 @@ def record_new_outgoing(sender, instance, created, **kwargs):
             DailyCount.record_item(day, DailyCount.TYPE_REPLIES, partner)
 
         if case:
-            # count the very first response on an org level
-            if instance == case.outgoing_messages.earliest('created_on'):
+            # count the very first response on an org level, the conditional update ensures only one reply wins
+            if Case.objects.filter(pk=case.pk, first_reply_on=None).update(first_reply_on=instance.created_on):
                 td = instance.created_on - case.opened_on
                 seconds_since_open = ceil(td.total_seconds())
                 DailySecondTotalCount.record_item(day, seconds_since_open,
                                                   DailySecondTotalCount.TYPE_TILL_REPLIED, org)
-            if case.assignee == partner:
-                # count the first response by this partner
-                if instance == case.outgoing_messages.filter(partner=partner).earliest('created_on'):
-                    author_action = case.actions.filter(action=CaseAction.OPEN).order_by('created_on').first()
-                    reassign_action = case.actions.filter(
-                        action=CaseAction.REASSIGN, assignee=partner).order_by('created_on').first()
-
-                    # don't count self-assigned cases
-                    if author_action and author_action.created_by.get_partner(org) != partner:
-                        # only count the time since this case was (re)assigned to this partner
-                        # or cases that were assigned during creation by another partner
-                        if reassign_action:
-                            start_date = reassign_action.created_on
-                        else:
-                            start_date = author_action.created_on
-
-                        td = instance.created_on - start_date
-                        seconds_since_open = ceil(td.total_seconds())
-                        DailySecondTotalCount.record_item(
-                            day, seconds_since_open,
-                            DailySecondTotalCount.TYPE_TILL_REPLIED, partner)
+
+            # count the first response by this partner since the case was assigned to them by another partner
+            if partner and case.assignee_id == partner.pk and case.assigned_on:
+                first_reply = Case.objects.filter(pk=case.pk, assignee=partner, assignee_replied_on=None).update(
+                    assignee_replied_on=instance.created_on)
+                if first_reply:
+                    td = instance.created_on - case.assigned_on
+                    seconds_since_assigned = ceil(td.total_seconds())
+                    DailySecondTotalCount.record_item(day, seconds_since_assigned,
+                                                      DailySecondTotalCount.TYPE_TILL_REPLIED, partner)
 
 
 @receiver(m2m_changed, sender=Message.labels.through)
 def record_incoming_labelling(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    Records label counts for labels added to or removed from a single message. Bulk labelling operations bypass this
+    signal and record their counts in aggregate via Message.apply_label and Message.remove_label.
+    """
     day = datetime_to_date(instance.created_on, instance.org)
 
     if action == 'post_add':
-        for label_id in pk_set:
-            DailyCount.record_item(day, DailyCount.TYPE_INCOMING, Label(pk=label_id))
+        counts = {(day, (Label(pk=label_id),)): 1 for label_id in pk_set}
     elif action == 'post_remove':
-        for label_id in pk_set:
-            DailyCount.record_removal(day, DailyCount.TYPE_INCOMING, Label(pk=label_id))
+        counts = {(day, (Label(pk=label_id),)): -1 for label_id in pk_set}
     elif action == 'pre_clear':
-        for label in instance.labels.all():
-            DailyCount.record_removal(day, DailyCount.TYPE_INCOMING, label)
+        counts = {(day, (Label(pk=label_id),)): -1 for label_id in instance.labels.values_list('pk', flat=True)}
+    else:
+        return
+
+    DailyCount.record_items(DailyCount.TYPE_INCOMING, counts)
 
 
 @receiver(post_save, sender=CaseAction)
@@ -25,3 +25,16 @@ def daily_count_export(export_id):
     logger.info("Starting daily count export #%d..." % export_id)
 
     DailyCountExport.objects.get(pk=export_id).do_export()
+
+
+@shared_task
+def rerun_daily_count_exports():
+    """
+    Task to start the next runs of recurring daily count exports
+    """
+    from .models import DailyCountExport
+
+    for export in DailyCountExport.get_recurring():
+        next_run = export.rerun()
+        if next_run:
+            daily_count_export.delay(next_run.pk)
@@ -2,21 +2,33 @@ from __future__ import unicode_literals
 
 import pytz
 import random
+import six
 
 from dash.orgs.models import Org
 from datetime import date, datetime, time
+from dateutil.relativedelta import relativedelta
+from django.core.management import call_command, CommandError
 from django.core.urlresolvers import reverse
 from django.test.utils import override_settings
+from django.db import connection
+from django.db.models import Sum
 from django.utils import timezone
 from mock import patch
 
-from casepro.msgs.models import Outgoing
+from casepro.msgs.models import Message, Outgoing
 from casepro.test import BaseCasesTest
 from casepro.utils import date_to_milliseconds
 from casepro.cases.models import Case
 
+from . import partitions
 from .models import DailyCount, DailyCountExport, DailySecondTotalCount
-from .tasks import squash_counts
+from .tasks import rerun_daily_count_exports, squash_counts
+
+
+def count_rows(table):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM "%s"' % table)
+        return cursor.fetchone()[0]
 
 
 class BaseStatsTest(BaseCasesTest):
@@ -171,6 +183,180 @@ class DailyCountsTest(BaseStatsTest):
         self.assertEqual(DailyCount.get_by_label([self.aids], 'I').day_totals(), [(date(2015, 1, 1), 0)])
         self.assertEqual(DailyCount.get_by_label([self.tea], 'I').day_totals(), [(date(2015, 1, 1), 0)])
 
+    def test_bulk_labelling_counts(self):
+        msgs = self.new_messages(date(2015, 1, 1), 3) + self.new_messages(date(2015, 1, 2), 2)
+
+        Message.bulk_label(self.unicef, self.admin, msgs, self.tea)
+
+        # should have a single count row per day rather than one per message
+        self.assertEqual(DailyCount.objects.filter(scope='label:%d' % self.tea.pk).count(), 2)
+        self.assertEqual(DailyCount.get_by_label([self.tea], 'I').day_totals(), [
+            (date(2015, 1, 1), 3), (date(2015, 1, 2), 2)
+        ])
+
+        # re-labelling already labelled messages doesn't change counts
+        Message.bulk_label(self.unicef, self.admin, msgs, self.tea)
+
+        self.assertEqual(DailyCount.objects.filter(scope='label:%d' % self.tea.pk).count(), 2)
+
+        Message.bulk_unlabel(self.unicef, self.admin, msgs[:2] + msgs[3:4], self.tea)
+
+        self.assertEqual(DailyCount.objects.filter(scope='label:%d' % self.tea.pk).count(), 4)
+        self.assertEqual(DailyCount.get_by_label([self.tea], 'I').day_totals(), [
+            (date(2015, 1, 1), 1), (date(2015, 1, 2), 1)
+        ])
+
+    def test_retention(self):
+        old_day = date(2015, 1, 1)
+        today = timezone.now().date()
+
+        DailyCount.record_item(old_day, DailyCount.TYPE_INCOMING, self.unicef)
+        DailyCount.record_item(old_day, DailyCount.TYPE_REPLIES, self.unicef, self.user1)
+        DailyCount.record_item(old_day, DailyCount.TYPE_REPLIES, self.moh)
+        DailyCount.record_item(old_day, DailyCount.TYPE_INCOMING, self.aids)
+        DailyCount.record_item(old_day, DailyCount.TYPE_INCOMING, self.nyaruka)
+        DailyCount.record_item(today, DailyCount.TYPE_INCOMING, self.unicef)
+        DailySecondTotalCount.record_item(old_day, 10, DailySecondTotalCount.TYPE_TILL_REPLIED, self.unicef)
+
+        # no retention configured so nothing is deleted
+        call_command('statspartitions', 'maintain')
+        self.assertEqual(DailyCount.objects.count(), 6)
+
+        self.unicef.set_stats_retention(12)
+
+        call_command('statspartitions', 'maintain')
+
+        # only old counts for unicef are deleted
+        self.assertEqual(DailyCount.get_by_org([self.unicef], DailyCount.TYPE_INCOMING).total(), 1)
+        self.assertEqual(DailyCount.get_by_org([self.nyaruka], DailyCount.TYPE_INCOMING).total(), 1)
+        self.assertEqual(DailyCount.objects.count(), 2)
+        self.assertEqual(DailySecondTotalCount.objects.count(), 0)
+
+    def test_partitions_convert(self):
+        this_month = partitions.month_start(timezone.now().date())
+        old_month = this_month - relativedelta(months=2)
+
+        DailyCount.record_item(old_month, DailyCount.TYPE_INCOMING, self.unicef)
+        DailyCount.record_item(this_month, DailyCount.TYPE_INCOMING, self.unicef)
+        DailyCount.record_item(this_month, DailyCount.TYPE_INCOMING, self.nyaruka)
+        DailySecondTotalCount.record_item(old_month, 10, DailySecondTotalCount.TYPE_TILL_REPLIED, self.unicef)
+
+        call_command('statspartitions', 'convert', months_ahead=1)
+
+        self.assertTrue(partitions.is_partitioned(DailyCount))
+        self.assertTrue(partitions.is_partitioned(DailySecondTotalCount))
+
+        # a partition for every month from the earliest count to the requested months ahead
+        expected_months = [old_month + relativedelta(months=m) for m in range(4)]
+        self.assertEqual(sorted(partitions.get_partitions(DailyCount).keys()), expected_months)
+
+        # all existing counts are kept and are in their month partitions
+        self.assertEqual(DailyCount.get_by_org([self.unicef], DailyCount.TYPE_INCOMING).total(), 2)
+        self.assertEqual(DailyCount.get_by_org([self.nyaruka], DailyCount.TYPE_INCOMING).total(), 1)
+        self.assertEqual(DailySecondTotalCount.objects.count(), 1)
+        self.assertEqual(count_rows(partitions.partition_name(DailyCount, old_month)), 1)
+        self.assertEqual(count_rows(partitions.partition_name(DailyCount, this_month)), 2)
+
+        # new counts can still be recorded and squashed
+        DailyCount.record_item(this_month, DailyCount.TYPE_INCOMING, self.unicef)
+        squash_counts()
+
+        self.assertEqual(DailyCount.get_by_org([self.unicef], DailyCount.TYPE_INCOMING).total(), 3)
+        self.assertEqual(count_rows(partitions.partition_name(DailyCount, this_month)), 2)
+
+        # can't convert tables twice
+        with self.assertRaises(CommandError):
+            call_command('statspartitions', 'convert')
+
+    @patch('casepro.statistics.partitions.vacuum_partition')
+    def test_partitions_maintain(self, mock_vacuum_partition):
+        this_month = partitions.month_start(timezone.now().date())
+        expired_month = this_month - relativedelta(months=4)
+        old_month = this_month - relativedelta(months=3)
+        later_month = this_month + relativedelta(months=3)
+
+        DailyCount.record_item(expired_month, DailyCount.TYPE_INCOMING, self.nyaruka)
+        DailyCount.record_item(old_month, DailyCount.TYPE_INCOMING, self.unicef)
+
+        call_command('statspartitions', 'convert', months_ahead=0)
+
+        # counts in months without partitions go to the default partition
+        DailyCount.record_item(old_month, DailyCount.TYPE_INCOMING, self.unicef)
+        DailyCount.record_item(later_month, DailyCount.TYPE_INCOMING, self.unicef)
+
+        default_name = '%s_%s' % (DailyCount._meta.db_table, partitions.DEFAULT_SUFFIX)
+        old_name = partitions.partition_name(DailyCount, old_month)
+
+        self.assertEqual(count_rows(default_name), 1)
+        self.assertEqual(count_rows(old_name), 2)
+
+        self.nyaruka.set_stats_retention(3)
+
+        call_command('statspartitions', 'maintain', months_ahead=3)
+
+        # partitions are created for upcoming months, existing counts are moved into them from the default partition,
+        # and the partition emptied by retention is dropped
+        self.assertEqual(sorted(partitions.get_partitions(DailyCount).keys()), [
+            old_month + relativedelta(months=m) for m in range(7)
+        ])
+        self.assertEqual(count_rows(default_name), 0)
+        self.assertEqual(count_rows(partitions.partition_name(DailyCount, later_month)), 1)
+
+        # the old partition is squashed down to one row per key
+        self.assertEqual(count_rows(old_name), 1)
+        self.assertTrue(partitions.is_compacted(old_name))
+        self.assertEqual(DailyCount.get_by_org([self.unicef], DailyCount.TYPE_INCOMING).total(), 3)
+        self.assertEqual(DailyCount.get_by_org([self.nyaruka], DailyCount.TYPE_INCOMING).total(), 0)
+
+        mock_vacuum_partition.assert_called_once_with(old_name)
+        mock_vacuum_partition.reset_mock()
+
+        # compacted partitions aren't compacted again
+        call_command('statspartitions', 'maintain', months_ahead=3)
+
+        self.assertNotCalled(mock_vacuum_partition)
+
+    def test_rebuild(self):
+        self.new_messages(date(2015, 1, 1), 3)
+        self.new_outgoing(self.user1, date(2015, 1, 2), 2)
+
+        d1 = self.anytime_on_day(date(2015, 1, 3), pytz.timezone("Africa/Kampala"))
+        msg = self.create_message(self.unicef, 234, self.ann, "Hello again", [self.aids], created_on=d1)
+
+        with patch.object(timezone, 'now', return_value=d1):
+            case = Case.get_or_open(self.unicef, self.user1, msg, "Summary", self.moh)
+            case.close(self.user1)
+
+        def get_counts():
+            return (
+                sorted(DailyCount.objects.values_list('day', 'item_type', 'scope').annotate(total=Sum('count'))),
+                sorted(DailySecondTotalCount.objects.values_list('day', 'item_type', 'scope').annotate(
+                    total=Sum('count'), seconds=Sum('seconds')))
+            )
+
+        original = get_counts()
+
+        # lose some counts and record some that shouldn't exist
+        DailyCount.objects.filter(item_type=DailyCount.TYPE_REPLIES).delete()
+        DailyCount.record_item(date(2015, 1, 1), DailyCount.TYPE_INCOMING, self.unicef)
+        DailyCount.record_item(date(2015, 1, 1), DailyCount.TYPE_INCOMING, self.nyaruka)
+
+        # dry run only reports discrepancies
+        out = six.StringIO()
+        call_command('rebuildstats', self.unicef.pk, '--since=2015-01-01', '--until=2015-01-05', '--processes=1',
+                     '--dry-run', stdout=out)
+        self.assertIn("Found 4 discrepancies", out.getvalue())
+        self.assertNotEqual(get_counts(), original)
+
+        call_command('rebuildstats', self.unicef.pk, '--since=2015-01-01', '--until=2015-01-05', '--processes=1',
+                     stdout=six.StringIO())
+
+        # other orgs are left alone
+        self.assertEqual(DailyCount.get_by_org([self.nyaruka], DailyCount.TYPE_INCOMING).total(), 1)
+        DailyCount.objects.filter(scope='org:%d' % self.nyaruka.pk).delete()
+
+        self.assertEqual(get_counts(), original)
+
     def test_case_counts_opened(self):
         d1 = self.anytime_on_day(date(2015, 1, 1), pytz.timezone("Africa/Kampala"))
         msg2 = self.create_message(
@@ -284,6 +470,66 @@ class DailyCountExportTest(BaseStatsTest):
         self.assertExcelRow(sheet, 15, [date(2016, 1, 15), 0, 0, 1])
         self.assertExcelRow(sheet, 31, [date(2016, 1, 31), 0, 0, 0])
 
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    def test_recurring_export(self):
+        url = reverse('statistics.dailycountexport_create')
+
+        self.login(self.admin)
+
+        response = self.url_post_json('unicef', url, {
+            'type': 'L', 'after': "2016-01-01", 'before': "2016-01-31", 'recurring': True
+        })
+        self.assertEqual(response.status_code, 200)
+
+        export1 = DailyCountExport.objects.get()
+        self.assertTrue(export1.is_recurring)
+
+        # a week later, the next run covers the complete days since the previous run
+        with patch.object(timezone, 'now', return_value=datetime(2016, 2, 8, 12, 0, 0, 0, pytz.UTC)):
+            rerun_daily_count_exports()
+
+        export1.refresh_from_db()
+        self.assertFalse(export1.is_recurring)
+
+        export2 = DailyCountExport.objects.get(previous=export1)
+        self.assertTrue(export2.is_recurring)
+        self.assertEqual(export2.since, date(2016, 2, 1))
+        self.assertEqual(export2.until, date(2016, 2, 8))
+
+        sheet = self.openWorkbook(export2.filename).sheets()[0]
+        self.assertEqual(sheet.nrows, 8)
+        self.assertExcelRow(sheet, 1, [date(2016, 2, 1), 0, 0, 0])
+        self.assertExcelRow(sheet, 7, [date(2016, 2, 7), 0, 0, 0])
+
+        # nothing for another run to export on the same day
+        with patch.object(timezone, 'now', return_value=datetime(2016, 2, 8, 13, 0, 0, 0, pytz.UTC)):
+            rerun_daily_count_exports()
+
+        self.assertEqual(DailyCountExport.objects.count(), 2)
+
+        # recurrence can be stopped from the download page of an earlier run
+        read_url = reverse('statistics.dailycountexport_read', args=[export1.pk])
+        stop_url = reverse('statistics.dailycountexport_stop', args=[export2.pk])
+
+        response = self.url_get('unicef', read_url)
+        self.assertEqual(response.context['stop_url'], stop_url)
+        self.assertContains(response, "Stop Recurring")
+
+        response = self.url_post('unicef', stop_url)
+        self.assertRedirects(response, reverse('statistics.dailycountexport_read', args=[export2.pk]),
+                             fetch_redirect_response=False)
+
+        export2.refresh_from_db()
+        self.assertFalse(export2.is_recurring)
+
+        response = self.url_get('unicef', read_url)
+        self.assertNotIn('stop_url', response.context)
+
+        with patch.object(timezone, 'now', return_value=datetime(2016, 2, 15, 12, 0, 0, 0, pytz.UTC)):
+            rerun_daily_count_exports()
+
+        self.assertEqual(DailyCountExport.objects.count(), 2)
+
     @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
     def test_partner_export(self):
         url = reverse('statistics.dailycountexport_create')
@@ -494,6 +740,42 @@ class ChartsTest(BaseStatsTest):
 
 class SecondTotalCountsTest(BaseStatsTest):
 
+    def test_percentiles(self):
+        self.assertEqual(DailySecondTotalCount.get_bucket(0), 0)
+        self.assertEqual(DailySecondTotalCount.get_bucket(1), 0)
+        self.assertEqual(DailySecondTotalCount.get_bucket(2), 4)  # 1.25^3 < 2 <= 1.25^4
+        self.assertEqual(DailySecondTotalCount.get_bucket(10 ** 20), DailySecondTotalCount.BUCKET_MAX)
+
+        day = date(2017, 6, 1)
+
+        # 97 quick replies and 3 very slow ones which distort the average
+        for n in range(97):
+            DailySecondTotalCount.record_item(day, 60, DailySecondTotalCount.TYPE_TILL_REPLIED, self.moh)
+        for n in range(3):
+            DailySecondTotalCount.record_item(day, 86400 * 30, DailySecondTotalCount.TYPE_TILL_REPLIED, self.moh)
+        DailySecondTotalCount.record_item(day, 3600, DailySecondTotalCount.TYPE_TILL_REPLIED, self.who)
+
+        # and a legacy squashed count which can't be bucketed
+        DailySecondTotalCount.objects.create(day=day, item_type=DailySecondTotalCount.TYPE_TILL_REPLIED,
+                                             scope='partner:%d' % self.moh.pk, count=5, seconds=500)
+
+        def assertPercentiles(values, expected):
+            for p, seconds in expected.items():
+                self.assertAlmostEqual(values[p], seconds, delta=seconds * 0.12)
+
+        counts = DailySecondTotalCount.get_by_partner([self.moh], DailySecondTotalCount.TYPE_TILL_REPLIED)
+        self.assertGreater(counts.average(), 86400 * 0.5)  # over 1000x the median
+        assertPercentiles(counts.percentiles(), {50: 60, 90: 60, 99: 86400 * 30})
+
+        squash_counts()
+
+        counts = DailySecondTotalCount.get_by_partner([self.moh, self.who], DailySecondTotalCount.TYPE_TILL_REPLIED)
+        assertPercentiles(counts.percentiles(), {50: 60, 90: 60, 99: 86400 * 30})
+
+        by_partner = counts.scope_percentiles()
+        assertPercentiles(by_partner[self.moh], {50: 60, 90: 60, 99: 86400 * 30})
+        assertPercentiles(by_partner[self.who], {50: 3600, 90: 3600, 99: 3600})
+
     def test_first_reply_counts(self):
         msg1 = self.create_message(self.unicef, 123, self.ann, "Hello 1", [self.aids])
         msg2 = self.create_message(self.unicef, 234, self.ned, "Hello 2", [self.aids, self.pregnancy])
@@ -540,6 +822,17 @@ class SecondTotalCountsTest(BaseStatsTest):
         self.assertEqual(DailySecondTotalCount.get_by_partner([self.moh], 'A').seconds(), 1)
         self.assertEqual(DailySecondTotalCount.get_by_partner([self.moh], 'A').average(), 1)
 
+        # check first reply times are recorded on the case
+        case5.refresh_from_db()
+        self.assertIsNotNone(case5.first_reply_on)
+        self.assertIsNotNone(case5.assigned_on)
+        self.assertIsNotNone(case5.assignee_replied_on)
+
+        # subsequent replies aren't counted
+        self.create_outgoing(self.unicef, self.user1, 201, Outgoing.CASE_REPLY, "Good question", self.ann, case=case5)
+        self.assertEqual(DailySecondTotalCount.get_by_org([self.unicef], 'A').total(), 6)
+        self.assertEqual(DailySecondTotalCount.get_by_partner([self.moh], 'A').total(), 1)
+
         # check empty partner metrics
         self.assertEqual(DailySecondTotalCount.get_by_partner([self.klab], 'A').average(), 0)
 
@@ -592,6 +885,7 @@ class SecondTotalCountsTest(BaseStatsTest):
 
         # check empty partner metrics
         self.assertEqual(DailySecondTotalCount.get_by_partner([self.klab], 'C').average(), 0)
+        self.assertEqual(DailySecondTotalCount.get_by_partner([self.klab], 'C').percentiles(), {50: 0, 90: 0, 99: 0})
 
         self.assertEqual(DailySecondTotalCount.objects.count(), 8)
         squash_counts()
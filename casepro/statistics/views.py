@@ -15,7 +15,7 @@ from temba_client.utils import parse_iso8601
 from casepro.cases.models import Partner
 from casepro.msgs.models import Label
 from casepro.utils import date_to_milliseconds, month_range, JSONEncoder
-from casepro.utils.export import BaseDownloadView
+from casepro.utils.export import BaseDownloadView, BaseStopView
 
 from .models import datetime_to_date, DailyCount, DailyCountExport
 from .tasks import daily_count_export
@@ -162,7 +162,7 @@ class MostUsedLabelsChart(BaseChart):
 
 class DailyCountExportCRUDL(SmartCRUDL):
     model = DailyCountExport
-    actions = ('create', 'read')
+    actions = ('create', 'read', 'stop')
 
     class Create(NonAtomicMixin, OrgPermsMixin, SmartCreateView):
         def post(self, request, *args, **kwargs):
@@ -172,7 +172,9 @@ class DailyCountExportCRUDL(SmartCRUDL):
             after = parse_iso8601(request.json['after']).date()
             before = parse_iso8601(request.json['before']).date() + timedelta(days=1)
 
-            export = DailyCountExport.create(self.request.org, self.request.user, of_type, after, before)
+            is_recurring = request.json.get('recurring', False)
+
+            export = DailyCountExport.create(self.request.org, self.request.user, of_type, after, before, is_recurring)
 
             daily_count_export.delay(export.pk)
 
@@ -181,3 +183,6 @@ class DailyCountExportCRUDL(SmartCRUDL):
     class Read(BaseDownloadView):
         title = _("Download Export")
         filename = 'daily_count_export.xls'
+
+    class Stop(BaseStopView):
+        permission = 'statistics.dailycountexport_read'
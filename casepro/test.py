@@ -1,13 +1,19 @@
 from __future__ import unicode_literals
 
+import codecs
+import csv
+import gzip
+import io
 import json
 import pytz
+import six
 
 from dash.test import DashTest
 from datetime import datetime, date, time
 from django.conf import settings
 from django.core import mail
 from django.utils.timezone import now
+from mock import patch
 from xlrd import open_workbook, xldate_as_tuple
 from xlrd.sheet import XL_CELL_DATE
 
@@ -17,6 +23,7 @@ from casepro.contacts.models import Contact, Group, Field
 from casepro.msgs.models import Label, FAQ, Message, Outgoing
 from casepro.profiles.models import Profile, ROLE_ANALYST, ROLE_MANAGER
 from casepro.rules.models import ContainsTest, Quantifier, LabelAction, Rule
+from casepro.utils.export import CSVExportWriter
 
 
 class TestBackend(backend.NoopBackend):
@@ -38,6 +45,11 @@ class BaseCasesTest(DashTest):
 
         backend._ACTIVE_BACKEND = None
 
+        # test transactions are never committed so run on-commit callbacks straight away
+        on_commit_patcher = patch('django.db.transaction.on_commit', lambda func, using=None: func())
+        on_commit_patcher.start()
+        self.addCleanup(on_commit_patcher.stop)
+
         # some orgs
         self.unicef = self.create_org("UNICEF", timezone=pytz.timezone("Africa/Kampala"), subdomain="unicef")
         self.nyaruka = self.create_org("Nyaruka", timezone=pytz.timezone("Africa/Kigali"), subdomain="nyaruka")
@@ -152,6 +164,7 @@ class BaseCasesTest(DashTest):
     def create_case(self, org, contact, assignee, message, labels=(), **kwargs):
         case = Case.objects.create(org=org, contact=contact, assignee=assignee, initial_message=message, **kwargs)
         case.labels.add(*labels)
+        case.refresh_from_db(fields=('label_ids',))  # maintained via db triggers
 
         if 'opened_on' in kwargs:  # uses auto_now_add
             case.opened_on = kwargs['opened_on']
@@ -201,6 +214,30 @@ class BaseCasesTest(DashTest):
 
         self.assertEqual(actual_values, expected_values)
 
+    def openCSV(self, filename):
+        """
+        Reads the rows of a gzip compressed CSV export
+        """
+        with gzip.open("%s/%s" % (settings.MEDIA_ROOT, filename), 'rb') as export_file:
+            data = export_file.read()
+
+        if six.PY2:  # pragma: no cover
+            rows = csv.reader(io.BytesIO(data[len(codecs.BOM_UTF8):]))
+            return [[v.decode('utf-8') for v in row] for row in rows]
+
+        return list(csv.reader(io.StringIO(data.decode('utf-8-sig'), newline='')))
+
+    def assertCSVRow(self, rows, row_num, values):
+        """
+        Asserts the values in the given CSV row, with expected values formatted as they are by the export writer
+        """
+        expected_values = []
+        for expected in values:
+            expected = CSVExportWriter.format_value(expected)
+            expected_values.append(expected.decode('utf-8') if isinstance(expected, bytes) else six.text_type(expected))
+
+        self.assertEqual(rows[row_num], expected_values)
+
     def assertSentMail(self, recipients, reset_outbox=True):
         self.assertEqual([e.to[0] for e in mail.outbox], recipients)
 
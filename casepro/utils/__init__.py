@@ -10,15 +10,25 @@ import unicodedata
 
 from dateutil.relativedelta import relativedelta
 from datetime import datetime, time, timedelta
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
 from django.utils.timesince import timeuntil
 from django.utils import timezone
 from enum import Enum
 from temba_client.utils import format_iso8601
 from uuid import UUID
 
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
 
 LANGUAGES_BY_CODE = {}  # cache of language lookups
 
+ORG_VERSION_KEY = 'org:%d:version:%s'
+
 
 def parse_csv(csv, as_ints=False):
     """
@@ -36,7 +46,7 @@ def str_to_bool(text):
     """
     Parses a boolean value from the given text
     """
-    return text and text.lower() in ['true', 'y', 'yes', '1']
+    return bool(text) and text.lower() in ['true', 'y', 'yes', '1']
 
 
 class JSONEncoder(json.JSONEncoder):
@@ -61,6 +71,17 @@ def json_encode(data):
     return json.dumps(data, cls=JSONEncoder)
 
 
+def json_encode_fast(data):
+    """
+    Encodes the given primitives as JSON, using ujson if it's installed. Unlike json_encode, values like datetimes must
+    already have been converted to primitives.
+    """
+    if ujson:
+        return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False)
+
+    return json.dumps(data)
+
+
 def json_decode(data):
     """
     Decodes the given JSON as primitives
@@ -134,6 +155,124 @@ def microseconds_to_datetime(ms):
     return datetime.utcfromtimestamp(ms / 1000000.0).replace(tzinfo=pytz.utc)
 
 
+def encode_cursor(dt, pk):
+    """
+    Encodes a datetime and id as a cursor string for keyset pagination
+    """
+    return '%d:%d' % (datetime_to_microseconds(dt), pk)
+
+
+def parse_cursor(cursor):
+    """
+    Parses a cursor string as a datetime and id tuple, returning None if the cursor is empty or invalid
+    """
+    try:
+        timestamp, pk = cursor.split(':')
+        return microseconds_to_datetime(int(timestamp)), int(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
+def filter_before_cursor(queryset, cursor, time_field):
+    """
+    Filters a queryset ordered by (time_field, id) descending to the items which come after the given cursor. The
+    redundant range condition on time_field lets the database use the same index as it would for the first page.
+    """
+    parsed = parse_cursor(cursor)
+    if not parsed:
+        return queryset
+
+    dt, pk = parsed
+    queryset = queryset.filter(**{time_field + '__lte': dt})
+    return queryset.filter(Q(**{time_field + '__lt': dt}) | Q(pk__lt=pk))
+
+
+def encode_timeline_cursor(item):
+    """
+    Encodes the position of a timeline item as a cursor string for keyset pagination
+    """
+    dt, item_type, pk = item.get_sort_key()
+    return '%s:%s' % (item_type, encode_cursor(dt, pk))
+
+
+def parse_timeline_cursor(cursor):
+    """
+    Parses a timeline cursor string as an item type, datetime and id tuple, returning None if the cursor is empty or
+    invalid
+    """
+    try:
+        item_type, cursor = cursor.split(':', 1)
+    except (AttributeError, ValueError):
+        return None
+
+    parsed = parse_cursor(cursor)
+    return (item_type,) + parsed if parsed else None
+
+
+def filter_timeline_before_cursor(queryset, item_type, cursor):
+    """
+    Filters a queryset of timeline items of the given type, ordered by (created_on, id) descending, to the items which
+    come after the given timeline cursor. Items from different sources with the same time are ordered by type.
+    """
+    parsed = parse_timeline_cursor(cursor)
+    if not parsed:
+        return queryset
+
+    cursor_type, dt, pk = parsed
+    queryset = queryset.filter(created_on__lte=dt)
+
+    if item_type > cursor_type:
+        return queryset.filter(created_on__lt=dt)
+    elif item_type == cursor_type:
+        return queryset.filter(Q(created_on__lt=dt) | Q(pk__lt=pk))
+    return queryset
+
+
+def cursor_page(queryset, per_page, time_field):
+    """
+    Fetches a page of items from a cursor filtered queryset, returning a tuple of the items, whether there are more
+    items, and the cursor for the next page
+    """
+    items = list(queryset[:per_page + 1])
+    has_more = len(items) > per_page
+    items = items[:per_page]
+
+    if not items:
+        next_cursor = None
+    elif isinstance(items[-1], dict):  # queryset of values
+        next_cursor = encode_cursor(items[-1][time_field], items[-1]['id'])
+    else:
+        next_cursor = encode_cursor(getattr(items[-1], time_field), items[-1].pk)
+
+    return items, has_more, next_cursor
+
+
+def get_org_versions(org, *names):
+    """
+    Gets the version stamps of the given named sets of org data, for keying cached values derived from them
+    """
+    keys = [ORG_VERSION_KEY % (org.pk, name) for name in names]
+    versions = cache.get_many(keys)
+    return tuple(versions.get(key, 0) for key in keys)
+
+
+def bump_org_version(org_id, name):
+    """
+    Bumps the version stamp of the given named set of data for the org with the given id, invalidating cached values
+    derived from it. This takes an id so that model signals don't have to fetch the org. It's deferred until the current
+    transaction commits, so that values derived from uncommitted data can't be cached under the new version.
+    """
+    key = ORG_VERSION_KEY % (org_id, name)
+
+    def bump():
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+    transaction.on_commit(bump)
+
+
 def month_range(offset, now=None):
     """
     Gets the UTC start and end (exclusive) of a month
@@ -167,6 +306,15 @@ class TimelineItem(object):
     def get_time(self):
         return self.item.created_on
 
+    def get_sort_key(self):
+        """
+        Gets the (time, type, id) tuple which orders this item in a timeline and locates it in a timeline cursor
+        """
+        return self.get_time(), self.item.TIMELINE_TYPE, self.item.pk
+
+    def __lt__(self, other):
+        return self.get_time() < other.get_time()
+
     def to_json(self):
         return {'time': self.get_time(), 'type': self.item.TIMELINE_TYPE, 'item': self.item.as_json()}
 
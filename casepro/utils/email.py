@@ -1,22 +1,27 @@
 from __future__ import print_function, unicode_literals
 
+import logging
 import six
+import time
 
+from celery import shared_task
 from django.contrib.auth.models import User
 from django.core.mail import EmailMultiAlternatives, get_connection
 from django.template import loader
 from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+EMAIL_RATE_KEY = 'email:rate:%s:%d'
+EMAIL_STATS_KEY = 'email:stats:%s'
 
 
 def send_email(recipients, subject, template, context):
     """
     Sends a multi-part (text and optionally HTML) email generated from templates
     """
-    html_template = loader.get_template(template + ".html")
-    text_template = loader.get_template(template + ".txt")
-
-    html = html_template.render(context)
-    text = text_template.render(context)
+    text, html = EmailRenderer().render(template, context)
 
     send_raw_email(recipients, subject, text, html)
 
@@ -25,31 +30,164 @@ def send_raw_email(recipients, subject, text, html):
     """
     Sends and multi-part (text and optionally HTML) email to a list of users or email addresses
     """
-    to_addresses = []
-    for recipient in recipients:
-        if isinstance(recipient, User):
-            to_addresses.append(recipient.email)
-        elif isinstance(recipient, six.string_types):
-            to_addresses.append(recipient)
+    send_raw_emails([(recipients, subject, text, html)])
+
+
+def send_raw_emails(emails):
+    """
+    Queues multiple multi-part emails, given as tuples of recipients, subject, text and HTML, for delivery in batches by
+    the email delivery task
+    """
+    messages = []
+    for recipients, subject, text, html in emails:
+        to_addresses = []
+        for recipient in recipients:
+            if isinstance(recipient, User):
+                to_addresses.append(recipient.email)
+            elif isinstance(recipient, six.string_types):
+                to_addresses.append(recipient)
+            else:  # pragma: no cover
+                raise ValueError("Email recipients must users or email addresses")
+
+        if getattr(settings, 'SEND_EMAILS', False):
+            # send individual messages so as to not leak users email addresses
+            messages += [(to_address, subject, text, html) for to_address in to_addresses]
         else:  # pragma: no cover
-            raise ValueError("Email recipients must users or email addresses")
+            print("FAKE SENDING this email to %s:" % ", ".join(to_addresses))
+            print("--------------------------------------- text -----------------------------------------")
+            print(text)
+            if html:
+                print("--------------------------------------- html -----------------------------------------")
+                print(html)
+
+    batch_size = getattr(settings, 'EMAIL_BATCH_SIZE', 50)
+
+    for b in range(0, len(messages), batch_size):
+        deliver_emails.delay(messages[b:b + batch_size])
+
+
+@shared_task(bind=True, max_retries=5, ignore_result=True)
+def deliver_emails(task, messages, attempt=0):
+    """
+    Delivers a batch of queued messages to the email relay over a single connection. Messages which fail are retried
+    with exponential backoff, up to max_retries times. Delivery attempts are counted separately from Celery's retries
+    as waiting for the rate limit also retries the task.
+    """
+    relay = getattr(settings, 'EMAIL_HOST', 'localhost')
+
+    wait = reserve_email_rate(relay, len(messages))
+    if wait:
+        record_email_stats(relay, rate_limited=len(messages))
+
+        # waiting for our turn doesn't count as a delivery attempt
+        raise task.retry(countdown=wait, max_retries=None)
 
     from_address = getattr(settings, 'DEFAULT_FROM_EMAIL', 'website@casepro.io')
+    backend = getattr(settings, 'EMAIL_DELIVERY_BACKEND', None) or getattr(
+        settings, 'CELERY_EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend'
+    )
+    connection = get_connection(backend)
+    failed = []
+    start = time.time()
 
-    if getattr(settings, 'SEND_EMAILS', False):
-        # send individual messages so as to not leak users email addresses, but use bulk send operation for speed
-        messages = []
-        for to_address in to_addresses:
-            message = EmailMultiAlternatives(subject, text, from_email=from_address, to=[to_address])
-            if html:
-                message.attach_alternative(html, "text/html")
-            messages.append(message)
-
-        get_connection().send_messages(messages)
-    else:  # pragma: no cover
-        print("FAKE SENDING this email to %s:" % ", ".join(to_addresses))
-        print("--------------------------------------- text -----------------------------------------")
-        print(text)
-        if html:
-            print("--------------------------------------- html -----------------------------------------")
-            print(html)
+    try:
+        connection.open()
+    except Exception:
+        logger.exception("Unable to connect to %s" % relay)
+        failed = list(messages)
+    else:
+        try:
+            for to_address, subject, text, html in messages:
+                message = EmailMultiAlternatives(subject, text, from_email=from_address, to=[to_address],
+                                                 connection=connection)
+                if html:
+                    message.attach_alternative(html, "text/html")
+
+                try:
+                    message.send()
+                except Exception:
+                    logger.exception("Unable to deliver email to %s via %s" % (to_address, relay))
+                    failed.append((to_address, subject, text, html))
+        finally:
+            connection.close()
+
+    record_email_stats(relay, sent=len(messages) - len(failed))
+
+    logger.info("Delivered %d of %d emails via %s in %.3f secs" % (
+        len(messages) - len(failed), len(messages), relay, time.time() - start
+    ))
+
+    if failed:
+        if attempt >= task.max_retries:
+            record_email_stats(relay, failed=len(failed))
+            logger.error("Giving up on delivering %d emails via %s" % (len(failed), relay))
+            return
+
+        record_email_stats(relay, retried=len(failed))
+
+        retry_delay = getattr(settings, 'EMAIL_RETRY_DELAY', 30)
+        raise task.retry(args=(failed,), kwargs={'attempt': attempt + 1}, countdown=retry_delay * 2 ** attempt,
+                         max_retries=None)
+
+
+def reserve_email_rate(relay, count):
+    """
+    Reserves capacity to deliver the given number of messages to the given relay in the current minute, across all
+    workers. Returns zero if reserved, otherwise the number of seconds until the next minute.
+    """
+    limit = getattr(settings, 'EMAIL_RATE_LIMIT', None)
+    if not limit:
+        return 0
+
+    r = get_redis_connection()
+    now = time.time()
+    key = EMAIL_RATE_KEY % (relay, int(now // 60))
+
+    with r.pipeline() as pipe:
+        pipe.incrby(key, count)
+        pipe.expire(key, 60)
+        total = pipe.execute()[0]
+
+    # a batch larger than the limit is allowed to go first in an otherwise empty minute
+    if total > limit and total > count:
+        r.decr(key, count)
+        return int(60 - now % 60) + 1
+
+    return 0
+
+
+def record_email_stats(relay, **counts):
+    """
+    Increments the delivery metrics for the given relay, e.g. sent=10
+    """
+    r = get_redis_connection()
+    with r.pipeline() as pipe:
+        for name, count in six.iteritems(counts):
+            pipe.hincrby(EMAIL_STATS_KEY % relay, name, count)
+        pipe.execute()
+
+
+def get_email_stats(relay=None):
+    """
+    Gets the delivery metrics for the given relay, as counts of messages sent, retried, failed and rate limited
+    """
+    relay = relay or getattr(settings, 'EMAIL_HOST', 'localhost')
+    stats = get_redis_connection().hgetall(EMAIL_STATS_KEY % relay)
+
+    return {k.decode('utf-8') if isinstance(k, bytes) else k: int(v) for k, v in six.iteritems(stats)}
+
+
+class EmailRenderer(object):
+    """
+    Renders the text and HTML parts of emails from templates, loading each template only once
+    """
+    def __init__(self):
+        self.templates = {}
+
+    def render(self, template, context):
+        if template not in self.templates:
+            self.templates[template] = (loader.get_template(template + ".txt"), loader.get_template(template + ".html"))
+
+        text_template, html_template = self.templates[template]
+
+        return text_template.render(context), html_template.render(context)
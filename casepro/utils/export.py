@@ -1,28 +1,104 @@
 from __future__ import unicode_literals
 
+import codecs
+import csv
+import gzip
+import io
 import json
+import logging
+import math
+import os
 import pytz
+import shutil
+import six
+import time
 
 from dash.orgs.models import Org
-from dash.orgs.views import OrgObjPermsMixin
+from dash.orgs.views import OrgObjPermsMixin, OrgPermsMixin
 from dash.utils import random_string
 from datetime import datetime, date
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.postgres.fields import ArrayField
 from django.core.files import File
 from django.core.files.storage import default_storage
 from django.core.files.temp import NamedTemporaryFile
 from django.core.urlresolvers import reverse
-from django.db import models
-from django.http import HttpResponse
+from django.db import models, transaction
+from django.db.models import Count, F, Max, Min, prefetch_related_objects
+from django.http import HttpResponse, HttpResponseRedirect, FileResponse, StreamingHttpResponse
 from django.utils.translation import ugettext_lazy as _
-from smartmin.views import SmartReadView
+from itertools import islice
+from smartmin.views import SmartReadView, SmartTemplateView
 from temba_client.utils import parse_iso8601
 from xlwt import Workbook, XFStyle
 
 from . import json_encode
 from .email import send_email
 
+logger = logging.getLogger(__name__)
+
+
+class CSVExportWriter(object):
+    """
+    Writes rows to a gzip compressed CSV file as they're rendered, so that exports of any size are written with
+    bounded memory. Files begin with a UTF-8 BOM so that Excel recognizes the encoding. Files which will be appended
+    to another, e.g. export shards after the first, are written without the BOM or header row.
+    """
+    extension = 'csv.gz'
+
+    def __init__(self, fileobj, header=True):
+        self.gzip_file = gzip.GzipFile(fileobj=fileobj, mode='wb')
+        self.header = header
+
+        if six.PY2:  # pragma: no cover
+            if header:
+                self.gzip_file.write(codecs.BOM_UTF8)
+            self.file = self.gzip_file
+        else:
+            self.file = io.TextIOWrapper(self.gzip_file, encoding='utf-8-sig' if header else 'utf-8', newline='')
+
+        self.writer = csv.writer(self.file)
+        self.num_rows = 0
+
+    def write_header(self, values):
+        if self.header:
+            self.writer.writerow([self.format_value(v) for v in values])
+
+    def write_row(self, values):
+        self.writer.writerow([self.format_value(v) for v in values])
+        self.num_rows += 1
+
+    @staticmethod
+    def format_value(value):
+        if value is None:
+            return ""
+        elif isinstance(value, bool):
+            return "Yes" if value else "No"
+        elif isinstance(value, datetime):
+            # Excel can't parse ISO8601 timestamps, so these are written in UTC like those of the Excel exports
+            return value.astimezone(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S')
+        elif isinstance(value, date):
+            return value.isoformat()
+        elif six.PY2 and isinstance(value, six.text_type):  # pragma: no cover
+            return value.encode('utf-8')
+
+        return value
+
+    def close(self):
+        """
+        Closes the compressed stream, leaving the underlying file open
+        """
+        self.file.close()
+
+
+class EchoBuffer(object):
+    """
+    File-like object which returns what is written to it, so that CSV rows can be encoded one at a time
+    """
+    def write(self, value):
+        return value
+
 
 class BaseExport(models.Model):
     """
@@ -36,6 +112,14 @@ class BaseExport(models.Model):
 
     created_on = models.DateTimeField(auto_now_add=True)
 
+    # recurring exports are re-run periodically, each run only exporting what's new since the previous run
+    is_recurring = models.BooleanField(default=False)
+
+    previous = models.ForeignKey('self', null=True, on_delete=models.SET_NULL, related_name='+')
+
+    # whether generating this export failed and was given up on
+    is_failed = models.BooleanField(default=False)
+
     # overridden by subclasses
     directory = None
     download_view = None
@@ -46,21 +130,22 @@ class BaseExport(models.Model):
     DATETIME_STYLE = XFStyle()
     DATETIME_STYLE.num_format_str = 'DD-MM-YYYY HH:MM:SS'
 
-    MAX_SHEET_ROWS = 65535
-
     def do_export(self):
         """
         Does actual export. Called from a celery task.
         """
-        book = Workbook()
-        self.render_book(book)
-
         temp = NamedTemporaryFile(delete=True)
-        book.save(temp)
+        extension = self.write_file(temp)
         temp.flush()
 
-        org_root = getattr(settings, 'SITE_ORGS_STORAGE_ROOT', 'orgs')
-        filename = '%s/%d/%s/%s.xls' % (org_root, self.org_id, self.directory, random_string(20))
+        self.save_file(temp, extension)
+
+    def save_file(self, temp, extension):
+        """
+        Saves the given written file to storage and notifies the user that their export is ready
+        """
+        # storage reads the file back in chunks
+        filename = '%s/%s.%s' % (self.get_directory(), random_string(20), extension)
         default_storage.save(filename, File(temp))
 
         self.filename = filename
@@ -71,9 +156,87 @@ class BaseExport(models.Model):
 
         send_email([self.created_by], subject, 'utils/email/export', {'download_url': download_url})
 
-        # force a gc
-        import gc
-        gc.collect()
+    def fail(self):
+        """
+        Marks this export as failed and notifies the user, unless it has already been marked as failed
+        """
+        if not self.__class__.objects.filter(pk=self.pk, is_failed=False).update(is_failed=True):
+            return
+
+        self.is_failed = True
+
+        subject = "Your export failed"
+        download_url = self.org.make_absolute_url(reverse(self.download_view, args=[self.pk]))
+
+        send_email([self.created_by], subject, 'utils/email/export_failed', {'download_url': download_url})
+
+    @classmethod
+    def get_recurring(cls):
+        return cls.objects.filter(is_recurring=True, created_by__is_active=True).select_related('org', 'created_by')
+
+    def rerun(self):
+        """
+        Creates the next run of this recurring export, which takes over its recurrence. Returns None if there's
+        nothing yet for a next run to export.
+        """
+        with transaction.atomic():
+            # lock this run, and check it hasn't been stopped since it was fetched
+            if not self.__class__.objects.select_for_update().filter(pk=self.pk, is_recurring=True).exists():
+                return None
+
+            next_run = self.create_next()
+            if next_run:
+                self.is_recurring = False
+                self.save(update_fields=('is_recurring',))
+
+        return next_run
+
+    def create_next(self):  # pragma: no cover
+        """
+        Child classes implement this to create the next run of this export
+        """
+        pass
+
+    def get_recurring_run(self):
+        """
+        Gets the run of this export which is currently recurring, which is a later run if this one has been re-run, or
+        None if it has been stopped
+        """
+        run = self
+        while run and not run.is_recurring:
+            run = self.__class__.objects.filter(previous=run).first()
+
+        return run
+
+    def stop_recurring(self):
+        """
+        Stops this export from recurring
+        """
+        while True:
+            run = self.get_recurring_run()
+            if not run:
+                return
+
+            # recurrence may have been handed to a new run since we looked, in which case try again
+            if self.__class__.objects.filter(pk=run.pk, is_recurring=True).update(is_recurring=False):
+                return
+
+    def get_directory(self):
+        org_root = getattr(settings, 'SITE_ORGS_STORAGE_ROOT', 'orgs')
+        return '%s/%d/%s' % (org_root, self.org_id, self.directory)
+
+    @property
+    def progress(self):
+        return 100 if self.filename else 0
+
+    def write_file(self, temp):
+        """
+        Writes this export to the given file and returns its extension
+        """
+        book = Workbook()
+        self.render_book(book)
+        book.save(temp)
+        return 'xls'
 
     def render_book(self, book):  # pragma: no cover
         """
@@ -108,18 +271,282 @@ class BaseSearchExport(BaseExport):
 
     search = models.TextField()
 
+    # estimated number of items in the search, and how many have been written
+    num_items = models.IntegerField(null=True)
+    items_done = models.IntegerField(default=0)
+
+    # for sharded exports, the descending id boundaries of the shards and which shards have been written
+    shard_bounds = ArrayField(models.IntegerField(), null=True)
+    shards_done = ArrayField(models.IntegerField(), default=list)
+
+    # the id of the newest item covered by this export, which the next run of a recurring export starts after if this
+    # run succeeds
+    last_item_id = models.IntegerField(null=True)
+
+    CHUNK_SIZE = 1000
+
+    MAX_SHARDS = 16
+
+    # when rendering, the (exclusive, inclusive) range of item ids to be exported
+    id_range = None
+    num_exported = 0
+
     @classmethod
-    def create(cls, org, user, search):
-        return cls.objects.create(org=org, partner=user.get_partner(org), created_by=user, search=json_encode(search))
+    def create(cls, org, user, search, is_recurring=False):
+        export = cls.for_search(org, user, search, is_recurring)
+        export.save()
+        return export
+
+    @classmethod
+    def for_search(cls, org, user, search, is_recurring=False):
+        """
+        Gets a new unsaved export of the given search, which can be saved and generated asynchronously, or streamed
+        """
+        return cls(org=org, partner=user.get_partner(org), created_by=user, search=json_encode(search),
+                   is_recurring=is_recurring)
+
+    def create_next(self):
+        # can't start the next run until this one has finished or failed
+        if not self.filename and not self.is_failed:
+            return None
+
+        return self.__class__.objects.create(org=self.org, partner=self.partner, created_by=self.created_by,
+                                             search=self.search, is_recurring=True, previous=self)
+
+    def get_watermark(self):
+        """
+        Gets the id of the newest item exported by this run, or if it didn't succeed, by the last run before it which
+        did. Items after that haven't been exported yet.
+        """
+        run = self
+        while run and (run.is_failed or not run.filename):
+            run = run.previous
+
+        return run.last_item_id if run else 0
+
+    @property
+    def num_shards(self):
+        return len(self.shard_bounds) - 1 if self.shard_bounds else 1
+
+    @property
+    def progress(self):
+        if self.filename:
+            return 100
+        elif not self.num_items:
+            return 0
+
+        # the item count is an estimate so don't claim to be finished until we are
+        return min(self.items_done * 100 // self.num_items, 99)
+
+    def start(self, task):
+        """
+        Starts this export from the given Celery task. Searches with more than EXPORT_SHARD_SIZE items are split into
+        id range shards which are rendered by separate invocations of the task and merged by whichever finishes last.
+        The export covers items up to the newest when it starts, and after the previous run if there is one.
+        """
+        shard_size = getattr(settings, 'EXPORT_SHARD_SIZE', 100000)
+
+        # runs of recurring exports only include items added since the previous successful run
+        after_id = self.previous.get_watermark() if self.previous else 0
+
+        items = self.get_items(self.get_search()).prefetch_related(None).order_by().filter(pk__gt=after_id)
+        stats = items.aggregate(count=Count('pk'), min_id=Min('pk'), max_id=Max('pk'))
+
+        self.num_items = stats['count']
+        self.last_item_id = stats['max_id'] or after_id
+
+        if self.num_items <= shard_size:
+            self.items_done = 0  # from a previous attempt
+            self.save(update_fields=('num_items', 'items_done', 'last_item_id'))
 
-    def render_book(self, book):
-        search = self.get_search()
+            # exclude items added since we counted, as they'll be in the next run
+            self.id_range = (after_id, self.last_item_id)
 
-        self.render_search(book, search)
+            try:
+                self.do_export()
+            except Exception as e:
+                logger.exception("%s #%d failed" % (self.__class__.__name__, self.pk))
+                self.retry_or_fail(task, e)
+            return
 
-    def render_search(self, book, search):  # pragma: no cover
+        # ids aren't evenly distributed across a search but id ranges are much cheaper to split on than offsets
+        num_shards = min(int(math.ceil(float(self.num_items) / shard_size)), self.MAX_SHARDS)
+        step = float(stats['max_id'] - stats['min_id'] + 1) / num_shards
+
+        self.shard_bounds = [stats['max_id'] - int(round(step * s)) for s in range(num_shards)] + [stats['min_id'] - 1]
+        self.save(update_fields=('num_items', 'last_item_id', 'shard_bounds'))
+
+        for shard in range(num_shards):
+            task.delay(self.pk, shard)
+
+    def do_shard(self, task, shard):
+        """
+        Renders a single shard of this export from the given Celery task, retrying it if it fails. If it has no retries
+        left, the whole export is marked as failed. Whichever shard finishes last merges them all.
+        """
+        # a retry after the merge failed doesn't need to write its shard again
+        if shard not in self.shards_done:
+            self.write_shard(task, shard)
+
+        with transaction.atomic():
+            export = self.__class__.objects.select_for_update().get(pk=self.pk)
+            if shard not in export.shards_done:
+                export.shards_done.append(shard)
+                export.save(update_fields=('shards_done',))
+
+            is_last = len(export.shards_done) == export.num_shards
+
+        if is_last:
+            try:
+                export.merge_shards()
+            except Exception as e:
+                logger.exception("Merging shards of %s #%d failed" % (self.__class__.__name__, self.pk))
+                export.retry_or_fail(task, e)
+
+    def write_shard(self, task, shard):
+        """
+        Writes a single shard of this export to storage
+        """
+        self.id_range = (self.shard_bounds[shard + 1], self.shard_bounds[shard])
+        self.num_exported = 0
+
+        try:
+            temp = NamedTemporaryFile(delete=True)
+            writer = CSVExportWriter(temp, header=(shard == 0))
+            self.render_search(writer, self.get_search())
+            writer.close()
+            temp.flush()
+
+            filename = self.get_shard_filename(shard)
+            default_storage.delete(filename)  # from a previous attempt
+            default_storage.save(filename, File(temp))
+        except Exception as e:
+            logger.exception("Shard %d of %s #%d failed" % (shard, self.__class__.__name__, self.pk))
+
+            # don't count the items of this attempt twice
+            self.__class__.objects.filter(pk=self.pk).update(items_done=F('items_done') - self.num_exported)
+
+            self.retry_or_fail(task, e)
+
+    def retry_or_fail(self, task, exc):
+        """
+        Retries the given Celery task after it failed with the given exception, or if it has no retries left, marks
+        this export as failed and re-raises the exception
+        """
+        if task.request.retries >= task.max_retries:
+            self.fail()
+            raise exc
+
+        raise task.retry(exc=exc)
+
+    def merge_shards(self):
+        """
+        Merges the written shards of this export into the final file, newest first
+        """
+        temp = NamedTemporaryFile(delete=True)
+
+        with gzip.GzipFile(fileobj=temp, mode='wb') as merged:
+            for shard in range(self.num_shards):
+                with default_storage.open(self.get_shard_filename(shard), 'rb') as shard_file:
+                    shutil.copyfileobj(gzip.GzipFile(fileobj=shard_file, mode='rb'), merged)
+
+        temp.flush()
+
+        self.save_file(temp, CSVExportWriter.extension)
+
+        for shard in range(self.num_shards):
+            default_storage.delete(self.get_shard_filename(shard))
+
+    def get_shard_filename(self, shard):
+        return '%s/shards/%d-%d.%s' % (self.get_directory(), self.pk, shard, CSVExportWriter.extension)
+
+    def write_file(self, temp):
+        """
+        Search exports can be very large so are streamed to a compressed CSV file
+        """
+        writer = CSVExportWriter(temp)
+        self.render_search(writer, self.get_search())
+        writer.close()
+        return writer.extension
+
+    def get_items(self, search):  # pragma: no cover
+        """
+        Child classes implement this to get the queryset of items for the given search
+        """
         pass
 
+    def render_search(self, writer, search):
+        rows = self.iter_rows(search)
+
+        writer.write_header(next(rows))
+
+        for row in rows:
+            writer.write_row(row)
+
+    def iter_rows(self, search):  # pragma: no cover
+        """
+        Child classes implement this to generate the header row and then the item rows of the given search
+        """
+        pass
+
+    def is_streamable(self):
+        """
+        Whether this export is small enough to stream directly in a response, based on a count which stops at
+        EXPORT_STREAM_THRESHOLD items
+        """
+        threshold = getattr(settings, 'EXPORT_STREAM_THRESHOLD', 1000)
+
+        items = self.get_items(self.get_search()).prefetch_related(None).order_by()
+        return items[:threshold + 1].count() <= threshold
+
+    def stream(self):
+        """
+        Generates this export as the encoded lines of a CSV file
+        """
+        writer = csv.writer(EchoBuffer())
+
+        yield codecs.BOM_UTF8
+
+        for row in self.iter_rows(self.get_search()):
+            line = writer.writerow([CSVExportWriter.format_value(v) for v in row])
+            yield line if six.PY2 else line.encode('utf-8')
+
+    def iter_chunks(self, queryset):
+        """
+        Iterates over the given search queryset in chunks, newest first by id. Items are fetched from a server-side
+        cursor, and any prefetches on the queryset are done per chunk rather than for the entire result set. Progress
+        is recorded on the export as each chunk is consumed.
+        """
+        if self.id_range:
+            queryset = queryset.filter(pk__gt=self.id_range[0], pk__lte=self.id_range[1])
+
+        lookups = queryset._prefetch_related_lookups
+        items = queryset.prefetch_related(None).order_by('-pk').iterator()
+        num_fetched = 0
+
+        while True:
+            start = time.time()
+
+            chunk = list(islice(items, self.CHUNK_SIZE))
+            if not chunk:
+                break
+
+            if lookups:
+                prefetch_related_objects(chunk, *lookups)
+
+            num_fetched += len(chunk)
+
+            logger.info("Fetched %d rows (%d total) for %s #%s in %.3f secs" % (
+                len(chunk), num_fetched, self.__class__.__name__, self.pk, time.time() - start
+            ))
+
+            yield chunk
+
+            # streamed exports aren't saved so have no progress to record
+            if self.pk:
+                self.__class__.objects.filter(pk=self.pk).update(items_done=F('items_done') + len(chunk))
+                self.num_exported += len(chunk)
+
     def get_search(self):
         search = json.loads(self.search)
         if 'after' in search:
@@ -132,19 +559,39 @@ class BaseSearchExport(BaseExport):
         abstract = True
 
 
-class BaseDownloadView(OrgObjPermsMixin, SmartReadView):
+class BaseStreamView(OrgPermsMixin, SmartTemplateView):
     """
-    Download view for exports
+    Streams a small search export directly as a CSV response. Views provide derive_search from a search mixin.
     """
     filename = None
-    template_name = 'download.haml'
 
-    @classmethod
-    def derive_url_pattern(cls, path, action):
-        return r'%s/download/(?P<pk>\d+)/' % path
+    def get(self, request, *args, **kwargs):
+        export = self.model.for_search(request.org, request.user, self.derive_search())
+
+        # search may have grown since it was found to be streamable, in which case generate it in the background
+        if not export.is_streamable():
+            export.save()
+            self.queue_export(export)
+
+            return HttpResponseRedirect(reverse(export.download_view, args=[export.pk]))
+
+        response = StreamingHttpResponse(export.stream(), content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename=%s' % self.filename
+        return response
+
+    def queue_export(self, export):  # pragma: no cover
+        """
+        Child classes implement this to queue the task which generates the given saved export
+        """
+        pass
 
+
+class ExportPermsMixin(OrgObjPermsMixin):
+    """
+    Mixin for views of a single export which partner users can only access if it's for their partner org
+    """
     def has_permission(self, request, *args, **kwargs):
-        if not super(BaseDownloadView, self).has_permission(request, *args, **kwargs):
+        if not super(ExportPermsMixin, self).has_permission(request, *args, **kwargs):
             return False
 
         obj = self.get_object()
@@ -153,6 +600,18 @@ class BaseDownloadView(OrgObjPermsMixin, SmartReadView):
         user_partner = self.request.user.get_partner(obj.org)
         return not user_partner or user_partner == obj.partner
 
+
+class BaseDownloadView(ExportPermsMixin, SmartReadView):
+    """
+    Download view for exports
+    """
+    filename = None
+    template_name = 'download.haml'
+
+    @classmethod
+    def derive_url_pattern(cls, path, action):
+        return r'%s/download/(?P<pk>\d+)/' % path
+
     def derive_title(self):
         return self.title
 
@@ -162,8 +621,16 @@ class BaseDownloadView(OrgObjPermsMixin, SmartReadView):
 
             export_file = default_storage.open(export.filename, 'rb')
 
-            response = HttpResponse(export_file, content_type='application/vnd.ms-excel')
-            response['Content-Disposition'] = 'attachment; filename=%s' % self.filename
+            if export.filename.endswith('.' + CSVExportWriter.extension):
+                # stream the compressed file as is, for the browser to decompress
+                response = FileResponse(export_file, content_type='text/csv; charset=utf-8')
+                response['Content-Encoding'] = 'gzip'
+                filename = '%s.csv' % os.path.splitext(self.filename)[0]
+            else:
+                response = HttpResponse(export_file, content_type='application/vnd.ms-excel')
+                filename = self.filename
+
+            response['Content-Disposition'] = 'attachment; filename=%s' % filename
 
             return response
         else:
@@ -174,4 +641,27 @@ class BaseDownloadView(OrgObjPermsMixin, SmartReadView):
 
         current_url_name = self.request.resolver_match.url_name
         context['download_url'] = '%s?download=1' % reverse(current_url_name, args=[self.object.pk])
+        context['in_progress'] = not self.object.filename and not self.object.is_failed
+        context['failed'] = self.object.is_failed
+        context['progress'] = self.object.progress
+
+        # exports which can recur can be stopped from the download page of any of their runs
+        if 'stop' in self.crudl.actions:
+            recurring_run = self.object.get_recurring_run()
+            if recurring_run:
+                context['stop_url'] = reverse(self.crudl.url_name_for_action('stop'), args=[recurring_run.pk])
+
         return context
+
+
+class BaseStopView(ExportPermsMixin, SmartReadView):
+    """
+    Endpoint for stopping a recurring export, which redirects back to its download page
+    """
+    http_method_names = ['post']
+
+    def post(self, request, *args, **kwargs):
+        export = self.get_object()
+        export.stop_recurring()
+
+        return HttpResponseRedirect(reverse(export.download_view, args=[export.pk]))
@@ -0,0 +1,50 @@
+"""
+Support for long-poll requests which wait for changes to be published on Redis channels. Waiting requests only hold a
+subscription and release their database connection, so idle clients don't touch the database. Views which wait should
+be non-atomic so that they aren't holding a transaction open.
+"""
+from __future__ import unicode_literals
+
+import time
+
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+from django_redis import get_redis_connection
+
+
+def get_push_timeout():
+    return getattr(settings, 'SITE_PUSH_TIMEOUT', 25)
+
+
+@contextmanager
+def subscription(*channels):
+    """
+    Context manager which subscribes to the given channels. Subscribe before checking for changes so that changes
+    published after the check aren't missed.
+    """
+    pubsub = get_redis_connection().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(*channels)
+    try:
+        yield pubsub
+    finally:
+        pubsub.close()
+
+
+def wait_for_publish(pubsub, timeout):
+    """
+    Blocks until something is published on a subscribed channel or the timeout in seconds expires, returning whether
+    something was published. The database connection is closed first unless it's inside a transaction, and will be
+    reopened if it's needed again.
+    """
+    if not connection.in_atomic_block:
+        connection.close()
+
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+
+        if pubsub.get_message(timeout=remaining):
+            return True
@@ -4,20 +4,25 @@ from __future__ import unicode_literals
 import hypothesis.strategies as st
 import pytz
 
+from celery.exceptions import Retry
 from datetime import date, datetime
 from django.core import mail
 from django.http import HttpRequest
 from django.test import override_settings
+from django_redis import get_redis_connection
 from enum import Enum
 from hypothesis import given
+from mock import patch, call
 from uuid import UUID
 
 from casepro.test import BaseCasesTest
 
 from . import safe_max, normalize, match_keywords, truncate, str_to_bool, json_encode, TimelineItem, uuid_to_int
 from . import date_to_milliseconds, datetime_to_microseconds, microseconds_to_datetime, month_range, date_range
-from . import get_language_name, json_decode, humanize_seconds
-from .email import send_email
+from . import get_language_name, json_decode, humanize_seconds, encode_cursor, parse_cursor, json_encode_fast
+from . import get_org_versions, bump_org_version
+from .export import CSVExportWriter
+from .email import deliver_emails, get_email_stats, reserve_email_rate, send_email, send_raw_emails
 from .middleware import JSONMiddleware
 
 
@@ -71,6 +76,15 @@ class UtilsTest(BaseCasesTest):
         d2 = microseconds_to_datetime(ms)
         self.assertEqual(d2, datetime(2015, 10, 9, 14, 48, 30, 123456, tzinfo=pytz.utc))
 
+    def test_cursors(self):
+        d1 = datetime(2015, 10, 9, 14, 48, 30, 123456, tzinfo=pytz.utc)
+        cursor = encode_cursor(d1, 123)
+        self.assertEqual(cursor, '1444402110123456:123')
+        self.assertEqual(parse_cursor(cursor), (d1, 123))
+        self.assertIsNone(parse_cursor(''))
+        self.assertIsNone(parse_cursor(None))
+        self.assertIsNone(parse_cursor('xyz'))
+
     def test_json_encode(self):
         class MyEnum(Enum):
             bar = 1
@@ -89,6 +103,14 @@ class UtilsTest(BaseCasesTest):
         self.assertEqual(json_encode(data), '["string", "2015-10-09T14:48:30.123456Z", "bar", {"bar": "X"}]')
         self.assertEqual(json_encode({'foo': "bar\u1234"}), '{"foo": "bar\\u1234"}')
 
+    def test_json_encode_fast(self):
+        data = {'foo': ["bar/\u1234", 1, True, None]}
+
+        self.assertEqual(json_decode(json_encode_fast(data)), data)
+
+        with patch('casepro.utils.ujson', None):
+            self.assertEqual(json_encode_fast(data), '{"foo": ["bar/\\u1234", 1, true, null]}')
+
     def json_decode(self):
         self.assertEqual(json_decode('{"foo":"bar\\u1234"}'), {'foo': "bar\u1234"})
         self.assertEqual(json_decode('{"foo":"bar\u1234"}'), {'foo': "bar\u1234"})
@@ -118,6 +140,7 @@ class UtilsTest(BaseCasesTest):
         ann = self.create_contact(self.unicef, 'C-101', "Ann")
         msg = self.create_message(self.unicef, 102, ann, "Hello", created_on=d1)
         self.assertEqual(TimelineItem(msg).to_json(), {'time': d1, 'type': 'I', 'item': msg.as_json()})
+        self.assertEqual(TimelineItem(msg).get_sort_key(), (d1, 'I', msg.pk))
 
     def test_uuid_to_int_range(self):
         """
@@ -160,8 +183,47 @@ class UtilsTest(BaseCasesTest):
         self.assertEqual(humanize_seconds(93600), "1\xa0day, 2\xa0hours")
         self.assertEqual(humanize_seconds(180000), "2\xa0days, 2\xa0hours")
 
+    def test_org_versions(self):
+        initial = get_org_versions(self.unicef, 'labels', 'groups')
+
+        bump_org_version(self.unicef.pk, 'labels')
+
+        labels, groups = get_org_versions(self.unicef, 'labels', 'groups')
+        self.assertEqual((labels, groups), (initial[0] + 1, initial[1]))
+
+        # bumps aren't visible until the current transaction commits
+        with patch('django.db.transaction.on_commit') as mock_on_commit:
+            bump_org_version(self.unicef.pk, 'labels')
+
+        self.assertEqual(get_org_versions(self.unicef, 'labels'), (labels,))
+
+        mock_on_commit.call_args[0][0]()
+
+        self.assertEqual(get_org_versions(self.unicef, 'labels'), (labels + 1,))
+
+    def test_csv_format_value(self):
+        kampala = pytz.timezone("Africa/Kampala")
 
+        self.assertEqual(CSVExportWriter.format_value(None), "")
+        self.assertEqual(CSVExportWriter.format_value(True), "Yes")
+        self.assertEqual(CSVExportWriter.format_value(date(2016, 5, 24)), "2016-05-24")
+
+        # datetimes are written in UTC in a format which Excel recognizes
+        self.assertEqual(CSVExportWriter.format_value(datetime(2016, 5, 24, 9, 30, 15, 123456, pytz.UTC)),
+                         "2016-05-24 09:30:15")
+        self.assertEqual(CSVExportWriter.format_value(kampala.localize(datetime(2016, 5, 24, 1, 0))),
+                         "2016-05-23 22:00:00")
+
+
+@override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory',
+                   EMAIL_HOST='relay.test')
 class EmailTest(BaseCasesTest):
+    def setUp(self):
+        super(EmailTest, self).setUp()
+
+        r = get_redis_connection()
+        r.delete(*(r.keys('email:rate:relay.test:*') + ['email:stats:relay.test']))
+
     @override_settings(SEND_EMAILS=True)
     def test_send_email(self):
         send_email([self.user1, 'bob@unicef.org'], "Subject", 'utils/email/export',
@@ -172,6 +234,105 @@ class EmailTest(BaseCasesTest):
         self.assertEqual(mail.outbox[0].subject, "Subject")
         self.assertEqual(mail.outbox[1].to, ["bob@unicef.org"])
 
+        self.assertEqual(get_email_stats(), {'sent': 2})
+
+    @override_settings(SEND_EMAILS=True, EMAIL_BATCH_SIZE=2)
+    def test_send_raw_emails(self):
+        with patch('casepro.utils.email.deliver_emails.delay') as mock_delay:
+            send_raw_emails([
+                ([self.user1, self.user2], "Subject 1", "Text 1", "<p>HTML 1</p>"),
+                (['bob@unicef.org'], "Subject 2", "Text 2", None),
+            ])
+
+        # messages are delivered in batches
+        self.assertEqual(mock_delay.call_args_list, [
+            call([("evan@unicef.org", "Subject 1", "Text 1", "<p>HTML 1</p>"),
+                  ("rick@unicef.org", "Subject 1", "Text 1", "<p>HTML 1</p>")]),
+            call([("bob@unicef.org", "Subject 2", "Text 2", None)]),
+        ])
+
+    @override_settings(EMAIL_DELIVERY_BACKEND=None,
+                       CELERY_EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_deliver_emails_with_celery_email_backend(self):
+        # without a delivery backend, the deployment's backend for other emails is used
+        deliver_emails([("evan@unicef.org", "Subject", "Text", None)])
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["evan@unicef.org"])
+
+    @patch('django.core.mail.backends.locmem.EmailBackend.open')
+    @patch('django.core.mail.backends.locmem.EmailBackend.send_messages')
+    def test_deliver_emails_with_failures(self, mock_send_messages, mock_open):
+        mock_send_messages.side_effect = [1, ValueError("relay down"), 1]
+
+        with patch.object(deliver_emails, 'retry', side_effect=Retry()) as mock_retry:
+            with self.assertRaises(Retry):
+                deliver_emails([
+                    ("evan@unicef.org", "Subject", "Text", None),
+                    ("bob@unicef.org", "Subject", "Text", None),
+                    ("rick@unicef.org", "Subject", "Text", None),
+                ])
+
+        # all messages are sent over one connection
+        self.assertEqual(len(mock_open.mock_calls), 1)
+
+        # only the failed message is retried
+        mock_retry.assert_called_once_with(args=([("bob@unicef.org", "Subject", "Text", None)],),
+                                           kwargs={'attempt': 1}, countdown=30, max_retries=None)
+
+        self.assertEqual(get_email_stats(), {'sent': 2, 'retried': 1})
+
+        # backoff is based on the delivery attempt
+        mock_send_messages.side_effect = ValueError("relay down")
+
+        with patch.object(deliver_emails, 'retry', side_effect=Retry()) as mock_retry:
+            with self.assertRaises(Retry):
+                deliver_emails([("bob@unicef.org", "Subject", "Text", None)], attempt=2)
+
+        mock_retry.assert_called_once_with(args=([("bob@unicef.org", "Subject", "Text", None)],),
+                                           kwargs={'attempt': 3}, countdown=120, max_retries=None)
+
+        # until we give up
+        with patch.object(deliver_emails, 'retry', side_effect=Retry()) as mock_retry:
+            deliver_emails([("bob@unicef.org", "Subject", "Text", None)], attempt=5)
+
+        self.assertEqual(mock_retry.mock_calls, [])
+        self.assertEqual(get_email_stats(), {'sent': 2, 'retried': 2, 'failed': 1})
+
+        # if we can't connect at all, the whole batch is retried
+        mock_open.side_effect = ValueError("relay down")
+        mock_send_messages.reset_mock()
+
+        with patch.object(deliver_emails, 'retry', side_effect=Retry()) as mock_retry:
+            with self.assertRaises(Retry):
+                deliver_emails([
+                    ("evan@unicef.org", "Subject", "Text", None),
+                    ("rick@unicef.org", "Subject", "Text", None),
+                ])
+
+        self.assertEqual(mock_send_messages.mock_calls, [])
+        mock_retry.assert_called_once_with(args=([
+            ("evan@unicef.org", "Subject", "Text", None),
+            ("rick@unicef.org", "Subject", "Text", None),
+        ],), kwargs={'attempt': 1}, countdown=30, max_retries=None)
+
+    @override_settings(EMAIL_RATE_LIMIT=3)
+    def test_reserve_email_rate(self):
+        self.assertEqual(reserve_email_rate('relay.test', 2), 0)
+        self.assertEqual(reserve_email_rate('relay.test', 1), 0)
+
+        # limit for this minute has been reached
+        self.assertGreater(reserve_email_rate('relay.test', 1), 0)
+
+        # and a rate limited batch is retried later
+        with patch.object(deliver_emails, 'retry', side_effect=Retry()) as mock_retry:
+            with self.assertRaises(Retry):
+                deliver_emails([("evan@unicef.org", "Subject", "Text", None)])
+
+        # without counting as a delivery attempt
+        mock_retry.assert_called_once_with(countdown=mock_retry.call_args[1]['countdown'], max_retries=None)
+        self.assertEqual(get_email_stats(), {'rate_limited': 1})
+
 
 class MiddlewareTest(BaseCasesTest):
     def test_json(self):
@@ -1,7 +1,19 @@
 from __future__ import unicode_literals
 
+from django.http import JsonResponse
 from smartmin.views import SmartTemplateView
 
+from . import json_encode_fast
+
+
+class FastJsonResponse(JsonResponse):
+    """
+    JSON response which is encoded with json_encode_fast, for large responses such as pages of search results
+    """
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super(JsonResponse, self).__init__(content=json_encode_fast(data), **kwargs)
+
 
 class PartialTemplate(SmartTemplateView):
     """